@@ -0,0 +1,266 @@
+import pyvisa as visa
+import numpy as np
+import threading
+import time
+import os
+from datetime import date
+
+from Scope_session import ScopeSession, convertFrames
+from Acquisition_pipeline import AcquisitionPipeline
+from Waveform_writer import ChunkedWaveformWriter, save_timestamps, truncate_timestamps
+from Raw_run_format import RawRunWriter
+from Scope_simulator import SimulatedResourceManager
+from Acquisition_telemetry import MetricsLog, metrics_path
+
+
+"""
+This runs SPE acquisitions on several oscilloscopes at the same time, e.g. to test a batch of PMTs
+(BA0131, BA0030, ...) with one scope per PMT instead of one PMT after the other.
+
+Every instrument is driven by its own thread, with its own ScopeSession and its own PMT, channel, HV and LED
+settings (a job). The waveforms of all instruments go through one shared AcquisitionPipeline, whose workers
+convert and save them to a separate file per job, named like the TakingSPEData.py files, each with its own
+metrics file (see Acquisition_telemetry.py).
+A global progress line shows the waveforms taken and the throughput of every instrument and of the whole batch.
+If an instrument fails (connection lost, no triggers, ...) its error is recorded and the other ones carry on.
+
+Edit the jobs at the bottom of this file and run it, or call run_batch() with a list of jobs.
+"""
+
+
+#settings of a job that don't have to be given
+JOB_DEFAULTS = {
+    'channel': 'CH1',
+    'laser': 'ON',
+    'num_waveforms': 10000,
+    'data_length': 1000,
+    'roi': None,                    #(t_start, t_stop) in s to only transfer that region of interest, see Scope_session.py
+    'acquisition_mode': 'single',   #'single' or 'fastframe', see TakingSPEData.py
+    'frames_per_batch': 1000,
+    'wait_method': 'opc',           #how the FastFrame batches are waited for, single waveforms use acquire_raw
+    'acquisition_timeout': 10,      #s without a trigger before the instrument gives up
+    'trigger_level': 1,             #height of the square wave on the AUX trigger input, in V
+}
+
+
+def job_name(job):
+    '''
+    output:
+        str of the file name of a job, without folder and extension, same as TakingSPEData.py
+    '''
+    return f"SPEdataTest_{job['PMT']}-{job['HV']}V_L-{job['LED']}_LASER-{job['laser']}_{job['channel']}"
+
+
+class BatchProgress:
+    '''
+    Waveform counts and throughput of every instrument of a batch, updated from the instrument threads
+    '''
+
+    def __init__(self, jobs):
+        self.lock = threading.Lock()
+        self.t_0 = time.time()
+        self.counts = {job_name(job): 0 for job in jobs}
+        self.targets = {job_name(job): job['num_waveforms'] for job in jobs}
+        self.status = {job_name(job): 'waiting' for job in jobs}
+
+    def update(self, name, count, status='running'):
+        with self.lock:
+            self.counts[name] = count
+            self.status[name] = status
+
+    def line(self):
+        '''
+        output:
+            str of the progress of the whole batch
+        '''
+        with self.lock:
+            elapsed = max(time.time() - self.t_0, 1e-9)
+            total = sum(self.counts.values())
+            parts = [f'{name.split("_")[1]}: {self.counts[name]}/{self.targets[name]} ({self.status[name]})'
+                     for name in self.counts]
+        return f'[{elapsed:7.1f} s] {total} waveforms, {total / elapsed:.1f} waveforms/s | ' + ' | '.join(parts)
+
+
+def setup_trigger(scope, job):
+    '''
+    Set the scope to trigger on the LED flashes on its AUX input, one acquisition per trigger (same as TakingSPEData.py)
+
+    input:
+        scope: ScopeSession of the instrument
+        job: dictionary of the job settings
+    '''
+    scope.write('ACQuire:STOPAfter SEQuence')
+    scope.write('TRIGger:A:TYPe EDGE') #set to edge trigger
+    scope.write('TRIGger:A:EDGE:SOUrce AUX')  #specifies that this is externally triggered (scope trigger port is AUX)
+    scope.write('TRIGger:A:EDGE:SLOpe RISE')
+    scope.write(f"TRIGger:A:LEVel:AUXin {job['trigger_level']}")
+
+
+def run_instrument(rm, job, pipeline, writer, progress, stop, metrics_file=None, timestamps_name=None):
+    '''
+    Take the data of one job on its instrument, handing the raw waveforms to the shared pipeline.
+    Runs in its own thread.
+
+    input:
+        rm: VISA resource manager to open the instrument with
+        job: dictionary of the job settings
+        pipeline: shared AcquisitionPipeline that converts and saves the waveforms
+        writer: the file writer of this job, its num_committed is where a resumed run starts
+        progress: shared BatchProgress
+        stop: threading.Event, set to stop every instrument early
+        metrics_file: str of the path to stream the telemetry of this instrument to, None for no metrics
+        timestamps_name: str of the full path name of the run, the FastFrame trigger timestamps are appended to
+                         {timestamps_name}_timestamps.csv like TakingSPEData.py does, None to not save them
+    output:
+        dictionary with the number of waveforms, the time taken, the round trips per waveform
+        and the telemetry summary
+    '''
+    name = job_name(job)
+    scope = ScopeSession(rm.open_resource(job['address']), job['channel'], job['data_length'],
+                         wait_method=job['wait_method'], roi=job['roi'])
+    metrics = None
+    try:
+        idn = scope.query('*IDN?')
+        setup_trigger(scope, job)
+        if metrics_file is not None:
+            metrics = MetricsLog(scope, metrics_file)
+
+        waveform_id = writer.num_committed
+        progress.update(name, waveform_id)
+        t_0 = time.time()
+
+        while waveform_id < job['num_waveforms'] and not stop.is_set():
+
+            if job['acquisition_mode'] == 'fastframe':
+                batch_size = min(job['frames_per_batch'], job['num_waveforms'] - waveform_id)
+                frames, scal_info, timestamps = scope.collect_fastframe_raw(batch_size, job['acquisition_timeout'])
+                if timestamps_name is not None:
+                    save_timestamps(timestamps, waveform_id, timestamps_name)
+            else:
+                #armed, waited for and read back in one round trip
+                raw_waveform_data, scal_info = scope.acquire_raw(job['acquisition_timeout'])
+                if raw_waveform_data is None:
+                    raise TimeoutError(f"no trigger within {job['acquisition_timeout']} s")
+                frames = raw_waveform_data[np.newaxis, :]
+
+            pipeline.put((name, waveform_id, frames, scal_info))
+            waveform_id += len(frames)
+            progress.update(name, waveform_id)
+            if metrics is not None:
+                metrics.update(queue_depth=pipeline.depth())
+
+        return {
+            'instrument': idn.strip(),
+            'waveforms': waveform_id,
+            'seconds': time.time() - t_0,
+            'round trips per waveform': scope.round_trips_per_waveform(),
+            'metrics': metrics.summary() if metrics is not None else None,
+        }
+    finally:
+        if metrics is not None:
+            metrics.close()
+        scope.close()
+
+
+def run_batch(jobs, folder=None, output_format='raw', num_workers=4, max_queue=1000, use_simulator=False,
+              progress_every=5.0, resume=True, rm=None):
+    '''
+    Run several acquisition jobs concurrently, one thread per instrument
+
+    input:
+        jobs: list of dictionaries with at least 'address', 'PMT', 'HV' and 'LED' (see JOB_DEFAULTS for the rest)
+        folder: str of the folder to save to (default ./SPE_PMT_data/{date}/)
+        output_format: 'raw' (.pmtraw) or 'csv', see TakingSPEData.py
+        num_workers: int of pipeline worker threads shared by all instruments
+        max_queue: int of raw batches that can wait in the pipeline
+        use_simulator: if True every address is a SimulatedScope
+        progress_every: float of seconds between progress lines
+        resume: if True, jobs whose files already exist carry on where they stopped
+        rm: resource manager to open the instruments with, by default one is opened (and closed) here
+    output:
+        dictionary of job name: result dictionary, with an 'error' entry for the jobs that failed
+    '''
+    jobs = [dict(JOB_DEFAULTS, **job) for job in jobs]
+    if folder is None:
+        folder = f"./SPE_PMT_data/{date.today().strftime('%y-%m-%d')}/"
+    os.makedirs(folder, exist_ok=True)
+
+    writers = {}
+    for job in jobs:
+        name = job_name(job)
+        if output_format == 'raw':
+            metadata = {'PMT': job['PMT'], 'PMT voltage (V)': job['HV'], 'LED wavelength (nm)': job['LED'],
+                        'laser': job['laser'], 'channel': job['channel'], 'address': job['address']}
+            writers[name] = RawRunWriter(f'{folder}{name}.pmtraw', metadata, resume)
+        else:
+            writers[name] = ChunkedWaveformWriter(f'{folder}{name}', resume=resume)
+        #the waveforms after the last committed one are taken again, with their timestamps
+        truncate_timestamps(f'{folder}{name}', writers[name].num_committed)
+
+    def store(item):
+        name, first_id, frames, scal_info = item
+        if output_format == 'raw':
+            writers[name].add(first_id, frames, scal_info)
+        else:
+            for i, waveform in enumerate(convertFrames(frames, scal_info)):
+                writers[name].add(first_id + i, waveform)
+
+    own_rm = rm is None
+    if own_rm:
+        rm = SimulatedResourceManager() if use_simulator else visa.ResourceManager('@py')
+    pipeline = AcquisitionPipeline(store, num_workers, max_queue)
+    progress = BatchProgress(jobs)
+    stop = threading.Event()
+    results = {}
+
+    def worker(job):
+        name = job_name(job)
+        try:
+            results[name] = run_instrument(rm, job, pipeline, writers[name], progress, stop,
+                                           metrics_path(f'{folder}{name}'), f'{folder}{name}')
+            progress.update(name, results[name]['waveforms'], 'done')
+        except Exception as error:
+            #one failing instrument must not take the others down
+            results[name] = {'error': f'{type(error).__name__}: {error}'}
+            progress.update(name, writers[name].num_committed, 'FAILED')
+            print(f'{name} failed: {type(error).__name__}: {error}')
+
+    threads = [threading.Thread(target=worker, args=(job,), daemon=True) for job in jobs]
+    try:
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=progress_every / len(threads))
+            print(progress.line())
+    except KeyboardInterrupt:
+        print('Stopping all instruments')
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        #save everything still in flight
+        pipeline.close()
+        for name, writer in writers.items():
+            writer.close()
+            if output_format == 'csv' and 'error' not in results.get(name, {'error': ''}):
+                writer.merge()
+        if own_rm:
+            rm.close()
+
+    print(progress.line())
+    pipeline.report()
+    return results
+
+
+if __name__ == '__main__':
+
+    #one job per scope, each with its own PMT, channel, HV and LED
+    jobs = [
+        {'address': 'TCPIP::142.90.115.154::inst0::INSTR', 'PMT': 'BA0131', 'HV': 1300, 'LED': 235},
+        {'address': 'TCPIP::142.90.100.19::inst0::INSTR', 'PMT': 'BA0030', 'HV': 1300, 'LED': 235},
+    ]
+
+    results = run_batch(jobs, use_simulator=False)
+    for name, result in results.items():
+        print(name, result)
@@ -0,0 +1,107 @@
+import threading
+import queue
+import traceback
+
+
+"""
+This is a small producer/consumer engine for the acquisition scripts (TakingSPEData.py and TakingDataScope.py).
+
+The main thread only talks to the oscilloscope and puts the raw waveforms on a bounded queue, while worker
+threads take them off the queue to convert and save them, so the scope is not left idle while we write to disk.
+When the queue is full, put() blocks until a worker frees a spot (backpressure), so a slow disk slows the
+acquisition down instead of filling up the memory.
+
+close() has to be called in the finally: block of the script: it waits until everything still in the queue
+has been handled before returning, so nothing in flight is lost when the run stops.
+"""
+
+
+#put on the queue once per worker to tell it to stop
+_STOP = object()
+
+
+class AcquisitionPipeline:
+    '''
+    Bounded queue between the thread reading the scope and the worker threads converting and saving the data
+
+    input:
+        handler: function called by the workers with every item put on the queue, e.g. to convert and save a waveform
+        num_workers: int of worker threads
+        max_queue: int of how many items can wait in the queue before put() blocks
+    '''
+
+    def __init__(self, handler, num_workers=2, max_queue=1000):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+
+        self.errors = []         #(item, traceback str) of every item the handler failed on
+        self.max_depth = 0       #largest number of items that were waiting in the queue
+        self.num_handled = 0
+        self.lock = threading.Lock()
+
+        self.closed = False
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                self.handler(item)
+                with self.lock:
+                    self.num_handled += 1
+            except Exception:
+                #keep the worker alive, the error is reported when the pipeline is closed
+                with self.lock:
+                    self.errors.append((item, traceback.format_exc()))
+            finally:
+                self.queue.task_done()
+
+    def put(self, item):
+        '''
+        Hand an item over to the workers, blocks while the queue is full
+
+        input:
+            item: anything the handler knows how to deal with
+        '''
+        self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def depth(self):
+        '''
+        output:
+            int of how many items are waiting in the queue right now
+        '''
+        return self.queue.qsize()
+
+    def close(self):
+        '''
+        Wait until every item in the queue has been handled, then stop the workers
+
+        output:
+            list of (item, traceback str) for the items the handler failed on
+        '''
+        if self.closed:
+            return self.errors
+        self.closed = True
+
+        for _ in self.workers:
+            self.queue.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+
+        if self.errors:
+            print(f'{len(self.errors)} items could not be handled, first error:\n{self.errors[0][1]}')
+
+        return self.errors
+
+    def report(self):
+        '''
+        Print how many items were handled and how deep the queue got
+        '''
+        print(f'{self.num_handled} items handled by {len(self.workers)} workers, '
+              f'max queue depth {self.max_depth}/{self.max_queue}, {len(self.errors)} errors')
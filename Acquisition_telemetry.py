@@ -0,0 +1,182 @@
+import numpy as np
+import time
+import json
+from datetime import datetime
+
+
+"""
+This streams the performance of an acquisition run to a metrics file next to the data, {name}_metrics.jsonl,
+so a slow run can be traced to the network, the scope or our own Python.
+
+ScopeSession times every write, query and binary read it sends (command_stats) and keeps the wait time of every
+acquisition. Every `every` seconds MetricsLog.update() appends one JSON line with what happened since the last line:
+
+    waveforms_per_s     waveforms read back
+    bytes_per_s         bytes read back from the scope (CURV? and query replies)
+    trigger_rate_hz     accepted triggers per second of live time (scope armed and waiting)
+    live_fraction       fraction of the time the scope was armed and waiting for a trigger
+    io_fraction         fraction of the time spent in commands to the scope outside of the waits (readout, arming)
+    python_fraction     the rest of the dead time: converting, queueing, saving, our own loop
+    commands            count and mean time in ms of every command header, e.g. 'CURV?'
+
+plus anything passed to update() (e.g. the queue depth of the pipeline). close() appends a summary line
+over the whole run, with the total and max time of every command, and prints it.
+
+A large io_fraction with a slow CURV? means the network (or the record length) limits the run, a long time in
+the scope commands that don't move data means the scope does, and a large python_fraction means we do.
+"""
+
+
+#commands sent while waiting for a trigger, their time is live time and not readout time
+WAIT_COMMANDS = ('*OPC?', 'ACQ:STATE?', '*CLS', '*OPC', '*ESR?',
+                 'ACQUIRE:STATE RUN;*WAI;:CURVE?')  #Scope_session.ACQUIRE_AND_READ, the wait and its transfer
+
+
+def metrics_path(name):
+    '''
+    output:
+        str of the metrics file of the run {name}, next to its data
+    '''
+    return f'{name}_metrics.jsonl'
+
+
+class MetricsLog:
+    '''
+    Write the performance of a ScopeSession to a JSON lines file while it is taking data
+
+    input:
+        session: ScopeSession taking the data
+        path: str of the metrics file, lines are appended so a resumed run keeps its earlier lines
+        every: float of seconds between lines
+    '''
+
+    def __init__(self, session, path, every=5.0):
+        self.session = session
+        self.path = path
+        self.every = every
+        self.file = open(path, 'a')
+
+        self.t_start = time.time()
+        self.last = self._counters()
+        self.first = self.last
+        self.last_line = time.time()
+
+        self._write({'event': 'start', 'date': datetime.now().isoformat(timespec='seconds'), 'path': path})
+
+    def _counters(self):
+        '''
+        output:
+            dictionary of the running totals of the session
+        '''
+        session = self.session
+        return {
+            'time': time.time(),
+            'waveforms': session.num_waveforms,
+            'bytes': session.bytes_read,
+            'round_trips': session.round_trips,
+            'live': session.live_time(),
+            'acquisitions': len(session.wait_times),
+            'commands': {header: list(stats) for header, stats in session.command_stats.items()},
+        }
+
+    def _write(self, line):
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+
+    @staticmethod
+    def _metrics(before, after):
+        '''
+        output:
+            dictionary of the rates and time fractions between two sets of counters
+        '''
+        elapsed = max(after['time'] - before['time'], 1e-9)
+        waveforms = after['waveforms'] - before['waveforms']
+        live = after['live'] - before['live']
+
+        commands = {}
+        io = 0.0
+        for header, (count, total, longest) in after['commands'].items():
+            count_0, total_0, _ = before['commands'].get(header, [0, 0.0, 0.0])
+            if count > count_0:
+                commands[header] = {'count': count - count_0, 'mean_ms': 1e3 * (total - total_0) / (count - count_0)}
+                if header.upper() not in WAIT_COMMANDS:
+                    io += total - total_0
+
+        return {
+            'elapsed_s': elapsed,
+            'waveforms': waveforms,
+            'waveforms_per_s': waveforms / elapsed,
+            'bytes_per_s': (after['bytes'] - before['bytes']) / elapsed,
+            'round_trips_per_waveform': (after['round_trips'] - before['round_trips']) / max(waveforms, 1),
+            'trigger_rate_hz': waveforms / live if live > 0 else 0.0,
+            'live_fraction': live / elapsed,
+            'io_fraction': io / elapsed,
+            'python_fraction': max(1 - (live + io) / elapsed, 0.0),
+            'commands': commands,
+        }
+
+    def update(self, force=False, **extra):
+        '''
+        Append a line of metrics if `every` seconds have passed since the last one, cheap enough to call every waveform
+
+        input:
+            force: if True write the line now
+            **extra: other values to put in the line, e.g. queue_depth=pipeline.depth()
+        '''
+        if not force and time.time() - self.last_line < self.every:
+            return
+
+        counters = self._counters()
+        line = {'event': 'interval', 't_s': counters['time'] - self.t_start, 'total_waveforms': counters['waveforms']}
+        line.update(self._metrics(self.last, counters))
+        line.update(extra)
+        self._write(line)
+
+        self.last = counters
+        self.last_line = time.time()
+
+    def summary(self):
+        '''
+        output:
+            dictionary of the metrics over the whole run, with the total and max time of every command
+        '''
+        counters = self._counters()
+        summary = {'event': 'summary', 'total_bytes': counters['bytes'] - self.first['bytes']}
+        summary.update(self._metrics(self.first, counters))
+
+        for header, stats in summary['commands'].items():
+            count, total, longest = self.session.command_stats[header]
+            stats['total_s'] = total - self.first['commands'].get(header, [0, 0.0, 0.0])[1]
+            stats['max_ms'] = 1e3 * longest
+        if self.session.readout_latencies:
+            summary['mean_readout_latency_ms'] = 1e3 * float(np.mean(self.session.readout_latencies))
+
+        return summary
+
+    def close(self):
+        '''
+        Append the summary line, print it and close the file
+
+        output:
+            dictionary of the summary
+        '''
+        if self.file is None:
+            return None
+
+        summary = self.summary()
+        self._write(summary)
+        self.file.close()
+        self.file = None
+
+        print(f"{summary['waveforms']} waveforms in {summary['elapsed_s']:.1f} s: "
+              f"{summary['waveforms_per_s']:.1f} waveforms/s, {summary['bytes_per_s'] / 1e3:.1f} kB/s read, "
+              f"trigger rate {summary['trigger_rate_hz']:.1f} Hz")
+        print(f"time spent waiting for triggers {100 * summary['live_fraction']:.1f}%, "
+              f"talking to the scope {100 * summary['io_fraction']:.1f}%, "
+              f"in our own Python {100 * summary['python_fraction']:.1f}%")
+        slowest = sorted(summary['commands'].items(), key=lambda item: -item[1]['total_s'])[:5]
+        for header, stats in slowest:
+            print(f"    {header:<40} {stats['count']:>8} x {stats['mean_ms']:8.3f} ms (max {stats['max_ms']:.3f} ms)")
+        print(f'Metrics saved to {self.path}')
+
+        return summary
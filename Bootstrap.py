@@ -0,0 +1,194 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from SPE_likelihood import fit_spe
+
+
+"""
+This estimates the uncertainty of anything computed from the waveforms of a run (the mean charge, the peak
+height, the parameters of an SPE fit, ...) by resampling the waveforms: the per-waveform values (e.g. the
+charge and amplitude columns of a Pulse_features table) are resampled and the statistic is computed again on
+every resample, the spread of the results is its uncertainty.
+
+    bootstrap()     num_resamples resamples of n waveforms drawn with replacement, all drawn at once as an
+                    index matrix (num_resamples x n) from a seeded generator, so a rerun gives the same result.
+                    Gives the standard error, the bias and a percentile confidence interval.
+    jackknife()     the run is split in num_groups consecutive groups of waveforms and each group is left out
+                    in turn. Cheaper (20 refits instead of 1000), gives the standard error and the bias, and
+                    leaving out consecutive groups also catches drifts during the run.
+
+The statistic is a function of the values of the waveforms, returning a number or a 1D array. Fits are
+spread across worker processes (num_workers), a batch of resamples per task, so the statistic has to be
+defined at the top level of a module (or be a functools.partial of one). A statistic that works along the last
+axis (e.g. functools.partial(np.mean, axis=-1)) of 1D values can be vectorized=True: it then gets a whole batch
+of resamples as a 2D array and no loop or process is needed at all. A resample whose fit fails gives NaN and is
+left out, a statistic that fails on all the waveforms raises a ValueError.
+"""
+
+
+def bootstrap_indices(num_values, num_resamples=1000, seed=0):
+    '''
+    output:
+        2D np.array of num_resamples rows of num_values indices drawn with replacement
+    '''
+    rng = np.random.default_rng(seed)
+    dtype = np.int32 if num_values < 2**31 else np.int64
+    return rng.integers(0, num_values, size=(num_resamples, num_values), dtype=dtype)
+
+
+def jackknife_groups(num_values, num_groups=20):
+    '''
+    output:
+        list of num_groups 1D np.arrays of the indices kept when each group of consecutive values is left out
+    '''
+    groups = np.array_split(np.arange(num_values), num_groups)
+    return [np.concatenate(groups[:i] + groups[i + 1:]) for i in range(len(groups))]
+
+
+def _evaluate(statistic, sample):
+    '''
+    output:
+        1D np.array of the statistic of one sample, None if it failed
+    '''
+    try:
+        return np.atleast_1d(np.asarray(statistic(sample), dtype=np.float64))
+    except (RuntimeError, ValueError, np.linalg.LinAlgError):
+        return None
+
+
+def _run_batch(item):
+    '''
+    Compute the statistic on a batch of resamples, in a worker process
+
+    output:
+        list of 1D np.arrays (None for the resamples that failed)
+    '''
+    statistic, values, indices, vectorized = item
+    if vectorized:
+        return list(np.asarray(statistic(values[indices]), dtype=np.float64).reshape(len(indices), -1))
+    return [_evaluate(statistic, values[index]) for index in indices]
+
+
+def _resample(values, statistic, indices, num_workers, vectorized, batch_size):
+    '''
+    output:
+        2D np.array of the statistic of every resample, one row per resample, NaN rows for the failed ones
+    '''
+    batches = [indices[start:start + batch_size] for start in range(0, len(indices), batch_size)]
+    items = [(statistic, values, batch, vectorized) for batch in batches]
+
+    if num_workers == 1 or vectorized:
+        outputs = [_run_batch(item) for item in items]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            outputs = list(pool.map(_run_batch, items))
+
+    results = [result for output in outputs for result in output]
+    size = max((len(result) for result in results if result is not None), default=1)
+    return np.array([np.full(size, np.nan) if result is None else result for result in results])
+
+
+def bootstrap(values, statistic, num_resamples=1000, confidence=0.68, num_workers=None, seed=0,
+              vectorized=False, batch_size=None):
+    '''
+    Bootstrap uncertainty of a statistic of the waveforms of a run
+
+    input:
+        values: np.array of the per-waveform values, one waveform per row (or per entry of a 1D array)
+        statistic: function of such an array returning a number or a 1D array (see the top of this file)
+        num_resamples: int of bootstrap resamples
+        confidence: float of the probability content of the interval, 0.68 for 1 sigma
+        num_workers: int of worker processes, None for one per core, 1 to run in this process
+        seed: int of the seed of the resampling
+        vectorized: if True the statistic takes a 2D array of resamples and works along its last axis
+        batch_size: int of resamples per task, by default enough for about 4 tasks per worker (or for about
+                    10^7 resampled values if vectorized)
+    output:
+        dictionary of 1D np.arrays, one value per output of the statistic:
+            'estimate' (on all the waveforms), 'std' (standard error), 'bias', 'low' and 'high' (percentile
+            interval), plus 'samples' (2D, one row per resample) and 'failed' (int of resamples that failed)
+    '''
+    values = np.asarray(values)
+    indices = bootstrap_indices(len(values), num_resamples, seed)
+    if batch_size is None:
+        if vectorized:
+            #about 10^7 resampled values at a time
+            batch_size = max(int(1e7 // max(values.size, 1)), 1)
+        else:
+            batch_size = max(len(indices) // (4 * (num_workers or os.cpu_count() or 1)), 1)
+
+    estimate = _evaluate(statistic, values)
+    if estimate is None:
+        raise ValueError('the statistic failed on all the waveforms, there is no estimate to resample')
+    samples = _resample(values, statistic, indices, num_workers, vectorized, batch_size)
+    good = np.all(np.isfinite(samples), axis=1)
+    tail = 100 * (1 - confidence) / 2
+
+    return {
+        'estimate': estimate,
+        'std': np.std(samples[good], axis=0, ddof=1),
+        'bias': np.mean(samples[good], axis=0) - estimate,
+        'low': np.percentile(samples[good], tail, axis=0),
+        'high': np.percentile(samples[good], 100 - tail, axis=0),
+        'samples': samples,
+        'failed': int(np.sum(~good)),
+    }
+
+
+def jackknife(values, statistic, num_groups=20, num_workers=None, vectorized=False):
+    '''
+    Grouped (delete-a-group) jackknife uncertainty of a statistic of the waveforms of a run
+
+    input:
+        values: np.array of the per-waveform values, one waveform per row (or per entry of a 1D array)
+        statistic: function of such an array returning a number or a 1D array
+        num_groups: int of groups of consecutive waveforms
+        num_workers: int of worker processes, None for one per core, 1 to run in this process
+        vectorized: if True the statistic can take a 2D array of samples (the groups are then cut to the
+                    same size, leaving out at most num_groups - 1 waveforms)
+    output:
+        dictionary of 1D np.arrays: 'estimate', 'std' (standard error), 'bias', and 'samples' and 'failed'
+    '''
+    values = np.asarray(values)
+    if vectorized:
+        values = values[:len(values) - len(values) % num_groups]
+    indices = jackknife_groups(len(values), num_groups)
+    if vectorized:
+        indices = np.array(indices)
+
+    estimate = _evaluate(statistic, values)
+    if estimate is None:
+        raise ValueError('the statistic failed on all the waveforms, there is no estimate to resample')
+    samples = _resample(values, statistic, indices, num_workers, vectorized,
+                        max(len(indices) // (num_workers or os.cpu_count() or 1), 1))
+    good = np.all(np.isfinite(samples), axis=1)
+    num_good = good.sum()
+    mean = np.mean(samples[good], axis=0)
+
+    return {
+        'estimate': estimate,
+        'std': np.sqrt((num_good - 1) / num_good * np.sum((samples[good] - mean)**2, axis=0)),
+        'bias': (num_good - 1) * (mean - estimate),
+        'samples': samples,
+        'failed': int(np.sum(~good)),
+    }
+
+
+def spe_fit_statistic(charges, model='spe', parameters=('gain', 'mu'), p0=None, bins=1000):
+    '''
+    Statistic for the bootstrap of an SPE fit: the fit_spe parameters of the charges
+
+    input:
+        charges: 1D np.array of the charges in C
+        model: str of the SPE_likelihood model
+        parameters: names of the parameters to return
+        p0: list of starting values, e.g. the fit of all the charges so every refit starts close to its result
+        bins: int of bins of the likelihood histogram
+    output:
+        1D np.array of the parameters, NaN if the fit did not converge
+    '''
+    fit = fit_spe(charges, model, bins, p0=p0)
+    if not fit['converged']:
+        return np.full(len(parameters), np.nan)
+    return np.array([fit['params'][name] for name in parameters])
@@ -1,6 +1,10 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+import os
+
+from Grid_analysis import analyze_grid, grid_rows, SUMMARY
+from Gain_curve import fit_power_law, power_law
 
 """This script plots the charge of the PMT response by measuring the area under the PMT pulse.
 
@@ -24,60 +28,65 @@ colors = ['red', 'blue', 'green', 'orange', 'purple',
 
 R=50 # Resistance in Ohms
 
+#every (PMT, LED, HV) file is analysed in its own process, this many at a time
+num_workers = os.cpu_count()
+
             
+if __name__ == '__main__':
 
-for PMT_ID in PMT_IDs:
+    tasks = []
+    for PMT_ID in PMT_IDs:
+        for LED_ID in LED_IDs:
 
-    c=0
-    plt.figure(figsize = (8,6))
+            if LED_ID =="308":
+                #t1 = 4e-7
+                t1 = 3.5e-7
 
-    for LED_ID in LED_IDs:
+            for set_voltage in range(500,1350,100):
 
-        if LED_ID =="308":
-            #t1 = 4e-7
-            t1 = 3.5e-7
-        area_data = []
+                #TODO
+                #Keep an eye on the file path, it may need to be adjusted
+                file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
+                tasks.append({'PMT': PMT_ID, 'LED': LED_ID, 'HV': set_voltage, 'file': file, 't0': t0, 't1': t1, 'resistance': R})
 
-        for set_voltage in range(500,1350,100):
+    # The baseline-subtracted charge of every waveform is in the feature table of each file (extracted the
+    # first time it is read, see Pulse_features.py), their mean is the charge of the average pulse.
+    # Files that can't be read are reported and left out of the plots
+    results, errors = analyze_grid(tasks, num_workers)
 
-            all_voltages = []
-            #TODO
-            #Keep an eye on the file path, it may need to be adjusted
-            file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
-            file_ = pd.read_csv(file, delimiter=',', header=0, skiprows=1)
-            file_ = np.array(file_)
+    for PMT_ID in PMT_IDs:
 
-            times = file_[:,0]
-            index_0  = np.searchsorted(times, t0 - tol, side='left')
-            index_f  = np.searchsorted(times, t1 + tol, side='right') - 1
-            times = times[index_0:index_f+1]
+        c=0
+        plt.figure(figsize = (8,6))
 
-            for q in range(1,99):
-                voltages = file_[:,q]
-                voltages = voltages[index_0:index_f+1]
-                all_voltages.append(voltages)
+        for LED_ID in LED_IDs:
 
-            average_pulse = np.mean(all_voltages, axis=0)
-            # Here we calculate the area under the pulse and divide by R to get the charge
-            area = (np.trapz(average_pulse, times))/R
-            area_data.append((set_voltage, area))
+            rows = grid_rows(tasks, PMT=PMT_ID, LED=LED_ID)
 
-        area_data = np.array(area_data)
+            HV = np.array([tasks[i]['HV'] for i in rows])
+            areas = np.abs(results[rows, SUMMARY.index('charge_mean')])
+            area_errors = results[rows, SUMMARY.index('charge_mean_err')]
 
-        HV = area_data[:,0]
-        areas = np.abs(area_data[:,1])
+            plt.errorbar(HV, areas, yerr=area_errors, fmt='o', label=f'Measured Charge LED_{LED_ID}',color=colors[c])
+            # plt.plot(HV, areas, '-',color=colors[c])
 
-        plt.plot(HV, areas, 'o', label=f'Measured Charge LED_{LED_ID}',color=colors[c])
-        # plt.plot(HV, areas, '-',color=colors[c])
+            # With the LED intensity fixed the mean charge follows the gain, a power law of the HV
+            try:
+                curve = fit_power_law(HV, areas, area_errors)
+                HV_fit = np.linspace(HV.min(), HV.max(), 100)
+                plt.plot(HV_fit, power_law(HV_fit, curve['gain_ref'], curve['exponent'], curve['voltage_ref']), '--',
+                         color=colors[c], label=f"Power law LED_{LED_ID}: k = {curve['exponent']:.2f} +- {curve['exponent_err']:.2f}")
+            except ValueError as error:
+                print(f'No power law for PMT {PMT_ID} LED {LED_ID}: {error}')
 
-        c+=1
+            c+=1
 
-    plt.legend()
-    plt.title(f'Abs. Charge vs. HV Supply for PMT {PMT_ID}')
-    plt.xlabel('High Voltage Supplied (V)')
-    plt.ylabel('Abs. Charge (C)')
-    plt.tight_layout()
-    #TODO
-    #Change the path to save the figure as needed
-    plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/FIXED_Charge_PMT_{PMT_ID}_{LED_ID}.png')
-    plt.close()
+        plt.legend()
+        plt.title(f'Abs. Charge vs. HV Supply for PMT {PMT_ID}')
+        plt.xlabel('High Voltage Supplied (V)')
+        plt.ylabel('Abs. Charge (C)')
+        plt.tight_layout()
+        #TODO
+        #Change the path to save the figure as needed
+        plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/FIXED_Charge_PMT_{PMT_ID}_{LED_ID}.png')
+        plt.close()
@@ -0,0 +1,328 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import time
+import os
+
+from SPE_likelihood import fit_spe, initial_values, MODELS
+from Pulse_features import load_features
+
+
+"""
+This fits the gain curve of PMTs: the SPE charge spectrum of every HV point of a sweep is fitted
+(SPE_likelihood.fit_spe) and the gains are fitted with a power law of the HV, gain = gain_ref * (HV / HV_ref) ** k,
+like the gain of a dynode chain. No starting values have to be tuned by hand:
+
+- the points of a sweep are fitted from the highest HV down, the peaks are best separated there and the first
+  fit starts from values taken from the charges. Every following point starts from the result of its neighbour,
+  with the gain (and the width of the photoelectron peak) scaled to the new HV with the slope of the points
+  already fitted. The LED intensity, pedestal and noise don't change with the HV, so they are kept.
+  If that fit does not converge, it is redone from values taken from the charges and the better one is kept.
+- at the lowest HV points the photoelectron peak sinks into the pedestal and the fit can converge to a gain
+  that is far off, with a large error. A point is only 'resolved' if its gain is known to MAX_GAIN_ERROR and is
+  at least MIN_SEPARATION pedestal widths, the power law of a sweep is fitted to the resolved points only.
+- the sweeps of different PMTs and LEDs are independent, so fit_gain_curves() fits them in parallel, one worker
+  process per sweep, and hands back compact arrays in the order of the sweeps. A sweep that fails is reported
+  and the other ones carry on.
+
+A sweep is a dictionary {'PMT': ..., 'LED': ..., 'files': {HV: file, ...}, 't0': ..., 't1': ...}, the charges of
+every file come from its feature table (see Pulse_features.py). fit_hv_sweep() and fit_power_law() can also be
+used directly on charges, e.g. from the _charges.csv files of Online_analysis.py.
+"""
+
+
+ELEMENTARY_CHARGE = 1.602176634e-19  #C
+DEFAULT_EXPONENT = 7.0  #gain slope used to scale the first warm start, about the number of dynodes times 0.7
+
+#parameters of the poisson models that scale with the gain from one HV point to the next
+GAIN_PARAMETERS = ('gain', 'sigma1', 'tau')
+
+MAX_GAIN_ERROR = 0.2    #relative error of the gain above which the photoelectron peak is not resolved
+MIN_SEPARATION = 1.0    #gain in pedestal widths below which it is not resolved either
+
+
+def unresolved(fit):
+    '''
+    Check if the photoelectron peak of a fit_spe result is resolved from the pedestal
+
+    output:
+        str of the reason the gain of the fit can't be used for the gain curve, None if it can
+    '''
+    gain, gain_err = fit['params']['gain'], fit['errors']['gain']
+    pedestal_width = fit['params'].get('sigma0', fit['params'].get('sigma'))
+    if not fit['converged']:
+        return 'did not converge'
+    if 'gain' in fit.get('at_bound', []):
+        return 'gain at a bound'
+    if not (np.isfinite(gain) and np.isfinite(gain_err) and gain > 0):
+        return 'no finite gain'
+    if gain_err > MAX_GAIN_ERROR * gain:
+        return f'relative gain error {gain_err / gain:.2f}'
+    if gain < MIN_SEPARATION * pedestal_width:
+        return f'gain of {gain / pedestal_width:.2f} pedestal widths'
+    return None
+
+
+def _warm_start(fit, charges, ratio):
+    '''
+    output:
+        list of starting values for the charges of the next HV point, from the fit of its neighbour
+    '''
+    p0 = []
+    for name in fit['names']:
+        value = fit['params'][name]
+        if name == 'N':
+            value = len(charges)
+        elif name in GAIN_PARAMETERS:
+            value = value * ratio
+        p0.append(value)
+    return p0
+
+
+def fit_hv_sweep(charges_by_hv, model='spe', bins=1000):
+    '''
+    Fit the charge spectra of all the HV points of a sweep, each one warm started from its neighbour
+
+    input:
+        charges_by_hv: dictionary of HV in V: 1D array of the charges in C at that HV
+        model: 'poisson', 'spe' or 'spe_background' (see SPE_likelihood.py)
+        bins: int of bins of the likelihood histograms
+    output:
+        dictionary of 1D np.arrays, one value per HV point in increasing HV:
+            'HV', 'gain' and 'gain_err' (charge of one photoelectron in C), 'mu' and 'mu_err',
+            'converged' (bool), 'resolved' (bool, see unresolved()), 'num_charges'
+        and 'fits': list of the fit_spe results, in the same order
+    '''
+    if 'gain' not in dict(MODELS[model]):
+        raise ValueError(f"the {model} model has no gain, use 'poisson', 'spe' or 'spe_background'")
+
+    voltages = sorted(charges_by_hv, reverse=True)
+    fits = []
+    for i, voltage in enumerate(voltages):
+        charges = np.asarray(charges_by_hv[voltage], dtype=np.float64)
+        if i == 0:
+            fit = fit_spe(charges, model, bins)
+        else:
+            #slope of the gain curve from the points already fitted
+            exponent = DEFAULT_EXPONENT
+            if i >= 2 and fits[-1]['params']['gain'] > 0 and fits[-2]['params']['gain'] > 0:
+                exponent = (np.log(fits[-2]['params']['gain'] / fits[-1]['params']['gain'])
+                            / np.log(voltages[i - 2] / voltages[i - 1]))
+            ratio = (voltage / voltages[i - 1]) ** exponent
+            fit = fit_spe(charges, model, bins, p0=_warm_start(fits[-1], charges, ratio))
+            if not fit['converged']:
+                cold = fit_spe(charges, model, bins, p0=initial_values(charges, model))
+                if cold['converged'] or cold['nll'] < fit['nll']:
+                    fit = cold
+        fits.append(fit)
+
+    fits = fits[::-1]
+    for voltage, fit in zip(voltages[::-1], fits):
+        reason = unresolved(fit)
+        if reason is not None:
+            print(f'{voltage} V: photoelectron peak not resolved from the pedestal ({reason}), left out of the gain curve')
+
+    return {
+        'HV': np.array(voltages[::-1], dtype=np.float64),
+        'gain': np.array([fit['params']['gain'] for fit in fits]),
+        'gain_err': np.array([fit['errors']['gain'] for fit in fits]),
+        'mu': np.array([fit['params']['mu'] for fit in fits]),
+        'mu_err': np.array([fit['errors']['mu'] for fit in fits]),
+        'converged': np.array([fit['converged'] for fit in fits]),
+        'resolved': np.array([unresolved(fit) is None for fit in fits]),
+        'num_charges': np.array([fit['num_charges'] for fit in fits]),
+        'fits': fits,
+    }
+
+
+def power_law(voltage, gain_ref, exponent, voltage_ref):
+    '''
+    output:
+        gain at the voltage, gain_ref * (voltage / voltage_ref) ** exponent
+    '''
+    return gain_ref * (np.asarray(voltage, dtype=np.float64) / voltage_ref) ** exponent
+
+
+def fit_power_law(voltages, gains, errors, voltage_ref=None):
+    '''
+    Weighted least squares fit of log(gain) against log(HV)
+
+    input:
+        voltages: 1D array of the HV points in V
+        gains: 1D array of the gains (any units), points that are not finite or not positive are left out
+        errors: 1D array of their 1 sigma uncertainties
+        voltage_ref: float of the reference HV in V, by default the geometric mean of the points, where gain_ref
+                     and the exponent are not correlated
+    output:
+        dictionary with 'gain_ref', 'exponent', 'voltage_ref', their uncertainties 'gain_ref_err' and
+        'exponent_err', the 'covariance' of (log(gain_ref), exponent), 'chi2' and 'ndf'.
+        If chi2 / ndf is above 1 the uncertainties are scaled up by sqrt(chi2 / ndf), the gains then scatter
+        more than their statistical errors (the model of the spectrum is not perfect)
+    '''
+    voltages, gains, errors = (np.asarray(values, dtype=np.float64) for values in (voltages, gains, errors))
+    good = np.isfinite(gains) & np.isfinite(errors) & (gains > 0) & (errors > 0)
+    if good.sum() < 2:
+        raise ValueError(f'{good.sum()} usable gain points, at least 2 are needed for a power law')
+    voltages, gains, errors = voltages[good], gains[good], errors[good]
+
+    if voltage_ref is None:
+        voltage_ref = float(np.exp(np.mean(np.log(voltages))))
+    x = np.log(voltages / voltage_ref)
+    y = np.log(gains)
+    weights = (gains / errors)**2  #1 / error of log(gain) squared
+
+    design = np.column_stack([np.ones_like(x), x])
+    normal = design.T @ (design * weights[:, np.newaxis])
+    covariance = np.linalg.inv(normal)
+    log_gain_ref, exponent = covariance @ (design.T @ (weights * y))
+
+    chi2 = float(np.sum(weights * (y - log_gain_ref - exponent * x)**2))
+    ndf = len(x) - 2
+    if ndf > 0 and chi2 > ndf:
+        covariance = covariance * chi2 / ndf
+
+    gain_ref = float(np.exp(log_gain_ref))
+    return {
+        'gain_ref': gain_ref,
+        'gain_ref_err': gain_ref * float(np.sqrt(covariance[0, 0])),
+        'exponent': float(exponent),
+        'exponent_err': float(np.sqrt(covariance[1, 1])),
+        'voltage_ref': voltage_ref,
+        'covariance': covariance,
+        'chi2': chi2,
+        'ndf': ndf,
+    }
+
+
+def voltage_for_gain(curve, gain):
+    '''
+    HV at which the power law of fit_power_law reaches a gain (in the units of the fitted gains)
+
+    output:
+        float of the HV in V
+        float of its 1 sigma uncertainty
+    '''
+    log_ratio = np.log(gain / curve['gain_ref'])
+    voltage = curve['voltage_ref'] * np.exp(log_ratio / curve['exponent'])
+    #derivatives with respect to log(gain_ref) and the exponent
+    gradient = voltage * np.array([-1 / curve['exponent'], -log_ratio / curve['exponent']**2])
+    return float(voltage), float(np.sqrt(gradient @ curve['covariance'] @ gradient))
+
+
+def _fit_sweep(item):
+    '''
+    Fit one sweep in a worker process
+
+    output:
+        dictionary of the points (without the fit_spe results) and the 'curve' of the power law, None if it failed
+        str of the error, None if it worked
+    '''
+    sweep, model = item
+    try:
+        charges_by_hv = {}
+        for voltage, file in sweep['files'].items():
+            table, aggregates = load_features(file, sweep['t0'], sweep['t1'])
+            charges_by_hv[voltage] = table['charge'].to_numpy()
+
+        points = fit_hv_sweep(charges_by_hv, model)
+        del points['fits']
+        resolved = points['resolved']
+        points['curve'] = fit_power_law(points['HV'][resolved], points['gain'][resolved], points['gain_err'][resolved])
+        return points, None
+    except Exception as error:
+        return None, f'{type(error).__name__}: {error}'
+
+
+def fit_gain_curves(sweeps, num_workers=None, model='spe'):
+    '''
+    Fit the gain curves of many sweeps in parallel
+
+    input:
+        sweeps: list of dictionaries with 'files' (HV: file), 't0' and 't1', plus anything to find them again with
+        num_workers: int of worker processes, None for one per core, 1 to fit everything in this process
+        model: 'poisson', 'spe' or 'spe_background'
+    output:
+        results: list with the points and curve of every sweep (see _fit_sweep), None for the ones that failed
+        errors: dictionary of sweep index: str of the error
+    '''
+    t_0 = time.time()
+    items = [(sweep, model) for sweep in sweeps]
+
+    if num_workers == 1:
+        outputs = [_fit_sweep(item) for item in items]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            outputs = list(pool.map(_fit_sweep, items))
+
+    results = [result for result, error in outputs]
+    errors = {i: error for i, (result, error) in enumerate(outputs) if error is not None}
+
+    print(f'{len(sweeps) - len(errors)} of {len(sweeps)} gain curves fitted in {time.time() - t_0:.1f} s '
+          f'with {num_workers or os.cpu_count()} workers')
+    for i, error in errors.items():
+        print(f"    {sweeps[i].get('PMT')} LED {sweeps[i].get('LED')}: {error}")
+
+    return results, errors
+
+
+def plot_gain_curve(points, label=None, color=None):
+    '''
+    Plot the gains of a sweep (in electrons) and their power law on the current axes, the points left out of the
+    power law (not resolved from the pedestal) are hollow
+    '''
+    curve = points['curve']
+    resolved = points['resolved']
+    plt.errorbar(points['HV'][resolved], points['gain'][resolved] / ELEMENTARY_CHARGE,
+                 yerr=points['gain_err'][resolved] / ELEMENTARY_CHARGE, fmt='o', color=color, markersize=4, capsize=2,
+                 label=f"{label}: k = {curve['exponent']:.2f} +- {curve['exponent_err']:.2f}")
+    if not resolved.all():
+        plt.errorbar(points['HV'][~resolved], points['gain'][~resolved] / ELEMENTARY_CHARGE,
+                     yerr=points['gain_err'][~resolved] / ELEMENTARY_CHARGE, fmt='o', color=color, markersize=4,
+                     capsize=2, markerfacecolor='none')
+    voltages = np.linspace(points['HV'].min(), points['HV'].max(), 100)
+    plt.plot(voltages, power_law(voltages, curve['gain_ref'], curve['exponent'], curve['voltage_ref']) / ELEMENTARY_CHARGE,
+             '--', color=color)
+
+
+if __name__ == '__main__':
+
+    #Adjust the date, PMT_IDs, LED_IDs, window and voltage settings as needed, same files as Charge_Test.py
+    date = '25-07-16'
+    PMT_IDs = ['BA0131', 'BA0030']
+    LED_IDs = ["235", "308"]
+    t0, t1 = 0.38e-7, 2e-7
+    voltages = range(500, 1350, 100)
+    gain_target = 1e7  #electrons, the HV for it is printed for every sweep
+
+    colors = ['red', 'blue', 'green', 'orange', 'purple',
+              'cyan', 'magenta', 'brown', 'gold', 'teal']
+
+    sweeps = [{'PMT': PMT_ID, 'LED': LED_ID, 't0': t0, 't1': 3.5e-7 if LED_ID == "308" else t1,
+               'files': {set_voltage: f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
+                         for set_voltage in voltages}}
+              for PMT_ID in PMT_IDs for LED_ID in LED_IDs]
+
+    results, errors = fit_gain_curves(sweeps)
+
+    for PMT_ID in PMT_IDs:
+        plt.figure(figsize=(8, 6))
+        for c, (sweep, points) in enumerate((sweep, points) for sweep, points in zip(sweeps, results)
+                                            if sweep['PMT'] == PMT_ID and points is not None):
+            curve = points['curve']
+            voltage, voltage_err = voltage_for_gain(curve, gain_target * ELEMENTARY_CHARGE)
+            print(f"{PMT_ID} LED {sweep['LED']}: gain = {curve['gain_ref'] / ELEMENTARY_CHARGE:.3e} x "
+                  f"(HV / {curve['voltage_ref']:.0f} V)^{curve['exponent']:.3f}, "
+                  f"{gain_target:.0e} at {voltage:.0f} +- {voltage_err:.0f} V")
+            plot_gain_curve(points, f"LED_{sweep['LED']}", colors[c % len(colors)])
+
+        plt.xscale('log')
+        plt.yscale('log')
+        plt.legend()
+        plt.title(f'Gain vs. HV Supply for PMT {PMT_ID}')
+        plt.xlabel('High Voltage Supplied (V)')
+        plt.ylabel('Gain (electrons per photoelectron)')
+        plt.tight_layout()
+        #TODO
+        #Change the path to save the figure as needed
+        plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/Gain_curve_PMT_{PMT_ID}.png')
+        plt.close()
@@ -0,0 +1,119 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import time
+import os
+
+from SPE_fit import R
+from Pulse_features import load_features
+from Bootstrap import bootstrap
+
+
+"""
+This analyses the files of a PMT x LED x HV sweep in parallel, one process per file, for Charge_Test.py and
+Linearity_Test.py (every file is independent, so a day of data takes about 1/Ncores of the time on one core).
+
+A task is a dictionary with the 'file' to analyse, its 't0' and 't1' window (and optionally the 'resistance'),
+plus anything to find it again with, e.g. {'PMT': 'BA0131', 'LED': '235', 'HV': 1300, ...}.
+analyze_grid() sends the tasks to a pool of worker processes, every worker reads the feature table of its file
+(see Pulse_features.py, extracted the first time) and sends back one row of numbers, the SUMMARY of the file.
+The rows come back as a single 2D array, in the order of the tasks whatever order the workers finish in,
+so a rerun gives the same array. A file that can't be read (missing, cut short, ...) gives a row of NaN and
+its error is collected, the rest of the sweep carries on.
+"""
+
+
+#columns of the summary of a file
+SUMMARY = ('charge_mean', 'charge_std', 'peak_voltage', 'amplitude_mean', 'amplitude_std', 'num_waveforms',
+           'charge_mean_err', 'amplitude_mean_err')
+
+
+def summarize_file(file, t0, t1, resistance=R):
+    '''
+    Summary of one file, from its feature table
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t0, t1: float of the start and end of the window in s
+        resistance: float in Ohm
+    output:
+        1D np.array of the SUMMARY values: mean and std of the charge in C, minimum of the average pulse in V
+        (what Linearity_Test.py plots), mean and std of the amplitude in V, number of waveforms, and the
+        bootstrap errors of the mean charge and of the mean amplitude (see Bootstrap.py)
+    '''
+    table, aggregates = load_features(file, t0, t1, resistance)
+    mean = partial(np.mean, axis=-1)
+    return np.array([
+        aggregates['mean']['charge'],
+        aggregates['std']['charge'],
+        np.min(aggregates['average_pulse']),
+        aggregates['mean']['amplitude'],
+        aggregates['std']['amplitude'],
+        len(table),
+        bootstrap(table['charge'].to_numpy(), mean, vectorized=True)['std'][0],
+        bootstrap(table['amplitude'].to_numpy(), mean, vectorized=True)['std'][0],
+    ])
+
+
+def _run_task(item):
+    '''
+    Run the analysis of one task in a worker process
+
+    output:
+        1D np.array of the result, None if it failed
+        str of the error, None if it worked
+    '''
+    analysis, task = item
+    try:
+        return np.asarray(analysis(task['file'], task['t0'], task['t1'], task.get('resistance', R)), dtype=np.float64), None
+    except Exception as error:
+        return None, f'{type(error).__name__}: {error}'
+
+
+def analyze_grid(tasks, num_workers=None, analysis=summarize_file, num_results=len(SUMMARY)):
+    '''
+    Analyse the files of a sweep in parallel
+
+    input:
+        tasks: list of dictionaries with at least 'file', 't0' and 't1'
+        num_workers: int of worker processes, None for one per core, 1 to run everything in this process
+        analysis: function(file, t0, t1, resistance) returning a 1D array of num_results floats, it has to be
+                  defined at the top level of a module so it can be sent to the workers
+        num_results: int of values returned by analysis
+    output:
+        results: 2D np.array with one row per task, in the order of the tasks, NaN for the tasks that failed
+        errors: dictionary of task index: str of the error, for the tasks that failed
+    '''
+    t_0 = time.time()
+    items = [(analysis, task) for task in tasks]
+
+    if num_workers == 1:
+        outputs = [_run_task(item) for item in items]
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            #map hands the outputs back in the order of the tasks
+            outputs = list(pool.map(_run_task, items))
+
+    results = np.full((len(tasks), num_results), np.nan)
+    errors = {}
+    for i, (result, error) in enumerate(outputs):
+        if error is None:
+            results[i] = result
+        else:
+            errors[i] = error
+
+    print(f'{len(tasks) - len(errors)} of {len(tasks)} files analysed in {time.time() - t_0:.1f} s '
+          f'with {num_workers or os.cpu_count()} workers')
+    for i, error in errors.items():
+        print(f"    {tasks[i]['file']}: {error}")
+
+    return results, errors
+
+
+def grid_rows(tasks, **selection):
+    '''
+    output:
+        1D np.array of the indices of the tasks matching every key=value of the selection, in task order
+    '''
+    return np.array([i for i, task in enumerate(tasks)
+                     if all(task.get(key) == value for key, value in selection.items())], dtype=int)
@@ -1,6 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
+import os
+
+from Grid_analysis import analyze_grid, grid_rows, SUMMARY
 
 
 """This script plots the linearity of the PMT response by measuring the peak height of the PMT pulse.
@@ -25,56 +28,57 @@ colors = ['red', 'blue', 'green', 'orange', 'purple',
           'cyan', 'magenta', 'brown', 'gold', 'teal']
             
 
-for PMT_ID in PMT_IDs:
+#every (PMT, LED, HV) file is analysed in its own process, this many at a time
+num_workers = os.cpu_count()
+
+
+if __name__ == '__main__':
+
+    tasks = []
+    for PMT_ID in PMT_IDs:
+        for LED_ID in LED_IDs:
 
-    c=0
-    plt.figure(figsize = (8,6))
+            if LED_ID =="308":
+                #t1 = 4e-7
+                t1 = 3.5e-7
 
-    for LED_ID in LED_IDs:
+            for set_voltage in range(500,1350,100):
 
-        if LED_ID =="308":
-            #t1 = 4e-7
-            t1 = 3.5e-7
-        peak_data = []
+                #TODO
+                #Keep an eye on the file path, it may need to be adjusted
+                file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
+                tasks.append({'PMT': PMT_ID, 'LED': LED_ID, 'HV': set_voltage, 'file': file, 't0': t0, 't1': t1})
 
-        for set_voltage in range(500,1350,100):
+    #the peak of the average pulse of each file (between t0 and t1) is in its feature table, see Pulse_features.py.
+    #Files that can't be read are reported and left out of the plots
+    results, errors = analyze_grid(tasks, num_workers)
 
-            all_voltages = []
-            #TODO
-            #Keep an eye on the file path, it may need to be adjusted
-            file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
-            file_ = pd.read_csv(file, delimiter=',', header=0, skiprows=1)
-            file_ = np.array(file_)
+    for PMT_ID in PMT_IDs:
 
-            times = file_[:,0]
-            index_0  = np.searchsorted(times, t0 - tol, side='left')
-            index_f  = np.searchsorted(times, t1 + tol, side='right') - 1
+        c=0
+        plt.figure(figsize = (8,6))
 
-            for q in range(1,99):
-                voltages = file_[:,q]
-                voltages = voltages[index_0:index_f+1]
-                all_voltages.append(voltages)
+        for LED_ID in LED_IDs:
 
-            average_pulse = np.mean(all_voltages, axis=0)
-            peak_voltage = np.min(average_pulse)
-            peak_data.append((set_voltage, peak_voltage))
+            rows = grid_rows(tasks, PMT=PMT_ID, LED=LED_ID)
 
-        peak_data = np.array(peak_data)
+            HV = np.array([tasks[i]['HV'] for i in rows])
+            peaks = np.abs(results[rows, SUMMARY.index('peak_voltage')])
 
-        HV = peak_data[:,0]
-        peaks = np.abs(peak_data[:,1])
+            # Bootstrap error of the mean amplitude of the waveforms, about that of the peak of the average pulse
+            peak_errors = results[rows, SUMMARY.index('amplitude_mean_err')]
 
-        plt.plot(HV, peaks, 'o', label=f'Measured Peaks LED_{LED_ID}',color=colors[c])
-        # plt.plot(HV, peaks, '-',color=colors[c])
+            plt.errorbar(HV, peaks, yerr=peak_errors, fmt='o', label=f'Measured Peaks LED_{LED_ID}',color=colors[c])
+            # plt.plot(HV, peaks, '-',color=colors[c])
 
-        c+=1
+            c+=1
 
-    plt.legend()
-    plt.title(f'Signal Peak Height vs. HV Supply for PMT {PMT_ID}')
-    plt.xlabel('High Voltage Supplied (V)')
-    plt.ylabel('Abs. Peak Height (V)')
-    plt.tight_layout()
-    #TODO
-    #Change the path to save the figure as needed
-    plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/FIXED_linearity_PMT_{PMT_ID}.png')
-    plt.close()
+        plt.legend()
+        plt.title(f'Signal Peak Height vs. HV Supply for PMT {PMT_ID}')
+        plt.xlabel('High Voltage Supplied (V)')
+        plt.ylabel('Abs. Peak Height (V)')
+        plt.tight_layout()
+        #TODO
+        #Change the path to save the figure as needed
+        plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/FIXED_linearity_PMT_{PMT_ID}.png')
+        plt.close()
@@ -0,0 +1,354 @@
+import numpy as np
+import matplotlib.pyplot as plt
+import threading
+import time
+import os
+
+from SPE_fit import integration_window, trapezoid
+from SPE_likelihood import fit_spe, MODELS
+from Scope_session import time_axis
+
+
+"""
+This integrates the SPE waveforms while they are being taken, so the charge histogram can be watched live
+instead of only after SPE_fit.compute_area has re-read the whole CSV at the end of the run.
+
+Every raw waveform (or FastFrame batch) coming off the acquisition pipeline is converted and integrated in one
+go with numpy, over the same [t0, t1] window as compute_area: the baseline is the mean of the samples before t0,
+it is subtracted, the signal is integrated with the trapezoidal rule and divided by the 50 Ohm termination.
+PMT pulses are negative, so the charge is the negative of the integral: a photoelectron gives a positive charge
+and the pedestal (no photoelectron) stays centered on 0.
+
+The charges can be streamed to {name}_charges.csv (one line per trigger, in trigger order). With the
+'charges' output format of TakingSPEData.py that is all that is saved, one float per trigger instead of the
+full trace, and the file is read back with load_charges() to go straight to SPE_fit.plot_and_compute_spe.
+
+PrecisionStop uses the charges to end an SPE run as soon as it has enough waveforms: every check_every waveforms
+it refits the charges with the maximum likelihood fit of SPE_likelihood.fit_spe, and the run stops once the
+gain and the width of the single photoelectron peak are known to the target relative uncertainty, or when the
+waveform or wall-clock budget is used up. Only a fit that converged to physical values counts: one stopped at a
+bound (a width or mu of 0), with a non-positive mu, gain or width, or with non-finite uncertainties is ignored,
+so a run is never stopped on a wrong fit, it just carries on until the next check.
+"""
+
+
+def charges_path(name):
+    '''
+    output:
+        str of the charges file of the run {name}, next to its data
+    '''
+    return f'{name}_charges.csv'
+
+
+def load_charges(file):
+    '''
+    Read the charges saved by OnlineCharge
+
+    input:
+        file: str of the path of a {name}_charges.csv file
+    output:
+        1D np.array of the charges in C, in trigger order
+    '''
+    data = np.loadtxt(file, delimiter=',', skiprows=1, ndmin=2)
+    return data[:, 1]
+
+
+class OnlineCharge:
+    '''
+    Integrate raw scope waveforms as they come in and keep their charges for a live histogram
+
+    input:
+        t0, t1: float of the start and end of the integration window in s, the samples before t0 are the baseline
+        path: str of the CSV file to stream the charges to, None to only keep them in memory
+        resume: if True and path exists, keep the charges already in it and append after them
+        resistance: float of the termination the PMT signal is read across, in Ohm
+        bins: int of bins of the live histogram
+    '''
+
+    def __init__(self, t0, t1, path=None, resume=True, resistance=50, bins=20):
+        self.t0 = t0
+        self.t1 = t1
+        self.path = path
+        self.resistance = resistance
+        self.bins = bins
+
+        self.lock = threading.Lock()
+        self.pending = {}       #charges that came in out of order, keyed by their position in the run
+        self.charges = []       #committed charges, in trigger order
+        self.windows = {}       #(times, index_0, index_f) of the integration window, keyed by the time axis settings
+        self.file = None
+        self.figure = None
+
+        if path is not None:
+            if resume and os.path.exists(path):
+                self.charges = list(load_charges(path))
+                self.file = open(path, 'a')
+            else:
+                self.file = open(path, 'w')
+                self.file.write('waveform,charge (C)\n')
+                self.file.flush()
+
+    @property
+    def num_committed(self):
+        '''
+        int of how many charges are committed (and on disk, if saving), a resumed run starts taking data from here
+        '''
+        return len(self.charges)
+
+    def truncate(self, num_charges):
+        '''
+        Keep only the first num_charges charges, on resume: the charges are saved as soon as they are integrated,
+        before the waveforms are written, so after a crash the charges file can be ahead of the data file
+
+        input:
+            num_charges: int of waveforms committed by the writer of the data, where the resumed run starts
+        '''
+        with self.lock:
+            if num_charges > self.num_committed:
+                raise ValueError(f'{self.num_committed} charges saved for {num_charges} waveforms, the charges of '
+                                 f'a resumed run have to be saved from its start')
+            if num_charges == self.num_committed:
+                return
+
+            print(f'Dropping the charges of waveforms {num_charges} to {self.num_committed - 1}, '
+                  f'they are not in the data')
+            del self.charges[num_charges:]
+            self.pending = {}
+            if self.file is not None:
+                self.file.close()
+                tmp = f'{self.path}.tmp'
+                with open(tmp, 'w') as f:
+                    f.write('waveform,charge (C)\n')
+                    f.write(''.join(f'{i},{float(charge)!r}\n' for i, charge in enumerate(self.charges)))
+                os.replace(tmp, self.path)
+                self.file = open(self.path, 'a')
+
+    def window(self, scal_info, num_points):
+        '''
+        output:
+            times: 1D np.array of the sample times in the integration window in s
+            index_0, index_f: int of the first and last sample in the integration window
+        '''
+        key = (scal_info['xincr'], scal_info['HPos'], scal_info['HDelay'], scal_info.get('first_sample'),
+               scal_info.get('record_length'), num_points)
+        if key not in self.windows:
+            #same time axis as convertToWave, and same window as SPE_fit.compute_area
+            times = time_axis(scal_info, num_points)
+            index_0, index_f = integration_window(times, self.t0, self.t1)
+            if index_f <= index_0:
+                raise ValueError(f'the integration window {self.t0}..{self.t1} s is not inside the record '
+                                 f'({times[0]:.3g}..{times[-1]:.3g} s)')
+            self.windows[key] = (times[index_0:index_f + 1], index_0, index_f)
+
+        return self.windows[key]
+
+    def integrate(self, frames, scal_info):
+        '''
+        Baseline-subtracted charge of raw waveforms
+
+        input:
+            frames: 2D array of raw 8-bit samples, one row per waveform
+            scal_info: dictionary with scope scaling details of these waveforms
+        output:
+            1D np.array of the charges in C, one per waveform
+        '''
+        frames = np.atleast_2d(frames)
+        times, index_0, index_f = self.window(scal_info, frames.shape[1])
+
+        #only the samples that are used are converted to volts, yzero cancels with the baseline
+        ymult, yoff = float(scal_info['ymult']), float(scal_info['yoff'])
+        signal = (frames[:, index_0:index_f + 1] - yoff) * ymult
+        if index_0 > 0:
+            signal -= ((frames[:, :index_0] - yoff) * ymult).mean(axis=1)[:, np.newaxis]
+
+        return -trapezoid(signal, times, axis=1) / self.resistance
+
+    def add(self, index, frames, scal_info):
+        '''
+        Integrate raw waveforms and add their charges to the run. They can come in any order
+        (e.g. from several pipeline workers), charges are committed as soon as they are next in line.
+
+        input:
+            index: int of the position in the run of the first waveform
+            frames: 2D array of raw 8-bit samples, one row per waveform
+            scal_info: dictionary with scope scaling details of these waveforms
+        '''
+        charges = self.integrate(frames, scal_info)
+
+        with self.lock:
+            for i, charge in enumerate(charges):
+                self.pending[index + i] = float(charge)
+
+            lines = []
+            while self.num_committed in self.pending:
+                lines.append(f'{self.num_committed},{self.pending[self.num_committed]!r}\n')
+                self.charges.append(self.pending.pop(self.num_committed))
+
+            if self.file is not None and lines:
+                self.file.write(''.join(lines))
+                self.file.flush()
+
+    def values(self):
+        '''
+        output:
+            1D np.array of the committed charges in C, in trigger order
+        '''
+        with self.lock:
+            return np.array(self.charges)
+
+    def plot(self):
+        '''
+        Draw (or redraw) the live charge histogram. Has to be called from the main thread, e.g. from the
+        acquisition loop every few seconds.
+        '''
+        charges = self.values()
+        if len(charges) == 0:
+            return
+
+        if self.figure is None:
+            plt.ion()
+            self.figure, self.ax = plt.subplots(figsize=(8, 6))
+
+        self.ax.clear()
+        self.ax.hist(charges, bins=self.bins, alpha=0.6, label=f'{len(charges)} waveforms')
+        self.ax.set_xlabel('Integrated Charge [C]')
+        self.ax.set_ylabel('Counts')
+        self.ax.set_title(f'mean {np.mean(charges):.2e} C, std {np.std(charges):.2e} C')
+        self.ax.legend()
+        self.figure.canvas.draw_idle()
+        plt.pause(0.001)
+
+    def close(self):
+        '''
+        output:
+            int of how many charges were committed
+        '''
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return self.num_committed
+
+
+#parameters of every SPE_likelihood model whose relative uncertainty has to reach the target: the gain and the
+#width of the single photoelectron peak (a single Gaussian over the pedestal and the photoelectrons measures
+#neither, so it can't stop a run)
+PRECISION_PARAMETERS = {'poisson': ('gain', 'sigma'), 'spe': ('gain', 'sigma1'), 'spe_background': ('gain', 'sigma1'),
+                        'double_gaussian': ('gain', 'sigma1')}
+
+
+def physical_fit(fit):
+    '''
+    output:
+        str of why a fit_spe result can't be trusted, None if it can
+    '''
+    if not fit['converged']:
+        return 'did not converge'
+    kinds = dict(MODELS[fit['model']])
+    #a fraction (the background of spe_background) can be 0, nothing else can
+    at_bound = [name for name in fit['at_bound'] if kinds[name] != 'fraction']
+    if at_bound:
+        return f"{', '.join(at_bound)} at the bound of the fit"
+    for name, value in fit['params'].items():
+        if not np.isfinite(value) or not np.isfinite(fit['errors'][name]):
+            return f'{name} is not finite'
+        if (kinds.get(name) in ('width', 'number') or name == 'gain') and value <= 0:
+            return f'{name} = {value:.3g}'
+    return None
+
+
+class PrecisionStop:
+    '''
+    Stopping policy for an SPE run: stop when the fit of the charges is precise enough, or a budget is hit
+
+    input:
+        online: OnlineCharge integrating the run, None to only check the budgets
+        target: float of the relative uncertainty the gain and SPE width have to reach, e.g. 0.01 for 1%
+        model: 'spe', 'spe_background', 'poisson' or 'double_gaussian', the SPE_likelihood model to fit
+        min_waveforms: int of waveforms to take before the first fit
+        check_every: int of waveforms between fits
+        max_waveforms: int of the waveform budget, None for no limit
+        max_time: float of the wall-clock budget in s from the creation of the policy, None for no limit
+        bins: int of bins of the likelihood histogram
+    '''
+
+    def __init__(self, online, target=0.01, model='spe', min_waveforms=1000, check_every=500,
+                 max_waveforms=None, max_time=None, bins=1000):
+        if model not in PRECISION_PARAMETERS:
+            raise ValueError(f"no precision stop for the {model} model, use one of {', '.join(PRECISION_PARAMETERS)}")
+        self.online = online
+        self.target = target
+        self.model = model
+        self.min_waveforms = min_waveforms
+        self.check_every = check_every
+        self.max_waveforms = max_waveforms
+        self.max_time = max_time
+        self.bins = bins
+
+        self.t_0 = time.time()
+        self.next_check = min_waveforms
+        self.precision = None   #dictionary of the relative uncertainties of the last good fit
+        self.fit = None         #fit_spe result of the last good fit
+
+    def refit(self):
+        '''
+        Fit the charges committed so far, starting from the last good fit
+
+        output:
+            dictionary of the relative uncertainty of every parameter in PRECISION_PARAMETERS, None if the fit
+            can't be trusted
+        '''
+        charges = self.online.values()
+        p0 = None
+        if self.fit is not None:
+            p0 = [self.fit['params'][name] for name in self.fit['names']]
+            p0[0] *= len(charges) / self.fit['num_charges']
+        try:
+            fit = fit_spe(charges, self.model, self.bins, p0=p0)
+        except (RuntimeError, ValueError, np.linalg.LinAlgError):
+            return None
+
+        problem = physical_fit(fit)
+        if problem is not None and p0 is not None:
+            #the last fit may have been a lucky one, start again from the charges
+            try:
+                fit = fit_spe(charges, self.model, self.bins)
+            except (RuntimeError, ValueError, np.linalg.LinAlgError):
+                return None
+            problem = physical_fit(fit)
+        if problem is not None:
+            print(f'{self.model} fit after {len(charges)} waveforms ignored: {problem}')
+            return None
+
+        self.fit = fit
+        self.precision = {parameter: abs(fit['errors'][parameter] / fit['params'][parameter])
+                          for parameter in PRECISION_PARAMETERS[self.model]}
+        return self.precision
+
+    def check(self, num_waveforms):
+        '''
+        Cheap enough to call after every waveform, the fit is only redone every check_every waveforms
+
+        input:
+            num_waveforms: int of waveforms taken so far
+        output:
+            str of why the run should stop, or None to carry on
+        '''
+        if self.max_waveforms is not None and num_waveforms >= self.max_waveforms:
+            return f'waveform budget of {self.max_waveforms} reached'
+        if self.max_time is not None and time.time() - self.t_0 > self.max_time:
+            return f'time budget of {self.max_time} s reached'
+
+        if self.online is None or self.online.num_committed < self.next_check:
+            return None
+        self.next_check = self.online.num_committed + self.check_every
+
+        precision = self.refit()
+        if precision is None:
+            return None
+        print('Fit precision after {} waveforms: {}'.format(self.online.num_committed,
+              ', '.join(f'{parameter} {100 * value:.2f}%' for parameter, value in precision.items())))
+        if max(precision.values()) <= self.target:
+            return f'{self.model} fit precision of {100 * self.target:g}% reached after {self.online.num_committed} waveforms'
+
+        return None
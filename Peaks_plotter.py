@@ -2,6 +2,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 
+from Pulse_features import load_features
+from Waveform_persistence import persistence_map, plot_persistence
+
 """
 This script plots the average pulse from multiple waveform files for a given PMT and voltage setting.
 """
@@ -26,11 +29,15 @@ colors = ['red', 'blue', 'green', 'orange', 'purple',
 
 R=50 # Resistance in Ohms
 
+#if True also save the persistence map of every file (all its waveforms, with the average pulse and +-1 sigma,
+#see Waveform_persistence.py), it needs a read of the whole file
+persistence = False
+
             
 
 for PMT_ID in PMT_IDs:
 
-    plt.figure(figsize = (8,6))
+    figure = plt.figure(figsize = (8,6))
 #TODO
 #Do not forget to change the voltage range and step as needed
     for set_voltage in range(1300,1350,100):
@@ -40,26 +47,22 @@ for PMT_ID in PMT_IDs:
             if LED_ID =="308":
                 #t1 = 4e-7
                 t1 = 3.5e-7
-            all_voltages = []
             #TODO
             file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPE_CHECK_200ns_7_VSPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
-            file_ = pd.read_csv(file, delimiter=',', header=0, skiprows=1)
-            file_ = np.array(file_)
-
-            times = file_[:,0]
-            index_0  = np.searchsorted(times, t0 - tol, side='left')
-            index_f  = np.searchsorted(times, t1 + tol, side='right') - 1
-            times = times[index_0:index_f+1]
 
-            for q in range(1,99):
-                voltages = file_[:,q]
-                voltages = voltages[index_0:index_f+1]
-                all_voltages.append(voltages)
-
-            average_pulse = np.mean(all_voltages, axis=0)
+            #average of all the waveforms of the file between t0 and t1, from the feature table of the file
+            table, aggregates = load_features(file, t0, t1)
+            times, average_pulse = aggregates['times'], aggregates['average_pulse']
             plt.plot(times, average_pulse, 'o', label=f'LED_{LED_ID} ON',color=colors[c], markersize=3)
             # plt.plot(HV, areas, '-',color=colors[c])
 
+            if persistence:
+                plot_persistence(persistence_map(file, t0, t1), f'PMT {PMT_ID} at {set_voltage} V, LED {LED_ID}')
+                #TODO
+                plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/Persistence_PMT_{PMT_ID}_{set_voltage}_{LED_ID}.png')
+                plt.close()
+                plt.figure(figure.number)
+
             c+=1
 
         plt.legend()
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+import os
+
+from SPE_fit import R, integration_window, trapezoid
+from Waveform_io import iter_waveform_blocks
+from Raw_run_format import EXTENSION
+
+
+"""
+This reads a run once and computes the features of every waveform in it, so the plotting scripts
+(Charge_Test.py, Linearity_Test.py, Peaks_plotter.py) read a small feature table instead of the waveforms.
+
+For every waveform, over the same t0..t1 window as SPE_fit.integrate_charges:
+
+    baseline        mean of the samples before t0, in V
+    baseline_rms    standard deviation of the samples before t0, in V
+    charge          baseline-subtracted integral divided by R, in C, same as SPE_fit.integrate_charges
+    amplitude       height of the pulse below the baseline, in V (PMT pulses are negative, the amplitude is positive)
+    peak_time       time of the pulse minimum, in s
+    rise_time       10% to 90% of the amplitude on the leading edge, in s
+    fall_time       90% to 10% of the amplitude on the trailing edge, in s
+    fwhm            full width at half maximum, in s
+
+The edge times are linearly interpolated between samples, and are NaN when the pulse does not cross the level
+inside the window. For the whole run it also keeps the average pulse between t0 and t1 (what Peaks_plotter.py
+and Linearity_Test.py plot, the same as Waveform_io.average_waveform) and the mean and standard deviation of
+every feature.
+
+The table is saved next to the run, as {run}_features_{t0}-{t1}ns.npz with one array per feature column, and
+load_features() reads it back instead of the run as long as the run has not changed since.
+"""
+
+
+FEATURES = ('baseline', 'baseline_rms', 'charge', 'amplitude', 'peak_time', 'rise_time', 'fall_time', 'fwhm')
+
+
+def features_path(file, t0, t1):
+    '''
+    output:
+        str of the feature table file of a run for the window t0..t1
+    '''
+    base = str(file)
+    for extension in ('.csv', EXTENSION):
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+    return f'{base}_features_{1e9 * t0:g}-{1e9 * t1:g}ns.npz'
+
+
+def _crossing(times, pulse, level, peak, edge):
+    '''
+    Interpolated time at which each pulse crosses its level, on the leading or the trailing edge of its peak
+
+    input:
+        times: 1D np.array of the sample times
+        pulse: 2D np.array of positive pulses, one per column
+        level: 1D np.array of the level of every pulse
+        peak: 1D np.array of the row of the peak of every pulse
+        edge: 'leading' or 'trailing'
+    output:
+        1D np.array of the crossing times, NaN where the pulse does not cross the level on that edge
+    '''
+    rows = np.arange(len(pulse))[:, np.newaxis]
+    columns = np.arange(pulse.shape[1])
+
+    if edge == 'leading':
+        #last sample under the level before the peak
+        below = (pulse < level) & (rows <= peak)
+        index_a = len(pulse) - 1 - np.argmax(below[::-1], axis=0)
+        index_b = index_a + 1
+    else:
+        #first sample under the level after the peak
+        below = (pulse < level) & (rows >= peak)
+        index_b = np.argmax(below, axis=0)
+        index_a = index_b - 1
+    found = below.any(axis=0) & (index_a >= 0) & (index_b < len(pulse))
+    index_a = np.clip(index_a, 0, len(pulse) - 1)
+    index_b = np.clip(index_b, 0, len(pulse) - 1)
+
+    pulse_a, pulse_b = pulse[index_a, columns], pulse[index_b, columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = times[index_a] + (level - pulse_a) * (times[index_b] - times[index_a]) / (pulse_b - pulse_a)
+    return np.where(found, crossing, np.nan)
+
+
+def waveform_features(times, voltages, t0, t1, dtype=np.float64, resistance=R):
+    '''
+    Features of many waveforms at once
+
+    input:
+        times: 1D np.array of the sample times in s
+        voltages: 2D np.array of the voltages in V, one waveform per column (the samples before t0 are the baseline)
+        t0, t1: float of the start and end of the window in s
+        dtype: float type of the computation
+        resistance: float in Ohm
+    output:
+        dictionary of feature: 1D np.array with one value per waveform, see FEATURES
+    '''
+    index_0, index_f = integration_window(times, t0, t1)
+    window = np.asarray(times[index_0:index_f+1], dtype=dtype)
+    num_waveforms = voltages.shape[1]
+
+    if index_0 > 0:
+        before = np.asarray(voltages[:index_0], dtype=dtype)
+        baseline = before.mean(axis=0)
+        baseline_rms = before.std(axis=0)
+    else:
+        baseline = np.zeros(num_waveforms, dtype=dtype)
+        baseline_rms = np.full(num_waveforms, np.nan, dtype=dtype)
+
+    #baseline-subtracted and flipped, so the pulses are positive
+    pulse = baseline - np.asarray(voltages[index_0:index_f+1], dtype=dtype)
+
+    peak = np.argmax(pulse, axis=0)
+    amplitude = pulse[peak, np.arange(num_waveforms)]
+
+    def edge(fraction, side):
+        return _crossing(window, pulse, fraction * amplitude, peak, side)
+
+    return {
+        'baseline': baseline,
+        'baseline_rms': baseline_rms,
+        'charge': trapezoid(pulse, window, axis=0) / dtype(resistance),
+        'amplitude': amplitude,
+        'peak_time': window[peak],
+        'rise_time': edge(0.9, 'leading') - edge(0.1, 'leading'),
+        'fall_time': edge(0.1, 'trailing') - edge(0.9, 'trailing'),
+        'fwhm': edge(0.5, 'trailing') - edge(0.5, 'leading'),
+    }
+
+
+def extract_features(file, t0, t1, dtype=np.float64, block_size=1000, resistance=R):
+    '''
+    Read a run once, block by block, and compute the features of all its waveforms
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t0, t1: float of the start and end of the window in s
+        dtype: float type of the computation
+        block_size: int of waveforms read at a time
+        resistance: float in Ohm
+    output:
+        table: pd.DataFrame with a Waveform column (its column number in the file) and a column per feature
+        aggregates: dictionary with the times and average_pulse between t0 and t1, and the mean and std of
+                    every feature (dictionaries of feature: float)
+    '''
+    columns = {feature: [] for feature in FEATURES}
+    total = None
+    count = 0
+
+    for times, block in iter_waveform_blocks(file, t0, t1, block_size=block_size, dtype=dtype):
+        for feature, values in waveform_features(times, block, t0, t1, dtype, resistance).items():
+            columns[feature].append(values)
+
+        index_0, index_f = integration_window(times, t0, t1)
+        block_sum = block[index_0:index_f+1].sum(axis=1)
+        total = block_sum if total is None else total + block_sum
+        count += block.shape[1]
+
+    if count == 0:
+        raise ValueError(f'{file} has no waveforms to compute the features of between {t0} and {t1} s')
+
+    table = pd.DataFrame({feature: np.concatenate(values) for feature, values in columns.items()})
+    table.insert(0, 'Waveform', np.arange(1, len(table) + 1))
+
+    aggregates = {
+        'times': times[index_0:index_f+1],
+        'average_pulse': total / count,
+        'mean': {feature: float(np.nanmean(table[feature])) for feature in FEATURES},
+        'std': {feature: float(np.nanstd(table[feature])) for feature in FEATURES},
+    }
+    return table, aggregates
+
+
+def save_features(path, table, aggregates, source=None, t0=None, t1=None, resistance=R):
+    '''
+    Save a feature table and its aggregates, one array per column
+
+    input:
+        path: str of the .npz file
+        table, aggregates: the output of extract_features
+        source: str of the run the features are from, its size and mtime are kept to know when they are stale
+        t0, t1, resistance: float of the settings the features were computed with
+    '''
+    stat = os.stat(source) if source is not None else None
+    arrays = {f'column_{column}': table[column].to_numpy() for column in table.columns}
+    arrays.update({
+        'times': aggregates['times'],
+        'average_pulse': aggregates['average_pulse'],
+        'mean': np.array([aggregates['mean'][feature] for feature in FEATURES]),
+        'std': np.array([aggregates['std'][feature] for feature in FEATURES]),
+        'settings': np.array([np.nan if value is None else value for value in (t0, t1, resistance)], dtype=np.float64),
+        'source': np.array([-1, -1] if stat is None else [stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+    })
+
+    tmp = f'{path}.tmp.npz'
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)  #never leave a half written table
+
+
+def read_features(path):
+    '''
+    output:
+        table, aggregates: as extract_features, from a file written by save_features
+        settings: 1D np.array of the t0, t1 and resistance
+        source: 1D np.array of the size and mtime in ns of the run
+    '''
+    with np.load(path) as data:
+        table = pd.DataFrame({key[len('column_'):]: data[key] for key in data.files if key.startswith('column_')})
+        aggregates = {
+            'times': data['times'],
+            'average_pulse': data['average_pulse'],
+            'mean': dict(zip(FEATURES, data['mean'].tolist())),
+            'std': dict(zip(FEATURES, data['std'].tolist())),
+        }
+        return table, aggregates, data['settings'], data['source']
+
+
+def load_features(file, t0, t1, resistance=R, recompute=False, block_size=1000):
+    '''
+    Feature table of a run: read from its features file if it is up to date, otherwise extracted and saved
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t0, t1: float of the start and end of the window in s
+        resistance: float in Ohm
+        recompute: if True always extract the features from the run again
+        block_size: int of waveforms read at a time when extracting
+    output:
+        table, aggregates: see extract_features
+    '''
+    path = features_path(file, t0, t1)
+    stat = os.stat(file)
+
+    if not recompute and os.path.exists(path):
+        table, aggregates, settings, source = read_features(path)
+        if (np.allclose(settings, [t0, t1, resistance], rtol=1e-12, atol=0)
+                and list(source) == [stat.st_size, stat.st_mtime_ns]):
+            return table, aggregates
+
+    table, aggregates = extract_features(file, t0, t1, block_size=block_size, resistance=resistance)
+    save_features(path, table, aggregates, file, t0, t1, resistance)
+    return table, aggregates
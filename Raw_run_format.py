@@ -0,0 +1,303 @@
+import numpy as np
+import pandas as pd
+import threading
+import json
+import os
+
+from Scope_session import time_axis
+
+"""
+This is a compact binary format for a run of waveforms (file extension .pmtraw).
+
+The scope sends 8-bit samples (DAT:ENC RPB, DAT:WID 1), but the CSV files store them as float64 text,
+which is about 20x the bytes the scope actually sent, and parsing them with pandas takes most of the time
+of every analysis script. A .pmtraw file stores the raw CURV? samples as they came in:
+
+    8 bytes   magic b'PMTRAW01'
+    4 bytes   little-endian uint32, length of the JSON header in bytes (padded so the data starts on 64 bytes)
+    header    JSON with the number of points per waveform, the scaling information of the scope
+              (xincr, ymult, yoff, yzero, HPos, HDelay, and first_sample and record_length for a region of
+              interest readout) and any run metadata (PMT, voltage, LED, ...)
+    data      uint8 array, one row of num_points samples per waveform
+
+The number of waveforms is not stored, it follows from the file size, so waveforms can be appended as they
+come in and a run that stopped part-way is still a valid file (an incomplete last row is ignored).
+
+RawRun memory-maps the file and only converts to volts what is asked for. Its to_columns() gives the same
+array as np.array(pd.read_csv(file)) of a TakingSPEData CSV (time in the first column, one waveform per column),
+so it can be used in place of the CSV by the analysis scripts, see Waveform_io.load_waveforms.
+"""
+
+
+MAGIC = b'PMTRAW01'
+EXTENSION = '.pmtraw'
+
+#the scope settings needed to convert the raw samples, same names as the scal_info dictionary of Scope_session
+SCALING_KEYS = ('xincr', 'ymult', 'yoff', 'yzero', 'HPos', 'HDelay')
+#only there for a region of interest readout, see Scope_session.time_axis
+ROI_KEYS = ('first_sample', 'record_length')
+
+
+def _scaling(scal_info):
+    return {key: float(scal_info[key]) for key in SCALING_KEYS + ROI_KEYS if key in scal_info}
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a {EXTENSION} file')
+        header_length = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(header_length).decode())
+
+    header['data_offset'] = len(MAGIC) + 4 + header_length
+    return header
+
+
+def _write_header(f, num_points, scal_info, metadata):
+    header = {
+        'version': 1,
+        'num_points': int(num_points),
+        'scaling': _scaling(scal_info),
+        'metadata': metadata,
+    }
+    header = json.dumps(header).encode()
+    #pad with spaces so the data starts on a 64 byte boundary
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 64)
+
+    f.write(MAGIC)
+    f.write(len(header).to_bytes(4, 'little'))
+    f.write(header)
+
+
+class RawRun:
+    '''
+    Memory-mapped reader of a .pmtraw file
+
+    input:
+        path: str of the path of the .pmtraw file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        header = _read_header(path)
+
+        self.num_points = header['num_points']
+        self.scaling = header['scaling']
+        self.metadata = header['metadata']
+
+        num_waveforms = (os.path.getsize(path) - header['data_offset']) // self.num_points
+        if num_waveforms > 0:
+            self.raw = np.memmap(path, dtype=np.uint8, mode='r', offset=header['data_offset'],
+                                 shape=(num_waveforms, self.num_points))
+        else:
+            self.raw = np.zeros((0, self.num_points), dtype=np.uint8)
+
+    def __len__(self):
+        return self.raw.shape[0]
+
+    @property
+    def times(self):
+        '''
+        1D np.array of the time of every sample in s, same as the time row of convertToWave
+        '''
+        return time_axis(self.scaling, self.num_points)
+
+    def voltages(self, start=None, stop=None, dtype=np.float64, samples=slice(None)):
+        '''
+        Convert waveforms start..stop to volts, only these rows are read from the file
+
+        input:
+            start, stop: int of the first and one past the last waveform to convert (default all of them)
+            dtype: float type of the returned array
+            samples: slice of the samples of every waveform to convert (default all of them)
+        output:
+            2D np.array of the voltages in V, one row per waveform
+        '''
+        raw = self.raw[start:stop, samples]
+        ymult = dtype(self.scaling['ymult'])
+        return ((raw.astype(dtype) - dtype(self.scaling['yoff'])) * ymult) + dtype(self.scaling['yzero'])
+
+    def to_columns(self, dtype=np.float64):
+        '''
+        output:
+            2D np.array with the time in the first column and each waveform in its own column,
+            same layout as the TakingSPEData CSV files
+        '''
+        return np.column_stack([self.times.astype(dtype), self.voltages(dtype=dtype).T])
+
+
+class RawRunWriter:
+    '''
+    Append raw waveforms to a .pmtraw file as they come in
+
+    input:
+        path: str of the path of the .pmtraw file
+        metadata: dictionary of run information to keep in the header (PMT, voltage, LED, ...)
+        resume: if True and the file exists, keep the waveforms already in it and append after them
+    '''
+
+    def __init__(self, path, metadata=None, resume=True):
+        self.path = path
+        self.metadata = metadata or {}
+        self.lock = threading.Lock()
+        self.pending = {}       #rows that came in out of order, keyed by their position in the run
+        self.scaling = None
+        self.num_points = None
+        self.num_committed = 0
+        self.file = None
+
+        if resume and os.path.exists(path):
+            header = _read_header(path)
+            self.scaling = header['scaling']
+            self.num_points = header['num_points']
+            self.num_committed = (os.path.getsize(path) - header['data_offset']) // self.num_points
+
+            self.file = open(path, 'r+b')
+            #drop an incomplete last row left by a crash
+            self.file.truncate(header['data_offset'] + self.num_committed * self.num_points)
+            self.file.seek(0, os.SEEK_END)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def add(self, index, frames, scal_info):
+        '''
+        Add raw waveforms to the run. They can come in any order (e.g. from several pipeline workers),
+        rows are appended to the file as soon as they are next in line.
+
+        input:
+            index: int of the position in the run of the first waveform
+            frames: 2D array of raw 8-bit samples, one row per waveform
+            scal_info: dictionary with scope scaling details of these waveforms
+        '''
+        frames = np.asarray(frames, dtype=np.uint8)
+
+        with self.lock:
+            if self.scaling is None:
+                self.scaling = _scaling(scal_info)
+                self.num_points = frames.shape[1]
+                self.file = open(self.path, 'wb')
+                _write_header(self.file, self.num_points, self.scaling, self.metadata)
+            elif self.file is None:
+                self.file = open(self.path, 'ab')
+
+            scaling = _scaling(scal_info)
+            if frames.shape[1] != self.num_points or scaling.keys() != self.scaling.keys() or any(
+                    not np.isclose(scaling[key], self.scaling[key], rtol=1e-9, atol=0) for key in scaling):
+                raise ValueError(f'the scope settings changed during the run, {self.path} can only hold one setting')
+
+            for i, row in enumerate(frames):
+                self.pending[index + i] = row
+
+            while self.num_committed in self.pending:
+                self.file.write(self.pending.pop(self.num_committed).tobytes())
+                self.num_committed += 1
+            self.file.flush()
+
+    def close(self):
+        '''
+        output:
+            int of how many waveforms are in the file
+        '''
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            return self.num_committed
+
+
+def _infer_scaling(times, voltages):
+    '''
+    Work out 8-bit scaling information that reproduces voltages that were converted from raw scope samples
+
+    input:
+        times: 1D array of the sample times in s
+        voltages: 2D array of the voltages in V, one row per waveform
+    output:
+        scal_info: dictionary with the scaling details
+        raw: 2D np.array of uint8 samples
+    '''
+    levels = np.unique(voltages)
+    steps = np.diff(levels)
+    steps = steps[steps > 1e-9 * max(1.0, np.abs(levels).max())]
+    if len(steps) > 0:
+        #the smallest step is one digitizing level, averaged over all steps to beat the rounding of the CSV text
+        ymult = np.median(steps / np.rint(steps / steps.min()))
+    else:
+        ymult = 1.0
+
+    #the lowest voltage is taken as level 0
+    yzero = levels[0]
+    raw = np.rint((voltages - yzero) / ymult)
+    if raw.max() > 255:
+        raise ValueError('the voltages span more than 256 levels, this is not 8-bit scope data')
+    if np.abs(raw * ymult + yzero - voltages).max() > 1e-3 * ymult:
+        raise ValueError('the voltages are not on a regular 8-bit grid, they cannot be stored as raw samples')
+
+    scal_info = {
+        'xincr': float(np.median(np.diff(times))),
+        'ymult': float(ymult),
+        'yoff': 0.0,
+        'yzero': float(yzero),
+        'HPos': 0.0,
+        'HDelay': float(times[0]),
+    }
+    return scal_info, raw.astype(np.uint8)
+
+
+def convert_csv(csv_path, raw_path=None, metadata=None):
+    '''
+    Convert a TakingSPEData CSV (time in the first column, each waveform in its own column) to a .pmtraw file.
+    The scaling is worked out from the voltages, and the conversion is checked to give back the same voltages.
+
+    input:
+        csv_path: str of the path of the CSV file
+        raw_path: str of the path of the .pmtraw file to write (default: same name, .pmtraw extension)
+        metadata: dictionary of run information to keep in the header
+    output:
+        str of the path of the .pmtraw file
+    '''
+    if raw_path is None:
+        raw_path = os.path.splitext(csv_path)[0] + EXTENSION
+
+    data = np.array(pd.read_csv(csv_path, delimiter=','))
+    scal_info, raw = _infer_scaling(data[:, 0], data[:, 1:].T)
+
+    writer = RawRunWriter(raw_path, dict(metadata or {}, source=os.path.basename(csv_path)), resume=False)
+    writer.add(0, raw, scal_info)
+    writer.close()
+
+    return raw_path
+
+
+def convert_waveform_files(csv_paths, raw_path, metadata=None):
+    '''
+    Convert TakingDataScope CSV files (header lines, then a TIME and a voltage column, one file per waveform)
+    to a single .pmtraw file, in the order given
+
+    input:
+        csv_paths: list of str of the paths of the {name}_waveform_N.csv files
+        raw_path: str of the path of the .pmtraw file to write
+        metadata: dictionary of run information to keep in the header
+    output:
+        str of the path of the .pmtraw file
+    '''
+    times = None
+    voltages = []
+    for csv_path in csv_paths:
+        with open(csv_path) as f:
+            #the data starts after the TIME,CHx subheader line
+            for skip, line in enumerate(f, start=1):
+                if line.startswith('TIME,'):
+                    break
+        data = np.loadtxt(csv_path, delimiter=',', skiprows=skip)
+        if times is None:
+            times = data[:, 0]
+        voltages.append(data[:, 1])
+
+    scal_info, raw = _infer_scaling(times, np.array(voltages))
+
+    writer = RawRunWriter(raw_path, dict(metadata or {}, num_files=len(csv_paths)), resume=False)
+    writer.add(0, raw, scal_info)
+    writer.close()
+
+    return raw_path
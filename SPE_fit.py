@@ -3,7 +3,9 @@ import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 import pandas as pd
 from matplotlib.gridspec import GridSpec
-from scipy.special import factorial
+
+from Waveform_io import iter_waveform_blocks
+from SPE_likelihood import fit_spe, expected_counts, print_spe_fit, spe_log_density
 
 
 """
@@ -12,41 +14,56 @@ Here are the implementations of all the functions used in the file SPE_fit_noteb
 
 tol = 1e-9
 
-#This function computes the area under the curve of a waveform file between specified time intervals.
+R = 50 # Resistance in Ohms
 
-def compute_area(file,t0,t1):
-    
-    file_ = pd.read_csv(file, delimiter=',', header=0, skiprows=1)
-    file_ = np.array(file_)
+#np.trapz was renamed np.trapezoid in numpy 2
+trapezoid = getattr(np, 'trapezoid', getattr(np, 'trapz', None))
 
-    #This is used to find the indices of the time intervals in the data.
-    #It finds the first index where the time is greater than or equal to t0 -
-    #tol and the first index where the time is greater than t1 + tol.
-    #The tol is used to avoid numerical issues with floating point precision.
-    #The times are then sliced to only include the data between these two indices.
+#This finds the indices of the time intervals in the data.
+#It finds the first index where the time is greater than or equal to t0 -
+#tol and the last index where the time is smaller than or equal to t1 + tol.
+#The tol is used to avoid numerical issues with floating point precision.
 
-    times = file_[:,0]
+def integration_window(times, t0, t1):
     index_0  = np.searchsorted(times, t0 - tol, side='left')
     index_f  = np.searchsorted(times, t1 + tol, side='right') - 1
-    times = times[index_0:index_f+1]
+    return index_0, index_f
 
-    df= pd.DataFrame(columns=['Waveform', 'Area'])
+#This computes the charge of every waveform at once. voltages has one waveform per column, like the files
+#read by load_waveforms. The baseline of each waveform (the mean of its samples before t0) is subtracted,
+#the signal is integrated with the trapezoidal rule between t0 and t1 and divided by the resistance.
+#PMT pulses are negative, so the charge is minus the integral: photoelectrons give positive charges and the
+#pedestal stays around 0. dtype can be np.float32 to halve the memory of very large files.
 
-    #TODO
-    #This 99 has to be changed to the number of waveforms in the file.
-    #It is currently hardcoded to 99, because the files have 99 waveforms but for a smoother histogram
-    #it is better to have more waveforms say 10e4 as I showed in the report.
+def integrate_charges(times, voltages, t0, t1, dtype=np.float64, resistance=R):
+
+    index_0, index_f = integration_window(times, t0, t1)
+    times = np.asarray(times[index_0:index_f+1], dtype=dtype)
+
+    signal = np.asarray(voltages[index_0:index_f+1], dtype=dtype)
+    if index_0 > 0:
+        signal = signal - np.mean(voltages[:index_0], axis=0, dtype=dtype)
+
+    return -trapezoid(signal, times, axis=0) / dtype(resistance)
+
+#This computes the charge of every waveform of a file between t0 and t1. The file is read block by block,
+#and only the rows up to t1 (the baseline and the window), so large files don't have to fit in memory.
+
+def file_charges(file, t0, t1, dtype=np.float64, block_size=1000, resistance=R):
+
+    charges = [integrate_charges(times, block, t0, t1, dtype, resistance)
+               for times, block in iter_waveform_blocks(file, t0, t1, block_size=block_size, dtype=dtype)]
+
+    return np.concatenate(charges)
 
-    for q in range(1,99):
+#This computes the charge (area under the curve divided by R) of every waveform of a file between t0 and t1,
+#and returns them in a table with the column number of the waveform in the file.
 
-        baseline = np.mean(file_[:index_0, q])
-        signal = file_[index_0:index_f+1, q]
-        #This computes the area under the curve of the signal using the trapezoidal rule.
-        #The area is divided by 50, which is the resistance in Ohms.
-        area= np.abs((np.trapz(signal, times)) / 50 )
-        df = df.append({'Waveform': q, 'Area': area}, ignore_index=True)
+def compute_area(file, t0, t1, dtype=np.float64):
 
-    return df
+    areas = file_charges(file, t0, t1, dtype)
+
+    return pd.DataFrame({'Waveform': np.arange(1, len(areas) + 1), 'Area': areas})
 
 """
 There are implementations for different types of fits: double Gaussian and a Gaussian convoluted with a Poisson distribution, but only the simple Gaussian fit is currently used.
@@ -54,15 +71,13 @@ These additional fits were included after reading some articles that used them t
 However, since we were never able to collect a proper SPE distribution, these fits were never actually used, and the corresponding code remains in the file unused for now.
 """
 
-def poisson_convolved_gaussian(x, A, mu, Q0, gain, sigma, n_max=10):
+#The Poisson weights are computed in log space and the photoelectron peaks around mu are all summed at once
+#(see SPE_likelihood.spe_log_density), so it also works for high LED intensities with thousands of photoelectrons.
+#n_max = None picks the numbers of photoelectrons from mu, an int sums the peaks 0..n_max.
+
+def poisson_convolved_gaussian(x, A, mu, Q0, gain, sigma, n_max=None):
 
-    result = np.zeros_like(x)
-    for n in range(n_max + 1):
-        weight = (mu**n) * np.exp(-mu) / factorial(n)
-        center = Q0 + n * gain
-        gaussian = np.exp(-0.5 * ((x - center) / sigma)**2) / (sigma * np.sqrt(2 * np.pi))
-        result += weight * gaussian
-    return A * result
+    return A * np.exp(spe_log_density(x, mu, Q0, sigma, gain, n_max=n_max))
 
 
 def double_gaussian(x, A0, mu0, sigma0, A1, mu1, sigma1):
@@ -75,6 +90,45 @@ def gaussian(x, A0, mu0, sigma0):
 
     return gauss0 
 
+def fit_charges(areas, model='gaussian', bins=20):
+    '''
+    Fit the histogram of the charges with the Gaussian or the Poisson convolved Gaussian model, with the same
+    initial guesses as plot_and_compute_spe
+
+    input:
+        areas: 1D array of the integrated charges in C
+        model: 'gaussian' (A0, mu0, sigma0) or 'poisson' (A, mu, Q0, gain, sigma)
+        bins: int of bins of the histogram
+    output:
+        popt: dictionary of the fitted parameters
+        perr: dictionary of their 1 sigma uncertainties (from the covariance of the fit)
+    '''
+    counts, bin_edges = np.histogram(areas, bins=bins)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    if model == 'gaussian':
+        names = ['A0', 'mu0', 'sigma0']
+        p0 = [max(counts), bin_centers[np.argmax(counts)], np.std(areas) / 10]
+        bounds = ([0, -np.inf, 0], np.inf)
+        function = gaussian
+    elif model == 'poisson':
+        names = ['A', 'mu', 'Q0', 'gain', 'sigma']
+        #the histogram counts are the integral of the normalized model over a bin
+        p0 = [len(areas) * (bin_edges[1] - bin_edges[0]), 0.5, bin_centers[np.argmax(counts)],
+              np.std(areas) / 2, np.std(areas) / 10]
+        #mu, the gain and sigma can't be negative, only the pedestal can
+        bounds = ([0, 0, -np.inf, 0, 0], np.inf)
+        function = poisson_convolved_gaussian
+    else:
+        raise ValueError(f"unknown model {model}, use 'gaussian' or 'poisson'")
+
+    #Poisson errors on the counts, so the uncertainties shrink with the number of waveforms like they should
+    popt, pcov = curve_fit(function, bin_centers, counts, p0=p0, sigma=np.sqrt(np.maximum(counts, 1)),
+                           absolute_sigma=True, bounds=bounds)
+    perr = np.sqrt(np.diag(pcov))
+
+    return dict(zip(names, popt)), dict(zip(names, perr))
+
 def plot_and_compute_spe(areas):
 
     #TODO
@@ -172,4 +226,46 @@ def plot_and_compute_spe(areas):
 
 
     plt.tight_layout()
-    plt.show();
\ No newline at end of file
+    plt.show();
+
+#This is the maximum likelihood version of plot_and_compute_spe: the fit uses every charge (see SPE_likelihood.py)
+#instead of a 20-bin histogram, so it doesn't depend on the binning, and gives the pedestal, gain and mean number
+#of photoelectrons with their uncertainties. bins is only the binning of the plot.
+#model can be 'gaussian', 'double_gaussian', 'poisson', 'spe' or 'spe_background'.
+
+def plot_spe_likelihood(areas, model='poisson', bins=20):
+
+    fit = fit_spe(areas, model)
+    print_spe_fit(fit)
+
+    counts, bin_edges = np.histogram(areas, bins=bins)
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    expected = expected_counts(bin_edges, model, [fit['params'][name] for name in fit['names']])
+
+    #residuals in units of the Poisson error of the bin
+    pulls = (counts - expected) / np.sqrt(np.maximum(expected, 1))
+
+    plt.figure(figsize=(8,6))
+    gs = GridSpec(2, 1, height_ratios=[3, 1])
+    ax0 = plt.subplot(gs[0])
+
+    ax0.hist(areas, bins=bin_edges, alpha=0.6, label='Data')
+    ax0.plot(bin_centers, expected, 'r--', label=f'{model} maximum likelihood fit')
+    if 'pedestal' in fit['params']:
+        ax0.axvline(fit['params']['pedestal'], color='r', linestyle=':', label='Pedestal')
+    if 'gain' in fit['params']:
+        ax0.axvline(fit['params']['pedestal'] + fit['params']['gain'], color='r', linestyle='-', label='1 p.e.')
+    ax0.set_ylabel("Counts")
+    ax0.legend()
+
+    ax1 = plt.subplot(gs[1], sharex=ax0)
+    ax1.errorbar(bin_centers, pulls, yerr=1, fmt='o', markersize=3, color='red', capsize=2)
+    ax1.axhline(0, color='gray', linestyle='--')
+    ax1.set_xlabel("Integrated Charge [C]")
+    ax1.set_ylabel("Pulls")
+    ax1.grid(True)
+
+    plt.tight_layout()
+    plt.show();
+
+    return fit
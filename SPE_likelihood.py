@@ -0,0 +1,500 @@
+import numpy as np
+from scipy.optimize import minimize
+from scipy.signal import find_peaks
+from scipy.special import ndtr, gammaln, xlogy
+
+
+"""
+This fits the SPE charge distribution by maximum likelihood, instead of curve_fit on a 20-bin histogram
+(SPE_fit.plot_and_compute_spe): the result doesn't depend on the binning, the counts get their Poisson errors,
+and all the charges are used.
+
+The charges are put in a fine histogram (1000 bins by default, the width of a bin is far below the width of
+the peaks, so nothing is lost by binning) and the extended Poisson likelihood of the bin counts is maximized.
+The expected count of every bin is the exact integral of the model over the bin (differences of the normal
+CDF), so the fit costs the same for 1e4 or 1e6 charges, and its gradient is computed analytically.
+
+The models are the ones of SPE_fit.py, written as sums of normal peaks with their number of entries instead of
+their height:
+
+    gaussian            N, mu0, sigma0                      one peak
+    double_gaussian     N0, mu0, sigma0, N1, mu1, sigma1    pedestal and single photoelectron peaks
+    poisson             N, mu, Q0, gain, sigma              Poisson (mean mu photoelectrons) sum of peaks at
+                                                            Q0 + n * gain, like SPE_fit.poisson_convolved_gaussian
+
+and the full SPE response, where the n photoelectron peak gets wider with the fluctuations of every photoelectron,
+sigma_n = sqrt(sigma0**2 + n * sigma1**2):
+
+    spe                 N, mu, Q0, sigma0, gain, sigma1
+    spe_background      N, mu, Q0, sigma0, gain, sigma1, w, tau
+                        plus a background: a fraction w of the triggers without a photoelectron have an exponential
+                        tail of decay length tau above the pedestal (noise, thermal electrons, ...)
+
+The Poisson weights are computed in log space and the numbers of photoelectrons summed over are picked from mu
+(see pe_range), so the poisson models work from a few photoelectrons per trigger up to thousands (the n_max of 10
+of SPE_fit.poisson_convolved_gaussian was only right for mu below 3 or so). spe_log_density() evaluates these
+models at any charges, a chunk of charges at a time with one work buffer, for fits and plots.
+
+The fits start from the best of a few readings of the charges (see initial_values): the lowest peak is the
+pedestal, or the n-th photoelectron peak, or (no peak resolved) mu and the gain come from the moments of the
+charges. Above a few photoelectrons per trigger the peaks merge and the gain and mu can hardly be told apart,
+the uncertainties then get large. A fit whose parameters stopped at a bound is listed in 'at_bound'.
+
+The uncertainties are the square root of the diagonal of the inverse Hessian of the negative log-likelihood at
+the best fit (the Fisher information of the bin counts). fit_spe() also gives the pedestal, the gain (charge of
+one photoelectron) and the mean number of photoelectrons per trigger of the models that have them, with their
+uncertainties.
+"""
+
+
+#parameter names of every model, and how each one scales with the charge: a 'count', a 'location' or a 'width'
+#in C, or a 'number' that doesn't change with the units of the charge
+MODELS = {
+    'gaussian': (('N', 'count'), ('mu0', 'location'), ('sigma0', 'width')),
+    'double_gaussian': (('N0', 'count'), ('mu0', 'location'), ('sigma0', 'width'),
+                        ('N1', 'count'), ('mu1', 'location'), ('sigma1', 'width')),
+    'poisson': (('N', 'count'), ('mu', 'number'), ('Q0', 'location'), ('gain', 'width'), ('sigma', 'width')),
+    'spe': (('N', 'count'), ('mu', 'number'), ('Q0', 'location'), ('sigma0', 'width'),
+            ('gain', 'width'), ('sigma1', 'width')),
+    'spe_background': (('N', 'count'), ('mu', 'number'), ('Q0', 'location'), ('sigma0', 'width'),
+                       ('gain', 'width'), ('sigma1', 'width'), ('w', 'fraction'), ('tau', 'width')),
+}
+
+
+def pe_range(mu, n_max=None):
+    '''
+    output:
+        1D np.array of the numbers of photoelectrons to sum over: 0..n_max, or (n_max None) the ones around mu
+        whose Poisson probability is not negligible (the tails left out are below 1e-10). A mu that is not a
+        valid mean (negative or NaN, e.g. while an unbounded fit explores) gets the peaks of mu = 0
+    '''
+    if n_max is not None:
+        return np.arange(n_max + 1)
+    mu = mu if mu > 0 else 0.0     #also NaN
+    spread = 7 * np.sqrt(mu) + 7
+    return np.arange(max(int(mu - spread), 0), int(np.ceil(mu + spread)) + 1)
+
+
+def log_poisson(n, mu):
+    '''
+    output:
+        1D np.array of the log of the Poisson probabilities of n for the mean mu
+    '''
+    return xlogy(n, mu) - mu - gammaln(n + 1)
+
+
+def spe_log_density(x, mu, Q0, sigma0, gain, sigma1=0.0, w=0.0, tau=None, n_max=None, chunk_size=4096, out=None):
+    '''
+    Log of the probability density of the charge of a trigger, for the poisson, spe and spe_background models
+
+    input:
+        x: np.array of the charges in C
+        mu, Q0, sigma0, gain, sigma1, w, tau: parameters of the model (see MODELS), sigma1 = 0 is the poisson model
+        n_max: int of the largest number of photoelectrons, None to pick them from mu (see pe_range)
+        chunk_size: int of charges evaluated at a time, the work buffer has chunk_size x (number of peaks) floats
+        out: np.array of the shape of x to write the result to, e.g. to reuse it between calls
+    output:
+        np.array of the log of the density in 1/C, the shape of x: -inf everywhere for a negative mu and NaN for
+        a NaN mu, so a fit that wanders there is pushed back instead of stopped
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    out = np.empty(x.shape) if out is None else out
+    if not mu >= 0:
+        out[...] = -np.inf if mu < 0 else np.nan
+        return out
+    flat_x, flat_out = x.reshape(-1), out.reshape(-1)
+
+    n = pe_range(mu, n_max)
+    widths = np.sqrt(sigma0**2 + n * sigma1**2)
+    centers = Q0 + n * gain
+    inverse_widths = 1 / widths
+    log_weights = log_poisson(n, mu) - np.log(widths) - 0.5 * np.log(2 * np.pi)
+    background = w > 0 and n[0] == 0
+    if background:
+        log_weights[0] += np.log1p(-w)
+
+    #every step is done in place in the buffer, so the only arrays made per chunk are the maxima and sums
+    work = np.empty((min(chunk_size, len(flat_x)), len(n)))
+    for start in range(0, len(flat_x), chunk_size):
+        chunk = flat_x[start:start + chunk_size]
+        buffer = work[:len(chunk)]
+        np.subtract(chunk[:, np.newaxis], centers, out=buffer)
+        buffer *= inverse_widths
+        np.square(buffer, out=buffer)
+        buffer *= -0.5
+        buffer += log_weights
+        #log-sum-exp over the peaks
+        largest = buffer.max(axis=1)
+        buffer -= largest[:, np.newaxis]
+        np.exp(buffer, out=buffer)
+        result = flat_out[start:start + len(chunk)]
+        np.log(buffer.sum(axis=1), out=result)
+        result += largest
+
+    if background:
+        with np.errstate(divide='ignore'):
+            tail = np.where(flat_x >= Q0, np.log(w) - mu - np.log(tau) - (flat_x - Q0) / tau, -np.inf)
+        np.logaddexp(flat_out, tail, out=flat_out)
+
+    return out
+
+
+def _peaks(model, theta, n_max):
+    '''
+    The model as a sum of normal peaks, with the derivatives of the peaks with respect to the parameters
+
+    output:
+        weights, centers, widths: 1D np.arrays of the entries, center and sigma of every peak
+        d_weights, d_centers, d_widths: 2D np.arrays of their derivatives, one row per peak and one column per parameter
+    '''
+    if model == 'gaussian':
+        N, mu0, sigma0 = theta
+        weights, centers, widths = np.array([N]), np.array([mu0]), np.array([sigma0])
+        d_weights, d_centers, d_widths = np.zeros((3, 1, 3))
+        d_weights[0, 0] = d_centers[0, 1] = d_widths[0, 2] = 1
+
+    elif model == 'double_gaussian':
+        N0, mu0, sigma0, N1, mu1, sigma1 = theta
+        weights, centers, widths = np.array([N0, N1]), np.array([mu0, mu1]), np.array([sigma0, sigma1])
+        d_weights, d_centers, d_widths = np.zeros((3, 2, 6))
+        d_weights[0, 0] = d_centers[0, 1] = d_widths[0, 2] = 1
+        d_weights[1, 3] = d_centers[1, 4] = d_widths[1, 5] = 1
+
+    elif model == 'poisson':
+        N, mu, Q0, gain, sigma = theta
+        n = pe_range(mu, n_max)
+        poisson = np.exp(log_poisson(n, mu))
+        weights, centers, widths = N * poisson, Q0 + n * gain, np.full(len(n), sigma)
+        d_weights, d_centers, d_widths = np.zeros((3, len(n), 5))
+        d_weights[:, 0] = poisson
+        d_weights[:, 1] = weights * (n / mu - 1)
+        d_centers[:, 2] = 1
+        d_centers[:, 3] = n
+        d_widths[:, 4] = 1
+
+    elif model in ('spe', 'spe_background'):
+        N, mu, Q0, sigma0, gain, sigma1 = theta[:6]
+        n = pe_range(mu, n_max)
+        poisson = np.exp(log_poisson(n, mu))
+        widths = np.sqrt(sigma0**2 + n * sigma1**2)
+        weights, centers = N * poisson, Q0 + n * gain
+        d_weights, d_centers, d_widths = np.zeros((3, len(n), len(theta)))
+        d_weights[:, 0] = poisson
+        d_weights[:, 1] = weights * (n / mu - 1)
+        d_centers[:, 2] = 1
+        d_widths[:, 3] = sigma0 / widths
+        d_centers[:, 4] = n
+        d_widths[:, 5] = n * sigma1 / widths
+        if model == 'spe_background' and n[0] == 0:
+            #the pedestal triggers that are in the background are not in the pedestal peak
+            w = theta[6]
+            d_weights[0, 6] = -weights[0]
+            d_weights[0, :2] *= 1 - w
+            weights = weights.copy()
+            weights[0] *= 1 - w
+
+    else:
+        raise ValueError(f"unknown model {model}, use one of {', '.join(MODELS)}")
+
+    return weights, centers, widths, d_weights, d_centers, d_widths
+
+
+def expected_counts(edges, model, theta, n_max=None, jacobian=False):
+    '''
+    Expected number of charges in every bin: the integral of the model over the bin
+
+    input:
+        edges: 1D np.array of the bin edges
+        model: str, one of MODELS
+        theta: list of the parameters of the model, in the order of MODELS
+        n_max: int of the largest number of photoelectrons of the poisson models, None to pick them from mu
+        jacobian: if True also return the derivatives
+    output:
+        1D np.array of the expected counts
+        2D np.array of their derivatives with respect to the parameters, one column per parameter (with jacobian)
+    '''
+    weights, centers, widths, d_weights, d_centers, d_widths = _peaks(model, theta, n_max)
+
+    z = (np.asarray(edges)[:, np.newaxis] - centers) / widths
+    #integral of every peak over every bin, from the closer tail so it does not cancel out far from the peak
+    #(one ndtr of the edges, the most expensive step of the fits)
+    tail = ndtr(-np.abs(z))
+    cdf = np.where(z < 0, tail, 1 - tail)
+    fraction = np.where(z[:-1] > 0, tail[:-1] - tail[1:], cdf[1:] - cdf[:-1])
+    counts = fraction @ weights
+    if model == 'spe_background':
+        background, d_background = _background_counts(edges, theta, n_max)
+        counts = counts + background
+    if not jacobian:
+        return counts
+
+    density = np.exp(-0.5 * z**2) / np.sqrt(2 * np.pi)
+    d_center = -(density[1:] - density[:-1]) / widths
+    d_width = -(z[1:] * density[1:] - z[:-1] * density[:-1]) / widths
+
+    jacobian = fraction @ d_weights + (d_center * weights) @ d_centers + (d_width * weights) @ d_widths
+    if model == 'spe_background':
+        jacobian = jacobian + d_background
+    return counts, jacobian
+
+
+def _background_counts(edges, theta, n_max):
+    '''
+    Expected counts of the exponential background of the spe_background model in every bin, and their derivatives
+
+    output:
+        1D np.array of the counts
+        2D np.array of the derivatives, one column per parameter
+    '''
+    N, mu, Q0, sigma0, gain, sigma1, w, tau = theta
+    d_tail = np.zeros((len(edges) - 1, len(theta)))
+    if pe_range(mu, n_max)[0] > 0:
+        #no triggers without a photoelectron
+        return np.zeros(len(edges) - 1), d_tail
+
+    weight = N * np.exp(-mu) * w
+    u = np.maximum((np.asarray(edges) - Q0) / tau, 0)
+    above = np.asarray(edges) > Q0
+    survival = np.exp(-u)
+    #fraction of the exponential in every bin, and its derivatives with respect to Q0 and tau
+    fraction = survival[:-1] - survival[1:]
+    d_Q0 = np.where(above, survival / tau, 0)
+    d_tau = np.where(above, u * survival / tau, 0)
+
+    d_tail[:, 0] = fraction * weight / N
+    d_tail[:, 1] = -fraction * weight
+    d_tail[:, 2] = weight * (d_Q0[:-1] - d_Q0[1:])
+    d_tail[:, 6] = fraction * N * np.exp(-mu)
+    d_tail[:, 7] = weight * (d_tau[:-1] - d_tau[1:])
+    return fraction * weight, d_tail
+
+
+def _histogram_peaks(charges):
+    '''
+    Significant peaks of the charge distribution
+
+    output:
+        1D np.array of the charges of the peaks, lowest first (the highest bin if nothing stands out)
+    '''
+    low, high = np.quantile(charges, [0.001, 0.999])
+    counts, edges = np.histogram(charges, bins=200, range=(low, high))
+    #padded with empty bins so a peak in the first or last bin is found too
+    counts = np.pad(np.convolve(counts, np.ones(5) / 5, mode='same'), 1)
+    #a peak has to stand out of its surroundings by 5% of the highest one, and by more than the noise of the counts
+    indices, _ = find_peaks(counts, prominence=np.maximum(0.05 * counts.max(), 3 * np.sqrt(counts)))
+    indices = indices - 1
+    if len(indices) == 0:
+        indices = np.array([np.argmax(counts) - 1])
+    return (edges[indices] + edges[indices + 1]) / 2
+
+
+def _spe_seeds(charges):
+    '''
+    Candidate starting points of the poisson models, (mu, Q0, sigma0, gain, sigma1) for every way of reading the
+    distribution: the lowest peak is the pedestal or the n-th photoelectron peak (when the peaks are resolved),
+    or (when they are not) mu and the gain come from the moments of the charges
+    '''
+    mean, var = np.mean(charges), np.var(charges)
+    peaks = _histogram_peaks(charges)
+    below = charges[charges < peaks[0]] - peaks[0]
+    lowest_sigma = np.sqrt(np.mean(below**2)) if len(below) > 10 else np.sqrt(var) / 10
+    lowest_sigma = max(lowest_sigma, np.sqrt(var) / 1e3)
+
+    def seed(Q0, gain, sigma0=None, k=0):
+        #sigma1 is what is left of the variance: var = sigma0**2 + mu * (gain**2 + sigma1**2)
+        mu = max((mean - Q0) / gain, 0.01)
+        sigma0 = lowest_sigma if sigma0 is None else sigma0
+        sigma1 = np.sqrt(np.clip((var - sigma0**2) / mu - gain**2, (0.1 * gain)**2, gain**2))
+        if k > 0:
+            #the lowest peak is the k photoelectron peak, wider than the pedestal
+            sigma0 = np.sqrt(max(lowest_sigma**2 - k * sigma1**2, (0.05 * gain)**2))
+        return mu, Q0, sigma0, gain, sigma1
+
+    seeds = []
+    if len(peaks) > 1:
+        spacing = np.median(np.diff(peaks))
+        seeds += [seed(peaks[0] - k * spacing, spacing, k=k) for k in range(4)]
+
+    #from the mean and variance, with sigma1 about 0.3 gain: var - sigma0**2 = mu * gain**2 * 1.09
+    excess = mean - peaks[0]
+    if excess > 0 and var > lowest_sigma**2:
+        seeds.append(seed(peaks[0], (var - lowest_sigma**2) / (1.09 * excess)))
+    #the charges are baseline-subtracted, so the pedestal is close to 0 even when it can't be seen
+    if mean > 0:
+        gain = var / (1.09 * mean)
+        seeds.append(seed(0.0, gain, 0.1 * gain))
+    #from the third cumulant, mu * gain**3 * (1 + 3 * 0.3**2), which the pedestal does not add to
+    third = np.mean((charges - mean)**3)
+    if third > 0:
+        gain = third * 1.09 / (var * 1.27)
+        seeds.append(seed(mean - var / (1.09 * gain), gain, 0.1 * gain))
+
+    return [values for values in seeds if np.all(np.isfinite(values)) and values[3] > 0]
+
+
+def _model_values(model, num_charges, mu, Q0, sigma0, gain, sigma1):
+    '''
+    output:
+        list of the parameters of a poisson model, in the order of MODELS
+    '''
+    if model == 'poisson':
+        return [num_charges, mu, Q0, gain, sigma0]
+    if model == 'spe':
+        return [num_charges, mu, Q0, sigma0, gain, sigma1]
+    return [num_charges, mu, Q0, sigma0, gain, sigma1, 0.05, gain / 2]
+
+
+def initial_values(charges, model):
+    '''
+    Starting values of the fit, from the charges: the pedestal is the lowest peak of the distribution, its width
+    comes from the charges below it (not mixed with any photoelectron), and what is above it is the signal.
+    For the poisson models every reading of the distribution of _spe_seeds() is tried and the one with the best
+    likelihood is kept, so a run with several photoelectrons per trigger (where the highest peak is not the
+    pedestal, or no peak is resolved) does not start the fit next to a wrong minimum
+
+    output:
+        list of the parameters of the model, in the order of MODELS
+    '''
+    n = len(charges)
+    spread = np.std(charges)
+    if model == 'gaussian':
+        return [n, np.mean(charges), spread]
+
+    if model == 'double_gaussian':
+        pedestal = _histogram_peaks(charges)[0]
+        below = charges[charges < pedestal] - pedestal
+        pedestal_sigma = max(np.sqrt(np.mean(below**2)) if len(below) > 10 else spread / 10, spread / 1e3)
+        above = charges[charges > pedestal + 3 * pedestal_sigma]
+        fraction = np.clip(len(above) / n, 0.01, 0.99)
+        mu1 = np.mean(above) if len(above) > 10 else pedestal + 3 * pedestal_sigma
+        sigma1 = np.std(above) if len(above) > 10 else pedestal_sigma
+        return [n * (1 - fraction), pedestal, pedestal_sigma, n * fraction, mu1, max(sigma1, pedestal_sigma)]
+
+    if model in ('poisson', 'spe', 'spe_background'):
+        candidates = [_model_values(model, n, *seed) for seed in _spe_seeds(charges)]
+        if not candidates:
+            return _model_values(model, n, 1.0, np.min(charges), spread / 10, spread, spread / 3)
+
+        counts, edges = np.histogram(charges, bins=200)
+        def nll(values):
+            expected = np.maximum(expected_counts(edges, model, values), 1e-300)
+            return np.sum(expected - counts * np.log(expected))
+        return min(candidates, key=nll)
+
+    raise ValueError(f"unknown model {model}, use one of {', '.join(MODELS)}")
+
+
+def fit_spe(charges, model='poisson', bins=1000, n_max=None, p0=None):
+    '''
+    Maximum likelihood fit of the charge distribution
+
+    input:
+        charges: 1D array of the integrated charges in C
+        model: 'gaussian', 'double_gaussian', 'poisson', 'spe' or 'spe_background'
+        bins: int of bins of the likelihood histogram
+        n_max: int of the largest number of photoelectrons of the poisson models, None to pick them from mu
+        p0: list of starting values in the order of MODELS, None to take them from the charges
+    output:
+        dictionary with
+            'params', 'errors': dictionaries of parameter: best fit value and its 1 sigma uncertainty, including
+                                pedestal, gain and mean_pe for the models that have them
+            'covariance': 2D np.array of the covariance of the parameters of the model
+            'names': list of the parameters of the model
+            'nll': float of the negative log-likelihood at the best fit (up to a constant)
+            'converged': bool
+            'at_bound': list of the parameters stopped at a bound of the fit (e.g. a width of 0)
+            'model', 'num_charges', 'edges': what was fitted
+    '''
+    charges = np.asarray(charges, dtype=np.float64)
+    charges = charges[np.isfinite(charges)]
+    names, kinds = zip(*MODELS[model])
+    p0 = initial_values(charges, model) if p0 is None else list(p0)
+
+    #the fit runs in units of the spread of the charges (and of the number of charges for the counts),
+    #so every parameter is about 1 and the minimizer is not thrown off by charges of 1e-12 C
+    location, scale = np.median(charges), max(np.std(charges), np.finfo(float).tiny)
+    units = np.array([{'count': len(charges), 'location': scale, 'width': scale, 'number': 1, 'fraction': 1}[kind]
+                      for kind in kinds])
+    offsets = np.array([location if kind == 'location' else 0 for kind in kinds])
+
+    counts, edges = np.histogram((charges - location) / scale, bins=bins)
+    count_units = np.where(np.array(kinds) == 'count', len(charges), 1)
+
+    def model_counts(theta):
+        expected, jacobian = expected_counts(edges, model, theta * count_units, n_max, jacobian=True)
+        return np.maximum(expected, 1e-300), jacobian * count_units
+
+    def nll(theta):
+        expected, jacobian = model_counts(theta)
+        return np.sum(expected - counts * np.log(expected)), jacobian.T @ (1 - counts / expected)
+
+    theta_0 = (np.array(p0, dtype=np.float64) - offsets) / units
+    bounds = [{'location': (None, None), 'fraction': (1e-9, 1 - 1e-9)}.get(kind, (1e-9, None)) for kind in kinds]
+    result = minimize(nll, theta_0, jac=True, method='L-BFGS-B', bounds=bounds,
+                      options={'maxiter': 1000, 'ftol': 1e-12, 'gtol': 1e-8})
+
+    #Hessian of the negative log-likelihood: Fisher information of the Poisson bin counts
+    expected, jacobian = model_counts(result.x)
+    hessian = jacobian.T @ (jacobian / expected[:, np.newaxis])
+    try:
+        covariance = np.linalg.inv(hessian)
+    except np.linalg.LinAlgError:
+        covariance = np.full_like(hessian, np.nan)
+
+    #a parameter stopped at its bound (a width or mu at 0) is not at a minimum of the likelihood, the fit took a
+    #wrong turn or the model does not describe the charges, and its uncertainty means nothing
+    at_bound = [name for name, value, (low, high) in zip(names, result.x, bounds)
+                if (low is not None and value - low < 1e-6) or (high is not None and high - value < 1e-6)]
+
+    #back to C and numbers of charges
+    values = result.x * units + offsets
+    covariance = covariance * np.outer(units, units)
+    fit = {
+        'model': model,
+        'names': list(names),
+        'params': dict(zip(names, values)),
+        'errors': dict(zip(names, np.sqrt(np.abs(np.diag(covariance))))),
+        'covariance': covariance,
+        'nll': float(result.fun),
+        'converged': bool(result.success),
+        'at_bound': at_bound,
+        'num_charges': len(charges),
+        'edges': edges * scale + location,
+    }
+    _add_spe_quantities(fit)
+
+    return fit
+
+
+def _add_spe_quantities(fit):
+    '''
+    Add the pedestal, gain and mean number of photoelectrons (and their uncertainties) of the models that have them
+    '''
+    params, names, covariance = fit['params'], fit['names'], fit['covariance']
+
+    def derived(name, value, gradient):
+        #uncertainty from the covariance of the parameters it depends on
+        gradient = np.array([gradient.get(parameter, 0.0) for parameter in names])
+        fit['params'][name] = value
+        fit['errors'][name] = float(np.sqrt(max(gradient @ covariance @ gradient, 0)))
+
+    if fit['model'] in ('poisson', 'spe', 'spe_background'):
+        derived('pedestal', params['Q0'], {'Q0': 1})
+        derived('mean_pe', params['mu'], {'mu': 1})
+    elif fit['model'] == 'double_gaussian':
+        N0, N1 = params['N0'], params['N1']
+        derived('pedestal', params['mu0'], {'mu0': 1})
+        derived('gain', params['mu1'] - params['mu0'], {'mu1': 1, 'mu0': -1})
+        #Poisson occupancy from the fraction of triggers in the pedestal, mu = -log(N0 / (N0 + N1))
+        derived('mean_pe', np.log((N0 + N1) / N0), {'N0': -N1 / (N0 * (N0 + N1)), 'N1': 1 / (N0 + N1)})
+
+
+def print_spe_fit(fit):
+    '''
+    Print the parameters of a fit_spe result with their uncertainties
+    '''
+    print(f"\nMaximum likelihood {fit['model']} fit of {fit['num_charges']} charges"
+          f"{'' if fit['converged'] else ' (DID NOT CONVERGE)'}"
+          f"{' (AT BOUND: ' + ', '.join(fit['at_bound']) + ')' if fit['at_bound'] else ''}:")
+    for name, value in fit['params'].items():
+        print(f"    {name:<10} {value: .4e} +- {fit['errors'][name]:.2e}")
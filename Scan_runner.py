@@ -0,0 +1,303 @@
+import time
+import json
+import os
+from datetime import date, datetime
+
+from Acquisition_orchestrator import run_batch, job_name
+from Scope_simulator import SimulatedResourceManager
+
+
+"""
+This runs a whole HV x LED sweep unattended, producing the grid of files Charge_Test.py and Linearity_Test.py read
+(SPEdataTest_{PMT}-{HV}V_L-{LED}_LASER-{laser}_CH1.csv for every PMT, HV point, LED and laser setting),
+instead of editing PMT_voltage, LED_wavelength and Filename in the acquisition script and rerunning it by hand.
+
+A sweep is a dictionary:
+
+    sweep = {
+        'name': 'BA_scan',                          #name of the manifest file
+        'pmts': [{'PMT': 'BA0131', 'address': 'TCPIP::...::INSTR', 'channel': 'CH1', 'hv_channel': 0}, ...],
+        'HV': list(range(500, 1350, 100)),          #V
+        'LED': ['235', '308'],
+        'laser': ['ON'],                            #'OFF' points are taken with the LED off (background)
+        'num_waveforms': 1000,                      #per point
+        'job': {'acquisition_mode': 'fastframe'},   #optional, any other job setting of Acquisition_orchestrator
+    }
+
+For every point the HV of all the PMTs is set (and left to settle), the LED is selected, and all the PMTs are read
+out at the same time with Acquisition_orchestrator.run_batch. Every finished point is written to a manifest
+({folder}{name}_manifest.json, replaced atomically so a crash never leaves it half written). Running the same sweep
+again skips the points in the manifest and carries on where it stopped, a point that was cut part-way
+resumes from the waveforms already on disk.
+
+The HV supply and the LED controller are pluggable, anything with these methods can be used:
+
+    hv_supply.set_voltage(pmt, voltage)     pmt is the dictionary of the PMT in the sweep, voltage in V
+    hv_supply.read_voltage(pmt)             output voltage in V
+    hv_supply.off()                         all outputs to 0 V, called at the end of the sweep and on errors
+    led_controller.set_led(led)             LED id of the sweep, or None to turn the LED off
+    led_controller.off()
+
+ManualHVSupply and ManualLEDController ask the operator to make each change (the way it is done now), and
+SimulatedHVSupply and SimulatedLEDController drive the simulated scopes of Scope_simulator.py, so a whole sweep
+can be tested without the bench.
+"""
+
+
+class ManualHVSupply:
+    '''
+    HV supply set by hand: asks the operator to set every voltage and waits for Enter
+    '''
+
+    def __init__(self):
+        self.voltages = {}
+
+    def set_voltage(self, pmt, voltage):
+        if self.voltages.get(pmt['PMT']) != voltage:
+            input(f"Set the HV of {pmt['PMT']} (channel {pmt.get('hv_channel')}) to {voltage} V, then press Enter")
+            self.voltages[pmt['PMT']] = voltage
+
+    def read_voltage(self, pmt):
+        return self.voltages.get(pmt['PMT'], 0)
+
+    def off(self):
+        if any(self.voltages.values()):
+            print('Turn the HV of all the PMTs off')
+        self.voltages = {}
+
+
+class ManualLEDController:
+    '''
+    LED controller set by hand: asks the operator to select every LED and waits for Enter
+    '''
+
+    def __init__(self):
+        self.led = None
+
+    def set_led(self, led):
+        if led != self.led:
+            input('Turn the LED off, then press Enter' if led is None else f'Select LED {led}, then press Enter')
+            self.led = led
+
+    def off(self):
+        if self.led is not None:
+            print('Turn the LED off')
+        self.led = None
+
+
+class SimulatedHVSupply:
+    '''
+    Stand-in HV supply for the simulated scopes: setting the voltage of a PMT sets the gain of the scope it is read
+    out on, gain = gain_ref * (voltage / voltage_ref) ** exponent like a dynode chain
+
+    input:
+        rm: SimulatedResourceManager the scopes of the sweep are opened with
+        gain_ref: float of the gain at voltage_ref
+        voltage_ref: float in V
+        exponent: float, about the number of dynodes times their secondary emission exponent
+    '''
+
+    def __init__(self, rm, gain_ref=1e7, voltage_ref=1300, exponent=7):
+        self.rm = rm
+        self.gain_ref = gain_ref
+        self.voltage_ref = voltage_ref
+        self.exponent = exponent
+        self.voltages = {}
+
+    def set_voltage(self, pmt, voltage):
+        self.voltages[pmt['PMT']] = voltage
+        self.rm.open_resource(pmt['address']).gain = self.gain_ref * (voltage / self.voltage_ref) ** self.exponent
+
+    def read_voltage(self, pmt):
+        return self.voltages.get(pmt['PMT'], 0)
+
+    def off(self):
+        self.voltages = {}
+
+
+class SimulatedLEDController:
+    '''
+    Stand-in LED controller for the simulated scopes: each LED gives a mean number of photoelectrons per flash
+
+    input:
+        rm: SimulatedResourceManager the scopes of the sweep are opened with
+        mean_pe: dictionary of LED id: mean photoelectrons per flash, LEDs not in it give default_pe
+        default_pe: float of mean photoelectrons per flash
+    '''
+
+    def __init__(self, rm, mean_pe=None, default_pe=1.0):
+        self.rm = rm
+        self.mean_pe = mean_pe or {}
+        self.default_pe = default_pe
+        self.led = None
+
+    def set_led(self, led):
+        self.led = led
+        for scope in self.rm.instruments.values():
+            scope.mean_pe = 0.0 if led is None else self.mean_pe.get(led, self.default_pe)
+
+    def off(self):
+        self.set_led(None)
+
+
+def point_key(pmt, voltage, led, laser):
+    '''
+    output:
+        str identifying a point of the sweep in the manifest
+    '''
+    return f"{pmt['PMT']}|{voltage}|{led}|{laser}"
+
+
+def scan_points(sweep):
+    '''
+    Order of the points of a sweep: the HV is changed as little as possible since it has to settle,
+    all the LEDs are taken at each HV point
+
+    output:
+        list of (laser, voltage, led) tuples
+    '''
+    return [(laser, voltage, led) for laser in sweep.get('laser', ['ON'])
+            for voltage in sweep['HV'] for led in sweep['LED']]
+
+
+class ScanManifest:
+    '''
+    Record of the finished points of a sweep, kept in a JSON file
+
+    input:
+        path: str of the path of the manifest file, loaded if it exists
+        sweep: dictionary of the sweep definition, saved with the points
+    '''
+
+    def __init__(self, path, sweep):
+        self.path = path
+        self.points = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.points = manifest['points']
+            if manifest['sweep'] != json.loads(json.dumps(sweep)):
+                print(f'The sweep changed since {path} was written, only the points of the new sweep are taken')
+
+        self.sweep = sweep
+
+    def done(self, key):
+        return self.points.get(key, {}).get('status') == 'done'
+
+    def record(self, key, entry):
+        '''
+        Add (or replace) a point and write the manifest to disk
+
+        input:
+            key: str from point_key
+            entry: dictionary of what to keep about the point
+        '''
+        self.points[key] = entry
+
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump({'sweep': self.sweep, 'points': self.points}, f, indent=1)
+        os.replace(f'{self.path}.tmp', self.path)  #the manifest is never half written
+
+    def summary(self):
+        '''
+        output:
+            dictionary of status: number of points
+        '''
+        summary = {}
+        for entry in self.points.values():
+            summary[entry['status']] = summary.get(entry['status'], 0) + 1
+        return summary
+
+
+def run_scan(sweep, hv_supply=None, led_controller=None, folder=None, output_format='csv', use_simulator=False,
+             hv_settle=30.0, led_settle=1.0, num_workers=4):
+    '''
+    Take all the points of a sweep that are not in its manifest yet
+
+    input:
+        sweep: dictionary of the sweep definition (see the top of this file)
+        hv_supply: HV supply driver, by default ManualHVSupply (SimulatedHVSupply with use_simulator)
+        led_controller: LED controller driver, by default ManualLEDController (SimulatedLEDController with use_simulator)
+        folder: str of the folder to save to (default ./SPE_PMT_data/{date}/)
+        output_format: 'csv' (what Charge_Test.py and Linearity_Test.py read) or 'raw' (.pmtraw)
+        use_simulator: if True the scopes are simulated
+        hv_settle: float of s to wait after changing the HV
+        led_settle: float of s to wait after changing the LED
+        num_workers: int of pipeline worker threads shared by all the PMTs of a point
+    output:
+        ScanManifest of the sweep
+    '''
+    if folder is None:
+        folder = f"./SPE_PMT_data/{date.today().strftime('%y-%m-%d')}/"
+    os.makedirs(folder, exist_ok=True)
+
+    rm = None
+    if use_simulator:
+        rm = SimulatedResourceManager()
+        for pmt in sweep['pmts']:
+            rm.open_resource(pmt['address'])
+        hv_supply = hv_supply or SimulatedHVSupply(rm)
+        led_controller = led_controller or SimulatedLEDController(rm)
+    hv_supply = hv_supply or ManualHVSupply()
+    led_controller = led_controller or ManualLEDController()
+
+    manifest = ScanManifest(f"{folder}{sweep['name']}_manifest.json", sweep)
+    points = scan_points(sweep)
+    print(f"Sweep {sweep['name']}: {len(points)} points x {len(sweep['pmts'])} PMTs, "
+          f"{sum(manifest.done(point_key(pmt, *point[1:], point[0])) for point in points for pmt in sweep['pmts'])} already done")
+
+    try:
+        for laser, voltage, led in points:
+            pmts = [pmt for pmt in sweep['pmts'] if not manifest.done(point_key(pmt, voltage, led, laser))]
+            if not pmts:
+                continue
+            print(f'=== {voltage} V, LED {led}, laser {laser}: {", ".join(pmt["PMT"] for pmt in pmts)}')
+
+            if any(hv_supply.read_voltage(pmt) != voltage for pmt in pmts):
+                for pmt in pmts:
+                    hv_supply.set_voltage(pmt, voltage)
+                time.sleep(hv_settle)
+
+            led_controller.set_led(led if laser == 'ON' else None)
+            time.sleep(led_settle)
+
+            jobs = [dict(sweep.get('job', {}), **pmt, HV=voltage, LED=led, laser=laser,
+                         num_waveforms=sweep['num_waveforms']) for pmt in pmts]
+            results = run_batch(jobs, folder, output_format, num_workers, use_simulator=use_simulator, rm=rm)
+
+            for pmt, job in zip(pmts, jobs):
+                name = job_name(dict(job, channel=job.get('channel', 'CH1')))
+                result = results.get(name, {'error': 'no result'})
+                complete = 'error' not in result and result['waveforms'] >= sweep['num_waveforms']
+                manifest.record(point_key(pmt, voltage, led, laser), {
+                    'PMT': pmt['PMT'], 'HV': voltage, 'LED': led, 'laser': laser,
+                    'file': f"{folder}{name}.{'pmtraw' if output_format == 'raw' else 'csv'}",
+                    'waveforms': result.get('waveforms', 0),
+                    'status': 'done' if complete else 'failed',
+                    'error': result.get('error'),
+                    'finished': datetime.now().isoformat(timespec='seconds'),
+                })
+
+    finally:
+        #never leave the HV on or the LED flashing
+        led_controller.off()
+        hv_supply.off()
+
+    print(f'Sweep {sweep["name"]} finished: {manifest.summary()}, manifest saved to {manifest.path}')
+    return manifest
+
+
+if __name__ == '__main__':
+
+    sweep = {
+        'name': 'BA_scan',
+        'pmts': [{'PMT': 'BA0131', 'address': 'TCPIP::142.90.115.154::inst0::INSTR', 'channel': 'CH1', 'hv_channel': 0},
+                 {'PMT': 'BA0030', 'address': 'TCPIP::142.90.100.19::inst0::INSTR', 'channel': 'CH1', 'hv_channel': 1}],
+        'HV': list(range(500, 1350, 100)),
+        'LED': ['235', '308'],
+        'laser': ['ON'],
+        'num_waveforms': 1000,
+    }
+
+    run_scan(sweep, use_simulator=False)
@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import os, sys
 
+from Waveform_render import render_run
+
 
 """This script plots every waveform for a given PMT and voltage setting. 
 It is useful to check the shape of the pulses and to see if there are any issues with the data.
@@ -21,62 +23,43 @@ date = '25-07-24'
 PMT_IDs = ['BA0100']
 LED_IDs = ["235"]
 
-for PMT_ID in PMT_IDs:
-    isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}')
-    if not isExist:
-        os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}')
+#'png' draws every waveform in its own PNG file, 'sheet' draws them as contact sheets of 100 thumbnails
+#(see Waveform_render.py), max_waveforms = None draws the whole run
+mode = 'png'
+max_waveforms = 99
 
-    for LED_ID in LED_IDs:
-        isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}')
-        if not isExist:
-            os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}')
-        #TODO
-        #t0 is the time at which the PMT pulse starts, and t1 is the time point when the pulse ends. 
+#blocks of waveforms are drawn in parallel, by this many processes
+num_workers = os.cpu_count()
 
-        t0, t1   = 0, 1.5e-7
-        tol = 1e-9
+if __name__ == '__main__':
 
-        if LED_ID =="308":
-            t1 = 3.5e-7
-        #TODO
-        #Do not forget to change the voltage range and step as needed
-        for set_voltage in range(1300,1350,100):
+    for PMT_ID in PMT_IDs:
+        isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}')
+        if not isExist:
+            os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}')
 
-            isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}')
+        for LED_ID in LED_IDs:
+            isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}')
             if not isExist:
-                os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}')
-        #TODO
-        #Keep an eye on the file path, it may need to be adjusted
-            file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPE_CHECK_13_6_VSPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
-            file_ = pd.read_csv(file, delimiter=',', header=0, skiprows=1)
-            file_ = np.array(file_)
-            times = file_[:,0]
-
-            index_0 = np.where(times == t0)[-1]
-            index_f = np.where(times == t1)[0]
-
-            #first element ≥ t0 − tol
-            index_0  = np.searchsorted(times, t0 - tol, side='left')
-
-            #first element  > t1 + tol  → subtract 1 to get the last ≤ t1
-            index_f  = np.searchsorted(times, t1 + tol, side='right') - 1
-
-            times = times[index_0:index_f+1]
-
-
-            for i in range(1,100):
-                plt.figure(figsize = (8,6))
-                voltages = file_[:,i]
-                voltages = voltages[index_0:index_f+1]
-
-                #plt.plot(times, voltages,'o',markersize=3)
-                plt.plot(times, voltages,'-')
-
-                plt.xlabel('Time (s)')
-                plt.ylabel('Voltage (V)')
-                plt.title(f'PMT {PMT_ID} at {set_voltage} V\n LED {LED_ID}')
-                plt.savefig(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}/{i}.png')
-                plt.close()
-
-
-
+                os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}')
+            #TODO
+            #t0 is the time at which the PMT pulse starts, and t1 is the time point when the pulse ends. 
+
+            t0, t1   = 0, 1.5e-7
+
+            if LED_ID =="308":
+                t1 = 3.5e-7
+            #TODO
+            #Do not forget to change the voltage range and step as needed
+            for set_voltage in range(1300,1350,100):
+
+                isExist = os.path.exists(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}')
+                if not isExist:
+                    os.makedirs(f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}')
+            #TODO
+            #Keep an eye on the file path, it may need to be adjusted
+                file = f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/SPE_CHECK_13_6_VSPEdataTest_{PMT_ID}-{set_voltage}V_L-{LED_ID}_LASER-ON_CH1.csv'
+                #only the first max_waveforms waveforms are drawn, and only their samples between t0 and t1
+                render_run(file, t0, t1, f'/home/aovelencio/PMTTesting/SPE_PMT_data/{date}/{PMT_ID}/{LED_ID}/{set_voltage}',
+                           mode=mode, num_workers=num_workers, max_waveforms=max_waveforms,
+                           title=f'PMT {PMT_ID} at {set_voltage} V\n LED {LED_ID}')
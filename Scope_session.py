@@ -0,0 +1,715 @@
+import numpy as np
+import time
+from datetime import datetime
+
+
+"""
+This is a reusable connection to the oscilloscope, shared by TakingSPEData.py and TakingDataScope.py.
+
+Before, every waveform re-sent the whole transfer setup (DAT:ENC, DAT:WID, DAT:STAR, DAT:STOP, DATA:SOURCE)
+and re-read WFMOutpre?, HOR:SCA?, HORizontal:DELay:TIMe? and HORIZONTAL:POSITION?, which is about a dozen
+network round trips per waveform. The session configures the transfer once, keeps the parsed scaling
+information, and only re-reads it when the scope settings change, so the steady state is one CURV? per waveform.
+
+A settings change is noticed in three ways:
+    - a command sent through session.write() that changes the scope setup (anything that is not a pure
+      acquisition/trigger-arming command) drops the cached scaling information
+    - CURV? returns a different number of points than the cached record
+    - every recheck_every CURV? reads WFMOutpre? is compared to the cached preamble (it carries XZEro, so
+      changes of the horizontal delay and position show up there too). Set recheck_every=0 to turn this off.
+
+The session can also use the FastFrame (segmented memory) mode of the scope with collect_fastframe():
+the scope captures N triggered frames into its own memory, and the whole batch comes back in a single
+CURV? transfer together with the per-frame trigger timestamps.
+
+To know when a triggered acquisition is ready to be read, arm() the scope and then wait_for_acquisition().
+It waits without flooding the scope with ACQ:STATE? queries, using (wait_method):
+    - 'opc': a single *OPC? that the scope only answers once the acquisition sequence is complete
+    - 'srq': *OPC plus a service request (SRQ) event from the scope, when the VISA backend supports events
+    - 'poll': ACQ:STATE? polling with an adaptive backoff (sleep through most of a typical wait, then poll
+      more and more slowly), used automatically if the other two are not supported
+That is three round trips per waveform (ACQ:STATE RUN, *OPC? and CURV?). acquire_raw() sends the three as one
+message, ACQuire:STATE RUN;*WAI;:CURVe?, where *WAI holds the CURV? until the single sequence is complete, so a
+waveform costs a single round trip (1.01 per waveform over 1000 waveforms of the simulator, the extra ones are
+the preamble reads); the wait and the transfer of that message can't be told apart and both count as live time.
+The wait time of every acquisition and the latency from the end of the wait to the end of the readout are
+recorded, so a run can report its real live time (scope armed, waiting for a trigger) and dead time.
+Every write, query and binary read is also timed, per command, together with the bytes read back
+(see command_stats, and Acquisition_telemetry.py to stream these to a metrics file during the run).
+
+With roi=(t_start, t_stop) in s the session only transfers the samples of that region of interest (e.g. the
+baseline and integration windows of the analysis) instead of the first data_length samples: the window is turned
+into sample indices from xincr, HORIZONTAL:POSITION and HORizontal:DELay:TIMe, sent as DAT:STAR/DAT:STOP, and the
+index of the first transferred sample ('first_sample') and the full record length are kept in scal_info, so
+time_axis() gives the exact time of every transferred sample.
+
+collect_channels() reads several channels (CH1-CH4, MATH, REF) of the same acquisition: one CURV? per channel,
+switching DATA:SOURCE in between, with the scaling information of every channel cached separately.
+The AUX input of the scope is a trigger input only, it has no waveform that can be read back; to keep the
+trigger (or an LED monitor) in the record, feed it to a spare channel as well.
+"""
+
+
+#commands that do not change the waveform scaling, so they do not drop the cached preamble
+NON_SETTING_COMMANDS = ('ACQ:STATE', 'ACQUIRE:STATE', 'ACQ:STOPA', 'ACQUIRE:STOPA', 'TRIG', '*')
+
+#arm, wait for the single sequence and read the waveform back, in one message (see acquire_raw())
+ACQUIRE_AND_READ = 'ACQuire:STATE RUN;*WAI;:CURVe?'
+
+
+def time_axis(scal_info, num_points):
+    '''
+    Time of every sample of a transferred waveform, from the scope settings. For a region of interest readout
+    scal_info has the index of the first transferred sample and the length of the whole record.
+
+    input:
+        scal_info: dictionary with scope scaling details
+        num_points: int of samples transferred
+    output:
+        1D np.array of the sample times in s
+    '''
+    first = scal_info.get('first_sample', 0)
+    record_length = scal_info.get('record_length', num_points)
+    i = np.arange(first, first + num_points)
+    return (i-(record_length*(scal_info['HPos']/100)))* scal_info['xincr'] + scal_info['HDelay']
+
+
+def convertToWave(datac, scal_info):
+    """
+    Converts raw data that is output by query_binary_values to the corrected
+    time and voltage steps, and returns them as a 2D np.array. This requires the
+    scaling information from the scope, read in through the dictionary scal_info.
+
+    input:
+        datac: 1D array that is the output from query_binary_values()
+        scal_info: dictionary with scope scaling details
+    output:
+        2D np.array of the converted data: [[time in s,] [voltages in V]]
+    """
+
+    datac = np.asarray(datac, dtype=np.float64)
+    x = time_axis(scal_info, len(datac))
+    y = ((datac-scal_info['yoff']) * scal_info['ymult']) + scal_info['yzero']
+
+    return np.array([x,y])
+
+
+def convertFrames(frames, scal_info):
+    """
+    Converts a 2D array of raw FastFrame frames (one frame per row) to a list of waveforms
+    like the ones returned by convertToWave. Every frame shares the same time axis, so it is only computed once.
+
+    input:
+        frames: 2D array of raw 8-bit samples, one row per frame
+        scal_info: dictionary with scope scaling details
+    output:
+        list of 2D np.arrays of the converted data: [[time in s,] [voltages in V]], one per frame
+    """
+
+    times = convertToWave(frames[0], scal_info)[0]
+    voltages = ((np.asarray(frames, dtype=np.float64) - scal_info['yoff']) * scal_info['ymult']) + scal_info['yzero']
+
+    return [np.array([times, v]) for v in voltages]
+
+
+def parse_timestamps(reply):
+    '''
+    Parse the reply of HORizontal:FASTframe:TIMEStamp:ALL? into trigger times relative to the first frame.
+    The scope returns one quoted string per frame, e.g. "02 Mar 2025 16:24:17.123 456 789 012",
+    where the fraction of the second is split in groups of 3 digits.
+
+    input:
+        reply: str reply of the timestamp query
+    output:
+        1D np.array of the frame trigger times in s, relative to the first frame
+    '''
+
+    stamps = [stamp.strip().strip('"') for stamp in reply.split('","')]
+    seconds = []
+    fractions = []
+    for stamp in stamps:
+        stamp = stamp.strip('"')
+        whole, fraction = stamp.split('.', 1)
+        seconds.append(datetime.strptime(whole.strip(), '%d %b %Y %H:%M:%S').timestamp())
+        fractions.append(float('0.' + fraction.replace(' ', '')))
+
+    #keep the whole seconds and the fractions apart until the end so the sub-ns digits are not lost
+    seconds = np.array(seconds) - seconds[0]
+    fractions = np.array(fractions) - fractions[0]
+
+    return seconds + fractions
+
+
+def parse_preamble(info):
+    '''
+    Parse the reply of WFMOutpre? into the scaling information used by convertToWave,
+    plus the extra fields TakingDataScope.py writes in its CSV header
+
+    input:
+        info: str reply of WFMOutpre?
+    output:
+        dictionary with the scaling and header details
+    '''
+
+    info = info.split(",")
+    infoSplit = info[-1].split(";")
+
+    return {
+        'xincr': float(infoSplit[5]),
+        #Vertical scale multiplying factor
+        'ymult': float(infoSplit[9]),
+        #Vertical position of the source waveform in digitizing levels
+        'yoff': float(infoSplit[10]),
+        'yzero': float(infoSplit[11]),
+        'VerticalScale': info[2] if len(info) > 2 else 'NA',
+        'VerticalPos': info[3] if len(info) > 3 else 'NA',
+        'Vunits': infoSplit[8],
+        'Hunits': infoSplit[4],
+        'waveType': infoSplit[13] if len(infoSplit) > 13 else 'NA',
+        'pointsFormat': infoSplit[2],
+    }
+
+
+class ScopeSession:
+    '''
+    Wraps the pyvisa resource of the oscilloscope: configures the waveform transfer once,
+    caches the scaling information and counts the round trips to the scope.
+
+    input:
+        oscilloscope: object holding the connection to the oscilloscope to read from
+        channel_id: str of the channel to read out, e.g. 'CH1'
+        data_length: int of how many datapoints to collect in each waveform, limited by the record length set on the scope
+        recheck_every: int, compare WFMOutpre? to the cached preamble every this many CURV? reads (0 to never check)
+        wait_method: 'opc', 'srq' or 'poll', how wait_for_acquisition() finds out the acquisition is complete
+        roi: (t_start, t_stop) in s of the only samples to transfer, None to transfer the first data_length samples
+    '''
+
+    def __init__(self, oscilloscope, channel_id='CH1', data_length=1000, recheck_every=1000, wait_method='opc',
+                 roi=None):
+        self.scope = oscilloscope
+        self.channel_id = channel_id
+        self.data_length = data_length
+        self.recheck_every = recheck_every
+        self.wait_method = wait_method
+        self.roi = roi
+        self.first_sample = 0       #index in the record of the first transferred sample
+        self.record_length = None   #length of the whole record, only read for a region of interest
+
+        self.scal_info = None       #cached scaling information, None until read
+        self.preamble = None        #raw WFMOutpre? string the cache was built from
+        self.configured = False     #True once the DAT:* transfer setup has been sent
+        self.roi_changed = False    #True when the horizontal settings changed and the region of interest must be resent
+        self.num_frames = 0         #FastFrame count set on the scope, 0 when FastFrame is off
+        self.source = channel_id    #channel DATA:SOURCE is set to
+        self.channel_cache = {}     #(preamble, scal_info) of the other channels, keyed by channel
+        self.reads = {}             #CURV? reads since the preamble was read, keyed by channel
+
+        self.round_trips = 0        #every write, query and binary read sent to the scope
+        self.num_waveforms = 0      #waveforms read through this session
+        self.preamble_reads = 0     #how many times the scaling information was (re)read
+        self.command_stats = {}     #[count, total s, max s] of every command header, e.g. 'CURV?'
+        self.bytes_read = 0         #bytes of all the replies read back from the scope
+
+        self.run_start = None       #time of the first arm()
+        self.armed_at = None        #time of the last arm()
+        self.acquired_at = None     #time the last wait ended, until its waveform has been read
+        self.wait_times = []        #s from arm() to the end of the wait, for every acquisition
+        self.readout_latencies = [] #s from the end of the wait to the end of the readout, for every acquisition
+        self.srq_enabled = False
+
+    ################# counted access to the scope #####################
+
+    def _timed(self, send, command, **kwargs):
+        '''
+        Send command with send (a method of the pyvisa resource), counting it as a round trip and timing it
+
+        output:
+            the reply of send
+        '''
+        self.round_trips += 1
+        t_0 = time.perf_counter()
+        reply = send(command, **kwargs)
+        elapsed = time.perf_counter() - t_0
+
+        #a chain of commands is kept whole, it is not the same as its first command
+        header = command if ';' in command else command.split(' ', 1)[0]
+        stats = self.command_stats.setdefault(header, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if isinstance(reply, str):
+            self.bytes_read += len(reply)
+        elif 'datatype' in kwargs:
+            #samples as sent by the scope, whatever type the container holds them in
+            self.bytes_read += len(reply) * np.dtype(kwargs['datatype']).itemsize
+
+        return reply
+
+    def write(self, command):
+        if not command.upper().startswith(NON_SETTING_COMMANDS):
+            self.invalidate()
+        return self._timed(self.scope.write, command)
+
+    def query(self, command):
+        return self._timed(self.scope.query, command)
+
+    def query_binary_values(self, command, **kwargs):
+        return self._timed(self.scope.query_binary_values, command, **kwargs)
+
+    def close(self):
+        self.scope.close()
+
+    ################# cached transfer setup and scaling #####################
+
+    def invalidate(self):
+        '''
+        Drop the cached transfer setup and scaling information, they are sent/read again before the next waveform
+        '''
+        self.configured = False
+        self.scal_info = None
+        self.preamble = None
+        self.num_frames = 0
+        self.channel_cache = {}
+
+    def configure_transfer(self):
+        '''
+        Send the waveform transfer setup to the scope, only needed once per session (or after a settings change)
+        '''
+        self._timed(self.scope.write, 'DAT:ENC RPB')  #set data encoding to binary
+        self._timed(self.scope.write, 'DAT:WID 1')    #set data width to 1 byte
+        if self.roi is None:
+            self._timed(self.scope.write, 'DAT:STAR 1')   #set start of data to first byte
+            self._timed(self.scope.write, f'DAT:STOP {self.data_length}') #set end of data to the last byte wanted
+        else:
+            self.configure_roi()
+        self._timed(self.scope.write, f'DATA:SOURCE {self.channel_id}') #change channel source being used
+        self.configured = True
+        self.source = self.channel_id
+
+    def configure_roi(self):
+        '''
+        Send the samples of the region of interest to the scope, again after every change of the horizontal settings
+        '''
+        start, stop = self.roi_samples()
+        self._timed(self.scope.write, f'DAT:STAR {start + 1}')  #DAT:STAR and DAT:STOP count from 1
+        self._timed(self.scope.write, f'DAT:STOP {stop + 1}')
+        self.roi_changed = False
+
+        #a new dictionary, the waveforms already returned keep the first sample they were transferred from
+        if self.scal_info is not None:
+            self.scal_info = dict(self.scal_info, first_sample=self.first_sample, record_length=self.record_length)
+
+    def roi_samples(self):
+        '''
+        Turn the region of interest into the indices of its first and last sample in the record,
+        with the same time axis as time_axis()
+
+        output:
+            int of the first and last sample index (from 0), inclusive
+        '''
+        xincr = float(self.query('WFMOutpre:XINcr?'))
+        HPos = float(self.query('HORIZONTAL:POSITION?'))
+        HDelay = float(self.query('HORizontal:DELay:TIMe?'))
+        self.record_length = int(float(self.query('HORizontal:RECOrdlength?')))
+
+        trigger_sample = self.record_length * HPos / 100
+        start = int(np.floor((self.roi[0] - HDelay) / xincr + trigger_sample + 1e-6))
+        stop = int(np.ceil((self.roi[1] - HDelay) / xincr + trigger_sample - 1e-6))
+        start, stop = max(start, 0), min(stop, self.record_length - 1)
+        if stop < start:
+            raise ValueError(f'the region of interest {self.roi} s is not inside the record')
+
+        self.first_sample = start
+        return start, stop
+
+    def select_source(self, channel):
+        '''
+        Switch DATA:SOURCE to another channel, keeping the cached scaling information of every channel
+
+        input:
+            channel: str of the channel to read out next, e.g. 'CH2'
+        '''
+        if not self.configured:
+            self.configure_transfer()
+        if channel == self.source:
+            return
+
+        self.channel_cache[self.source] = (self.preamble, self.scal_info)
+        self._timed(self.scope.write, f'DATA:SOURCE {channel}')
+        self.source = channel
+        self.preamble, self.scal_info = self.channel_cache.pop(channel, (None, None))
+
+    def configure_fastframe(self, num_frames):
+        '''
+        Turn on FastFrame with num_frames frames per acquisition, and set the transfer to return all of them.
+        Only sent when the number of frames changes.
+
+        input:
+            num_frames: int of triggered frames the scope captures into its memory per acquisition
+        '''
+        if not self.configured:
+            self.configure_transfer()
+
+        self._timed(self.scope.write, 'HORizontal:FASTframe:STATE ON')
+        self._timed(self.scope.write, f'HORizontal:FASTframe:COUNt {num_frames}')
+        self._timed(self.scope.write, 'ACQuire:STOPAfter SEQuence') #one sequence fills all the frames
+        self._timed(self.scope.write, 'DATa:FRAMESTARt 1')
+        self._timed(self.scope.write, f'DATa:FRAMESTOP {num_frames}')
+        self.num_frames = num_frames
+
+    ################# waiting for triggers #####################
+
+    def arm(self):
+        '''
+        Start a new acquisition (ACQuire:STATE RUN), wait_for_acquisition() then waits for it to be complete
+        '''
+        self.write('ACQuire:STATE RUN')
+        self.armed_at = time.time()
+        if self.run_start is None:
+            self.run_start = self.armed_at
+
+    def wait_for_acquisition(self, timeout=60):
+        '''
+        Wait until the acquisition started by arm() is complete, using wait_method
+        (falling back to 'poll' if the scope or the VISA backend does not support it)
+
+        input:
+            timeout: float of how long to wait in s before giving up
+        output:
+            True if the acquisition is complete, False if the timeout was reached
+        '''
+        if self.armed_at is None:
+            self.arm()
+        deadline = time.time() + timeout
+
+        done = None
+        if self.wait_method == 'srq':
+            done = self._wait_srq(deadline)
+        if self.wait_method == 'opc':
+            done = self._wait_opc(deadline)
+        if done is None:
+            #not supported, don't try again
+            self.wait_method = 'poll'
+            done = self._wait_poll(deadline)
+
+        if done:
+            self.acquired_at = time.time()
+            self.wait_times.append(self.acquired_at - self.armed_at)
+        self.armed_at = None
+
+        return done
+
+    def _wait_opc(self, deadline):
+        '''
+        *OPC? is only answered once the single sequence is complete, so it is one round trip per acquisition
+
+        output:
+            True if complete, False on timeout, None if *OPC? can't be used
+        '''
+        old_timeout = getattr(self.scope, 'timeout', None)
+        try:
+            if old_timeout is not None:
+                #the VISA timeout (in ms) has to cover the whole wait
+                self.scope.timeout = max(deadline - time.time(), 0.001) * 1000
+            return self.query('*OPC?').strip() == '1'
+        except Exception as error:
+            if 'TMO' in str(error) or 'timeout' in str(error).lower():
+                #the scope still answers *OPC? later, clear it so the reply doesn't end up in the next query
+                if hasattr(self.scope, 'clear'):
+                    self.scope.clear()
+                return False
+            return None
+        finally:
+            if old_timeout is not None:
+                self.scope.timeout = old_timeout
+
+    def _wait_srq(self, deadline):
+        '''
+        The scope sets the OPC bit when the acquisition is complete, which raises a service request (SRQ)
+
+        output:
+            True if complete, False on timeout, None if SRQ events can't be used
+        '''
+        try:
+            from pyvisa import constants
+
+            if not self.srq_enabled:
+                self.write('*ESE 1')     #the OPC bit sets the event status bit
+                self.write('*SRE 32')    #and the event status bit requests service
+                self.scope.enable_event(constants.EventType.service_request, constants.EventMechanism.queue)
+                self.srq_enabled = True
+
+            self.write('*CLS')
+            self.write('*OPC')
+            self.scope.wait_on_event(constants.EventType.service_request, max(deadline - time.time(), 0.001) * 1000)
+            self.query('*ESR?')  #reading the event status register clears it for the next acquisition
+            return True
+        except Exception as error:
+            if self.srq_enabled and ('TMO' in str(error) or 'timeout' in str(error).lower()):
+                return False
+            #no events on this backend or scope, use *OPC? from now on
+            self.wait_method = 'opc'
+            return None
+
+    def _wait_poll(self, deadline, min_poll=0.0005, max_poll=0.02):
+        '''
+        Poll ACQ:STATE? until the acquisition stops, first sleeping through most of a typical wait,
+        then polling with a doubling interval between min_poll and max_poll (in s)
+
+        output:
+            True if complete, False on timeout
+        '''
+        if self.wait_times:
+            #the shortest recent wait, as the longer ones include the time lost between polls
+            typical_wait = np.min(self.wait_times[-20:])
+            time.sleep(max(min(0.8 * typical_wait - (time.time() - self.armed_at), deadline - time.time()), 0))
+            max_poll = max(min(max_poll, typical_wait / 4), min_poll)
+
+        poll = min_poll
+        while True:
+            #returns 1 if in acquiring mode, 0 if stopped
+            if int(self.query('ACQ:STATE?')) == 0:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(poll, max(deadline - time.time(), 0)))
+            poll = min(2 * poll, max_poll)
+
+    def read_preamble(self, info=None):
+        '''
+        Read and cache the scaling information needed by convertToWave
+
+        input:
+            info: str reply of WFMOutpre? if it was already queried, otherwise it is queried here
+        output:
+            dictionary with scope scaling details
+        '''
+        if info is None:
+            info = self.query('WFMOutpre?')
+
+        scal_info = parse_preamble(info)
+        scal_info['Hscale'] = float(self.query('HOR:SCA?'))
+        scal_info['HDelay'] = float(self.query('HORizontal:DELay:TIMe?'))
+        scal_info['HPos'] = float(self.query('HORIZONTAL:POSITION?'))
+        if self.roi is not None:
+            scal_info['first_sample'] = self.first_sample
+            scal_info['record_length'] = self.record_length
+
+        self.preamble = info
+        self.scal_info = scal_info
+        self.preamble_reads += 1
+        self.reads[self.source] = 0
+
+        return scal_info
+
+    def check_settings(self):
+        '''
+        Compare WFMOutpre? to the cached preamble and re-read the scaling information if the scope settings changed
+
+        output:
+            True if the settings changed
+        '''
+        info = self.query('WFMOutpre?')
+        if info == self.preamble:
+            return False
+
+        self.read_preamble(info)
+        if self.roi is not None:
+            #the waveform just read was still transferred from the old samples, the next one from the new ones.
+            #The horizontal settings are shared by all the channels, so theirs are read again too
+            self.roi_changed = True
+            self.channel_cache = {}
+        return True
+
+    ################# reading waveforms #####################
+
+    def collect_raw(self, num_frames=1, count=True, acquire=False):
+        '''
+        Read one raw waveform (or one FastFrame batch) from the scope, configuring the transfer and
+        reading the scaling information only when needed
+
+        input:
+            num_frames: int of frames returned by CURV?, more than 1 only in FastFrame mode
+            count: if False the waveform is not counted, for the extra channels of the same acquisition
+            acquire: if True the scope is armed and waited for in the same message as the CURV? (ACQUIRE_AND_READ)
+        output:
+            raw_waveform_data: 1D np.array of the raw 8-bit samples, all frames one after the other
+            scal_info: dictionary with scope scaling details for this waveform
+        '''
+        if not self.configured:
+            self.configure_transfer()
+        elif self.roi_changed:
+            self.configure_roi()
+
+        if acquire:
+            self.armed_at = time.time()
+            if self.run_start is None:
+                self.run_start = self.armed_at
+            raw_waveform_data = self.query_binary_values(ACQUIRE_AND_READ, datatype='B', container=np.array)
+            self.wait_times.append(time.time() - self.armed_at)
+            self.armed_at = None
+        else:
+            raw_waveform_data = self.query_binary_values('CURV?', datatype='B', container=np.array)
+        num_points = len(raw_waveform_data) // num_frames
+
+        if self.acquired_at is not None:
+            self.readout_latencies.append(time.time() - self.acquired_at)
+            self.acquired_at = None
+
+        if self.scal_info is None:
+            self.read_preamble()
+        elif self.recheck_every and self.reads[self.source] >= self.recheck_every:
+            self.check_settings()
+            self.reads[self.source] = 0
+        self.reads[self.source] += 1
+
+        #a different record length means the scope was changed behind our back
+        if self.scal_info.get('num_points', num_points) != num_points:
+            self.read_preamble()
+        self.scal_info['num_points'] = num_points
+
+        if count:
+            self.num_waveforms += num_frames
+
+        return raw_waveform_data, self.scal_info
+
+    def acquire_raw(self, timeout=60):
+        '''
+        Arm the scope, wait for the trigger and read the raw waveform back in a single round trip
+        (ACQUIRE_AND_READ), instead of arm(), wait_for_acquisition() and collect_raw()
+
+        input:
+            timeout: float of how long to wait for the trigger in s
+        output:
+            raw_waveform_data: 1D np.array of the raw 8-bit samples, None if there was no trigger within timeout
+            scal_info: dictionary with scope scaling details for this waveform, None if there was no trigger
+        '''
+        old_timeout = getattr(self.scope, 'timeout', None)
+        try:
+            if old_timeout is not None:
+                #the VISA timeout (in ms) has to cover the wait on top of the transfer
+                self.scope.timeout = timeout * 1000 + old_timeout
+            return self.collect_raw(acquire=True)
+        except Exception as error:
+            if 'TMO' not in str(error) and 'timeout' not in str(error).lower():
+                raise
+            #the scope still sends the waveform later, clear it so it doesn't end up in the next query
+            if hasattr(self.scope, 'clear'):
+                self.scope.clear()
+            self.armed_at = None
+            return None, None
+        finally:
+            if old_timeout is not None:
+                self.scope.timeout = old_timeout
+
+    def collect_channels(self, channels):
+        '''
+        Read several channels of the same acquisition, one CURV? per channel. All channels share the
+        time axis of the acquisition, only the vertical scaling differs.
+
+        input:
+            channels: list of str of the channels to read out, e.g. ['CH1', 'CH2']
+        output:
+            dictionary of channel: (raw_waveform_data, scal_info), in the order of channels
+        '''
+        records = {}
+        for i, channel in enumerate(channels):
+            self.select_source(channel)
+            #the acquisition is only counted once, whatever the number of channels
+            records[channel] = self.collect_raw(count=(i == 0))
+
+        return records
+
+    def collect_waveform(self):
+        '''
+        Collect and return a converted waveform from the scope using convertToWave
+
+        output:
+            2D converted array of scope data: [[time in s,] [voltages in V]]
+        '''
+        raw_waveform_data, scal_info = self.collect_raw()
+
+        #convert to [time [s], voltage [V]] using the scope settings
+        return convertToWave(raw_waveform_data, scal_info)
+
+    def collect_fastframe_raw(self, num_frames, timeout=60):
+        '''
+        Capture num_frames triggered frames into the FastFrame memory of the scope and read them back
+        in a single binary transfer, without converting them
+
+        input:
+            num_frames: int of triggered frames to capture in this batch
+            timeout: float of how long to wait for the frames to be captured in s
+        output:
+            frames: 2D np.array of the raw 8-bit samples, one row per frame
+            scal_info: dictionary with scope scaling details for these frames
+            timestamps: 1D np.array of the frame trigger times in s, relative to the first frame
+        '''
+        if self.num_frames != num_frames:
+            self.configure_fastframe(num_frames)
+
+        self.arm()
+        if not self.wait_for_acquisition(timeout):
+            raise TimeoutError(f'FastFrame batch of {num_frames} frames not captured within {timeout} s')
+
+        raw_waveform_data, scal_info = self.collect_raw(num_frames)
+        frames = raw_waveform_data.reshape(num_frames, -1)
+
+        timestamps = parse_timestamps(self.query(f'HORizontal:FASTframe:TIMEStamp:ALL:{self.channel_id}? 1,{num_frames}'))
+
+        return frames, scal_info, timestamps
+
+    def collect_fastframe(self, num_frames, timeout=60):
+        '''
+        Capture num_frames triggered frames with collect_fastframe_raw and split them into converted waveforms
+
+        input:
+            num_frames: int of triggered frames to capture in this batch
+            timeout: float of how long to wait for the frames to be captured in s
+        output:
+            waveforms: list of 2D converted arrays of scope data: [[time in s,] [voltages in V]], one per frame
+            timestamps: 1D np.array of the frame trigger times in s, relative to the first frame
+        '''
+        frames, scal_info, timestamps = self.collect_fastframe_raw(num_frames, timeout)
+
+        return convertFrames(frames, scal_info), timestamps
+
+    ################# reporting #####################
+
+    def round_trips_per_waveform(self):
+        if self.num_waveforms == 0:
+            return 0.0
+        return self.round_trips / self.num_waveforms
+
+    def live_time(self):
+        '''
+        output:
+            float of the time in s the scope was armed and waiting for triggers
+        '''
+        return float(np.sum(self.wait_times))
+
+    def dead_time(self):
+        '''
+        output:
+            float of the time in s since the first arm() that the scope was not waiting for triggers
+            (reading out, converting, our own Python)
+        '''
+        if self.run_start is None:
+            return 0.0
+        return time.time() - self.run_start - self.live_time()
+
+    def report(self):
+        '''
+        Print how many round trips to the scope were needed per waveform, and the live and dead time of the run
+        '''
+        print(f'{self.num_waveforms} waveforms, {self.round_trips} round trips to the scope '
+              f'({self.round_trips_per_waveform():.2f} per waveform, preamble read {self.preamble_reads} times)')
+
+        if self.wait_times:
+            live, dead = self.live_time(), self.dead_time()
+            print(f'live time {live:.3f} s, dead time {dead:.3f} s ({100 * dead / (live + dead):.1f}% dead), '
+                  f'waiting with {self.wait_method}: mean wait {1e3 * np.mean(self.wait_times):.2f} ms', end='')
+            if self.readout_latencies:
+                print(f', mean wait-to-readout latency {1e3 * np.mean(self.readout_latencies):.2f} ms')
+            else:
+                print()
@@ -0,0 +1,492 @@
+import numpy as np
+import time
+import socketserver
+import threading
+from datetime import datetime
+
+
+"""
+This is a stand-in for the oscilloscope, so the acquisition scripts can be run, benchmarked and checked
+for throughput regressions without the scope at TCPIP::142.90.115.154.
+
+SimulatedScope answers the subset of SCPI commands that TakingDataScope.py, TakingSPEData.py and
+Scope_session.py use (*IDN?, *OPC?, *WAI, ACQ:STATE, ACQ:STOPAfter, TRIGGER:STATE?, the trigger setup, DAT:*,
+WFMOutpre?, CURV?, the horizontal queries and FastFrame) and makes up realistic PMT pulses: a Poisson number
+of photoelectrons per LED flash, each with a gain spread, on top of a noisy baseline, digitized to 8 bits.
+CH1 has the PMT pulses, every other channel shows an LED monitor pulse of the same flash.
+The trigger rate, record length and the time every message takes are all settings. Like on the scope, a message
+can chain several commands with ';' (e.g. ACQuire:STATE RUN;*WAI;:CURVe?) and then only costs one round trip.
+
+It can be used in two ways:
+    - in the same process: SimulatedResourceManager().open_resource(...) gives a SimulatedScope in place of
+      visa.ResourceManager('@py').open_resource(...), set use_simulator = True in the acquisition scripts
+    - over the network: serve(SimulatedScope(), port=4000) and open 'TCPIP::127.0.0.1::4000::SOCKET' with
+      pyvisa (set read_termination = write_termination = '\\n' on that resource), so the VISA layer is included
+
+Running this file measures the waveforms per second of every acquisition mode on the simulated scope.
+"""
+
+
+#long forms of the SCPI keywords used by the scripts, everything is matched on its short form
+_SHORT_FORMS = {
+    'ACQUIRE': 'ACQ', 'STOPAFTER': 'STOPA', 'TRIGGER': 'TRIG', 'TYPE': 'TYP', 'SOURCE': 'SOU', 'SLOPE': 'SLO',
+    'LEVEL': 'LEV', 'AUXIN': 'AUX', 'EXTERNAL': 'EXT', 'PROBE': 'PRO', 'DATA': 'DAT', 'ENCDG': 'ENC',
+    'WIDTH': 'WID', 'START': 'STAR', 'CURVE': 'CURV', 'WFMOUTPRE': 'WFMO', 'HORIZONTAL': 'HOR', 'SCALE': 'SCA',
+    'DELAY': 'DEL', 'TIME': 'TIM', 'POSITION': 'POS', 'FASTFRAME': 'FAST', 'COUNT': 'COUN',
+    'TIMESTAMP': 'TIMES', 'FRAMESTART': 'FRAMESTAR', 'RECORDLENGTH': 'RECO', 'XINCR': 'XIN',
+}
+
+
+def short_form(header):
+    '''
+    Reduce a SCPI command header to its short form, e.g. 'HORizontal:DELay:TIMe?' -> 'HOR:DEL:TIM?'
+
+    input:
+        header: str of the command header (without its arguments)
+    output:
+        str of the upper case short form
+    '''
+    tokens = []
+    for token in header.split(':'):
+        query = token.endswith('?')
+        token = token.rstrip('?')
+        if token != token.upper():
+            #mixed case, the upper case start is the short form
+            short = ''
+            for ch in token:
+                if ch.islower():
+                    break
+                short += ch
+            token = short
+        token = _SHORT_FORMS.get(token, token)
+        tokens.append(token + ('?' if query else ''))
+    return ':'.join(tokens)
+
+
+def commands(message):
+    '''
+    output:
+        list of the commands of a message, split at ';' and without the leading ':' of a rooted header
+    '''
+    return [command.strip().lstrip(':') for command in message.split(';') if command.strip()]
+
+
+def is_query(command):
+    '''
+    output:
+        True if the command expects a reply
+    '''
+    return command.split(' ', 1)[0].endswith('?')
+
+
+class SimulatedScope:
+    '''
+    Simulated oscilloscope with the same write/query/query_binary_values interface as a pyvisa resource
+
+    input:
+        trigger_rate: float of LED flashes (triggers) per second
+        record_length: int of samples in a waveform
+        latency: float of how long every message takes in s (the network round trip plus the scope)
+        bandwidth: float of bytes/s of the binary transfers of CURV?
+        xincr: float of the sample interval in s
+        mean_pe: float of the mean number of photoelectrons per flash
+        gain: float of the PMT gain (electrons per photoelectron)
+        gain_spread: float of the relative sigma of the charge of a single photoelectron
+        noise: float of the sigma of the baseline noise in V
+        pulse_time: float of the time of the pulse after the trigger in s
+        periodic: if True the flashes are evenly spaced (function generator), otherwise random in time
+        seed: int seed of the random numbers, so runs can be repeated
+    '''
+
+    def __init__(self, trigger_rate=1000.0, record_length=1000, latency=0.5e-3, bandwidth=10e6, xincr=4e-10,
+                 mean_pe=1.0, gain=1e7, gain_spread=0.3, noise=1e-3, pulse_time=6e-8, periodic=True, seed=0):
+        self.trigger_rate = trigger_rate
+        self.record_length = record_length
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mean_pe = mean_pe
+        self.gain = gain
+        self.gain_spread = gain_spread
+        self.noise = noise
+        self.pulse_time = pulse_time
+        self.periodic = periodic
+        self.rng = np.random.default_rng(seed)
+
+        #scope settings, as returned by the queries
+        self.settings = {
+            'ACQ:STOPA': 'SEQUENCE', 'TRIG:A:TYP': 'EDGE', 'TRIG:A:EDGE:SOU': 'CH1', 'TRIG:A:EDGE:SLO': 'FALL',
+            'TRIG:EXT:PRO': '1.0', 'DAT:ENC': 'RPB', 'DAT:WID': '1', 'DAT:STAR': '1', 'DAT:STOP': str(record_length),
+            'DAT:SOU': 'CH1', 'DAT:FRAMESTAR': '1', 'DAT:FRAMESTOP': '1', 'HOR:FAST:STATE': '0', 'HOR:FAST:COUN': '1',
+        }
+        self.levels = {}           #trigger levels, keyed by source
+        self.xincr = xincr
+        self.HPos = 10.0           #horizontal position in % of the record
+        self.HDelay = 0.0          #horizontal delay in s
+        self.ymult = 2e-3          #V per digitizing level
+        self.yoff = 160.0          #digitizing level of 0 V, leaves more room for the negative PMT pulses
+        self.yzero = 0.0
+
+        self.t_start = time.time()
+        self.armed_at = None       #time of the last ACQ:STATE RUN, None when stopped
+        self.armed_triggers = None
+        self.frames = np.full((1, record_length), int(self.yoff), dtype=np.uint8)  #last acquired frames
+        self.monitor_frames = self.frames
+        self.trigger_times = np.zeros(1)
+
+        self.num_commands = 0
+        self.num_triggers = 0
+
+    ################# pyvisa resource interface #####################
+
+    def write(self, command):
+        self._message(command)
+
+    def query(self, command):
+        return self._message(command) + '\n'
+
+    def query_binary_values(self, command, datatype='B', container=list, **kwargs):
+        data = self._message(command)
+        return container(data)
+
+    def read_raw(self):
+        return b''
+
+    def close(self):
+        pass
+
+    ################# acquisitions #####################
+
+    def _next_triggers(self, after, count):
+        '''
+        Times of the next count triggers after the time after
+        '''
+        if self.periodic:
+            period = 1.0 / self.trigger_rate
+            first = np.ceil((after - self.t_start) / period) * period + self.t_start
+            return first + period * np.arange(count)
+        return after + np.cumsum(self.rng.exponential(1.0 / self.trigger_rate, count))
+
+    def _frames_per_acquisition(self):
+        if self.settings['HOR:FAST:STATE'] in ('1', 'ON'):
+            return int(self.settings['HOR:FAST:COUN'])
+        return 1
+
+    def _acquisition_done_at(self):
+        '''
+        Time at which the acquisition armed by the last ACQ:STATE RUN is complete, None when not armed
+        '''
+        if self.armed_at is None:
+            return None
+        return self.armed_triggers[-1]
+
+    def _update(self):
+        '''
+        Move the simulation forward to now: in SEQuence mode the armed acquisition completes at the
+        trigger that fills its last frame, in RUNSTop mode the scope keeps acquiring every trigger
+        '''
+        if self.armed_at is None:
+            return
+        now = time.time()
+        done_at = self._acquisition_done_at()
+        if self.settings['ACQ:STOPA'].startswith('SEQ'):
+            if now >= done_at:
+                self._acquire(self.armed_triggers)
+                self.armed_at = None
+        elif now >= done_at:
+            #RUNSTop: the displayed waveform is the latest trigger before now
+            self._acquire(self._next_triggers(now - 1.0 / self.trigger_rate, 1)[:1])
+
+    def _acquire(self, trigger_times):
+        self.trigger_times = trigger_times
+        self.frames = self.synthesize(len(trigger_times))
+        self.monitor_frames = self.synthesize_monitor(len(trigger_times))
+        self.num_triggers += len(trigger_times)
+
+    def times(self):
+        '''
+        output:
+            1D np.array of the time of every sample in s
+        '''
+        i = np.arange(self.record_length)
+        return (i - self.record_length * self.HPos / 100) * self.xincr + self.HDelay
+
+    def synthesize(self, num_frames):
+        '''
+        Make up num_frames digitized PMT waveforms
+
+        input:
+            num_frames: int of waveforms to make
+        output:
+            2D np.array of uint8 samples, one row per waveform
+        '''
+        R = 50                    #Resistance in Ohms
+        e = 1.602e-19             #charge of the electron in C
+        tau_rise, tau_fall = 2e-9, 8e-9
+
+        t = self.times() - self.pulse_time
+        shape = np.where(t > 0, np.exp(-np.clip(t, 0, None) / tau_fall) - np.exp(-np.clip(t, 0, None) / tau_rise), 0.0)
+        #normalize so the integral of the pulse divided by R is the charge of the pulse
+        shape *= R / (tau_fall - tau_rise)
+
+        npe = self.rng.poisson(self.mean_pe, num_frames)
+        #the sum of npe photoelectrons with a gaussian gain spread
+        charge = self.gain * e * (npe + self.gain_spread * np.sqrt(npe) * self.rng.standard_normal(num_frames))
+        charge = np.clip(charge, 0, None)
+
+        volts = -charge[:, np.newaxis] * shape[np.newaxis, :]
+        volts += self.noise * self.rng.standard_normal((num_frames, self.record_length))
+
+        return np.clip(np.rint((volts - self.yzero) / self.ymult + self.yoff), 0, 255).astype(np.uint8)
+
+    def synthesize_monitor(self, num_frames):
+        '''
+        Make up num_frames digitized LED monitor waveforms: a short positive pulse just before the PMT pulse
+
+        input:
+            num_frames: int of waveforms to make
+        output:
+            2D np.array of uint8 samples, one row per waveform
+        '''
+        t = self.times() - (self.pulse_time - 1e-8)
+        volts = 0.15 * np.exp(-0.5 * (t / 2e-9)**2)
+        volts = volts[np.newaxis, :] + self.noise * self.rng.standard_normal((num_frames, self.record_length))
+
+        return np.clip(np.rint((volts - self.yzero) / self.ymult + self.yoff), 0, 255).astype(np.uint8)
+
+    ################# SCPI #####################
+
+    def preamble(self):
+        num_points = self.record_length
+        xzero = self.HDelay - num_points * self.HPos / 100 * self.xincr
+        return (f'1;8;BIN;RP;MSB;"Ch1, DC coupling, {self.ymult * 25e3:.1f}mV/div, {self.xincr * num_points / 10 * 1e9:.3f}ns/div, '
+                f'{num_points} points, Sample mode";{num_points};Y;LINEAR;"s";{self.xincr:.4E};{xzero:.4E};0;"V";'
+                f'{self.ymult:.4E};{self.yoff:.4E};{self.yzero:.4E};TIME;ANALOG;0.0E+0;0.0E+0;0.0E+0;1')
+
+    def curve(self):
+        start = max(int(self.settings['DAT:STAR']), 1) - 1
+        stop = min(int(self.settings['DAT:STOP']), self.record_length)
+        frames = self.frames if self.settings['DAT:SOU'] == 'CH1' else self.monitor_frames
+        if self.settings['HOR:FAST:STATE'] in ('1', 'ON'):
+            frames = frames[int(self.settings['DAT:FRAMESTAR']) - 1:int(self.settings['DAT:FRAMESTOP'])]
+        else:
+            frames = frames[-1:]
+        data = np.ascontiguousarray(frames[:, start:stop]).ravel()
+        if self.bandwidth:
+            time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def timestamps(self, first, count):
+        stamps = []
+        for t in self.trigger_times[first - 1:first - 1 + count]:
+            whole = datetime.fromtimestamp(np.floor(t)).strftime('%d %b %Y %H:%M:%S')
+            fraction = f'{t - np.floor(t):.12f}'[2:]
+            stamps.append(f'"{whole}.{fraction[0:3]} {fraction[3:6]} {fraction[6:9]} {fraction[9:12]}"')
+        return ','.join(stamps)
+
+    def _message(self, message):
+        '''
+        Handle a message of one or more commands separated by ';', in one round trip
+
+        output:
+            the reply of the query of the message ('' if it has none, joined by ';' if it has several)
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+
+        replies = [self._handle(command) for command in commands(message)]
+        replies = [reply for command, reply in zip(commands(message), replies) if is_query(command)]
+        if len(replies) == 1:
+            return replies[0]
+        return ';'.join(replies)
+
+    def _wait_for_sequence(self):
+        '''
+        Block until the armed single sequence is complete, like the scope does for *OPC? and *WAI
+        '''
+        done_at = self._acquisition_done_at()
+        if done_at is not None and self.settings['ACQ:STOPA'].startswith('SEQ'):
+            time.sleep(max(done_at - time.time(), 0))
+            self._update()
+
+    def _handle(self, command):
+        self.num_commands += 1
+
+        header, _, argument = command.partition(' ')
+        argument = argument.strip()
+        header = short_form(header)
+        self._update()
+
+        if header == '*IDN?':
+            return 'TEKTRONIX,MSO54,SIMULATED,CF:91.1CT FV:v1.0'
+        if header == '*OPC?':
+            self._wait_for_sequence()
+            return '1'
+        if header == '*WAI':
+            #the commands after it in the message only run once the acquisition is complete
+            self._wait_for_sequence()
+            return ''
+        if header == 'ACQ:STATE':
+            if argument.upper() in ('RUN', 'ON', '1'):
+                self.armed_at = time.time()
+                #the triggers that will fill the frames of this acquisition
+                self.armed_triggers = self._next_triggers(self.armed_at, self._frames_per_acquisition())
+            else:
+                self.armed_at = None
+            return ''
+        if header == 'ACQ:STATE?':
+            return '1' if self.armed_at is not None else '0'
+        if header == 'TRIG:STATE?':
+            if self.armed_at is None:
+                return 'SAV'
+            return 'REA' if self.settings['ACQ:STOPA'].startswith('SEQ') else 'TRIG'
+        if header.startswith('TRIG:A:LEV'):
+            source = header.rstrip('?').split(':')[-1]
+            if header.endswith('?'):
+                return f'{self.levels.get(source, 0.0):.4E}'
+            self.levels[source] = float(argument)
+            return ''
+        if header == 'WFMO?':
+            return self.preamble()
+        if header == 'CURV?':
+            return self.curve()
+        if header == 'WFMO:XIN?':
+            return f'{self.xincr:.4E}'
+        if header == 'HOR:RECO?':
+            return str(self.record_length)
+        if header == 'HOR:SCA?':
+            return f'{self.xincr * self.record_length / 10:.4E}'
+        if header == 'HOR:DEL:TIM':
+            self.HDelay = float(argument)
+            return ''
+        if header == 'HOR:DEL:TIM?':
+            return f'{self.HDelay:.4E}'
+        if header == 'HOR:POS':
+            self.HPos = float(argument)
+            return ''
+        if header == 'HOR:POS?':
+            return f'{self.HPos:.4E}'
+        if header.startswith('HOR:FAST:TIMES:ALL:'):
+            first, count = (int(x) for x in argument.split(','))
+            return self.timestamps(first, count)
+        if header.endswith('?'):
+            return self.settings.get(header.rstrip('?'), '0')
+
+        self.settings[header] = argument.upper()
+        return ''
+
+
+class SimulatedResourceManager:
+    '''
+    Stand-in for visa.ResourceManager('@py') that opens SimulatedScope instruments, every address gets its own scope
+
+    input:
+        **settings: keyword settings passed on to every SimulatedScope
+    '''
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.instruments = {}
+
+    def open_resource(self, address):
+        if address not in self.instruments:
+            self.instruments[address] = SimulatedScope(**{'seed': len(self.instruments), **self.settings})
+        return self.instruments[address]
+
+    def close(self):
+        pass
+
+
+class _SCPIHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        scope = self.server.scope
+        for line in self.rfile:
+            command = line.decode().strip()
+            if not command:
+                continue
+            with self.server.lock:
+                reply = scope._message(command)
+            if not any(is_query(part) for part in commands(command)):
+                continue
+            if isinstance(reply, np.ndarray):
+                #IEEE 488.2 definite length block, the way the scope sends CURV?
+                data = reply.tobytes()
+                size = str(len(data)).encode()
+                self.wfile.write(b'#' + str(len(size)).encode() + size + data + b'\n')
+            else:
+                self.wfile.write(reply.encode() + b'\n')
+
+
+def serve(scope, host='127.0.0.1', port=4000):
+    '''
+    Serve a SimulatedScope over a raw TCP socket in a background thread, one SCPI command per line
+
+    input:
+        scope: SimulatedScope to serve
+        host, port: where to listen
+    output:
+        the socketserver, call .shutdown() on it to stop
+    '''
+    server = socketserver.ThreadingTCPServer((host, port), _SCPIHandler)
+    server.daemon_threads = True
+    server.scope = scope
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+################# throughput benchmark #####################
+
+def benchmark(mode, num_waveforms=1000, frames_per_batch=100, data_length=1000, wait_method='opc', **settings):
+    '''
+    Measure how many waveforms per second an acquisition mode reaches on the simulated scope
+
+    input:
+        mode: 'single' (re-arm, wait and read back one waveform per flash), 'acquire' (the same in a single
+              message, with ScopeSession.acquire_raw) or 'fastframe'
+        num_waveforms: int of waveforms to take
+        frames_per_batch: int of frames per FastFrame batch
+        data_length: int of samples read per waveform
+        wait_method: how the session waits for the acquisitions, see ScopeSession
+        **settings: keyword settings of the SimulatedScope (trigger_rate, latency, ...)
+    output:
+        dictionary with the waveforms per second and the round trips per waveform
+    '''
+    from Scope_session import ScopeSession
+
+    session = ScopeSession(SimulatedScope(record_length=data_length, **settings), 'CH1', data_length, wait_method=wait_method)
+    session.write('ACQuire:STOPAfter SEQuence')
+
+    t_0 = time.time()
+    waveform_id = 0
+    while waveform_id < num_waveforms:
+        if mode == 'fastframe':
+            batch_size = min(frames_per_batch, num_waveforms - waveform_id)
+            session.collect_fastframe_raw(batch_size)
+            waveform_id += batch_size
+        elif mode == 'acquire':
+            session.acquire_raw()
+            waveform_id += 1
+        else:
+            session.arm()
+            session.wait_for_acquisition()
+            session.collect_raw()
+            waveform_id += 1
+    elapsed = time.time() - t_0
+
+    return {
+        'mode': mode,
+        'waveforms': waveform_id,
+        'seconds': elapsed,
+        'waveforms per s': waveform_id / elapsed,
+        'round trips per waveform': session.round_trips_per_waveform(),
+        'dead time fraction': session.dead_time() / (session.live_time() + session.dead_time()),
+    }
+
+
+if __name__ == '__main__':
+
+    for mode, wait_method in [('single', 'poll'), ('single', 'opc'), ('acquire', 'opc'), ('fastframe', 'opc')]:
+        result = benchmark(mode, num_waveforms=1000, wait_method=wait_method, trigger_rate=1000.0, latency=0.5e-3)
+        print(f"{mode:>10} ({wait_method:>4}): {result['waveforms per s']:8.1f} waveforms/s, "
+              f"{result['round trips per waveform']:.2f} round trips per waveform, "
+              f"{100 * result['dead time fraction']:.1f}% dead time")
@@ -6,6 +6,12 @@ from time import *
 from datetime import date
 import os, sys
 
+from Scope_session import ScopeSession, convertToWave
+from Acquisition_pipeline import AcquisitionPipeline
+from Raw_run_format import RawRunWriter
+from Scope_simulator import SimulatedResourceManager
+from Acquisition_telemetry import MetricsLog, metrics_path
+
 
 """
 This is Emma's code for taking data from oscilloscope"""
@@ -32,8 +38,26 @@ dataTakingTime = 60 #s
 # Replace 'USB0::0x0699::0x0363::C065087::INSTR' with your instrument's VISA address
 oscilloscope_address = 'TCPIP::142.90.115.154::inst0::INSTR'
 
-#the channel to read out
-channel_id = "CH1"
+#set to True to take data from the simulated scope of Scope_simulator.py instead, e.g. to test without the scope
+use_simulator = False
+
+#the channels to read out, all from the same trigger (e.g. ["CH1", "CH2"] for the PMT and the LED monitor)
+#the first one is the channel that is triggered on. AUX can't be read back, it is a trigger input only
+channel_ids = ["CH1"]
+channel_id = channel_ids[0]
+
+#how the script waits for each trigger: 'opc' (*OPC?), 'srq' (service request events) or 'poll' (ACQ:STATE?)
+wait_method = 'opc'
+
+#the trigger rate, dead time and command latencies of the run are written to {name}_metrics.jsonl every this many s
+metrics_every = 5
+
+#how many datapoints to collect in each waveform, but will be limited by the record length set on the scope really
+dateLength = 10000
+
+#(t_start, t_stop) in s to only transfer the samples of that region of interest (e.g. the pulse and a bit of
+#baseline before it) instead of the first dateLength samples, None for the whole record
+roi = None
 
 #data to save data to - default is todays date
 today = date.today()
@@ -49,38 +73,26 @@ if not isExist:
    print(f"Creating folder: {folder}")
 
 
+#the scope is read on the main thread, converting and saving is done by this many worker threads
+num_workers = 2
+max_queue = 100 #how many waveforms can wait to be saved before reading the scope pauses
+
+#'csv' saves every waveform to its own {name}_waveform_X.csv (plus the _raw.csv of the samples),
+#'raw' appends the 8-bit samples from the scope to a single {name}.pmtraw file (see Raw_run_format.py)
+output_format = 'csv'
+
 #putting all the naming and folder together
-name = f"{folder}{Filename}_{channel_id}"
-name2 = f"{folder}{Filename}_TRIG_{channel_id}"
+name = f"{folder}{Filename}_{'_'.join(channel_ids)}"
 
 
 ################ functions to save data ################
-def convertToWave(datac, scal_info):
+def saveData(records, name, number):
     """
-    Converts raw data that is output by query_binary_values to the corrected
-    time and voltage steps, and returns them as a 2D np.array. This requires the 
-    scaling information from the scope, read in through the dictionary scal_info.
+    Converts and saves one acquisition read from the scope, every channel in its own column of the same file.
+    This runs on the pipeline worker threads, the scope itself is only read on the main thread.
 
     input:
-        datac: 1D array that is the output from query_binary_values()
-        scal_info: dictionary with scope scaling details
-    output:
-        2D np.array of the converted data: [[time in s,] [voltages in V]]
-    """
-
-    x = []
-    y = []
-    for i in range(0,len(datac)):
-        x.append((i-(len(datac)*(scal_info['HPos']/100)))* scal_info['xincr'] + scal_info['HDelay'])
-        y.append(((datac[i]-scal_info['yoff']) * scal_info['ymult']) + scal_info['yzero'])
-        
-    return np.array([x,y])
-
-
-def saveData(oscilloscope, name, number):
-    """
-    input:
-        oscilloscope: object holding the connection to the oscilloscope to read from
+        records: dictionary of channel: (raw data, scaling details), the output from ScopeSession.collect_channels()
         name: str of full path name of file to save to, without file type extension
         number: int/str of the data set number to added to the end of the name
     output:
@@ -90,39 +102,23 @@ def saveData(oscilloscope, name, number):
     csv_file_path = f'{name}_waveform_{number}.csv'
     csv_file_path_raw = f'{name}_waveform_{number}_raw.csv'
 
-    # Configure and query waveform data
-    oscilloscope.write('DAT:ENC RPB')  # Set data encoding to binary
-    oscilloscope.write('DAT:WID 1')    # Set data width to 1 byte
-    oscilloscope.write('DAT:STAR 1')   # Set start of data to first byte
-    dateLength = 10000 #but will be limited by the record length set on the scope really
-    oscilloscope.write(f'DAT:STOP {dateLength}') # Set end of data to 10,000th byte
-    oscilloscope.write(f"DATA:SOURCE {channel_id}") #change channel source being used
-
-    raw_waveform_data = oscilloscope.query_binary_values('CURV?', datatype='B', container=np.array)
-
-    #get data for converting the waveform
-    info = oscilloscope.query('WFMOutpre?') 
-    info = info.split(",")
-    VerticalScale = info[2]
-    VerticalPos = info[3]
-    infoSplit = info[-1].split(";")
-    xincr = float(infoSplit[5])
-
-    #Vertical scale multiplying factor
-    ymult = float(infoSplit[9])
-    #Vertical position of the source waveform in digitizing levels
-    yoff = float(infoSplit[10])
-    yzero = float(infoSplit[11])
-    Hscale = float(oscilloscope.query("HOR:SCA?"))
-    HDelay = float(oscilloscope.query("HORizontal:DELay:TIMe?"))
-    HPos = float(oscilloscope.query("HORIZONTAL:POSITION?"))
+    #the horizontal settings are shared by all channels, the header shows the first one
+    raw_waveform_data, scal_info = records[channel_id]
+
+    xincr = scal_info['xincr']
+    ymult = scal_info['ymult']
+    yoff = scal_info['yoff']
+    yzero = scal_info['yzero']
+    Hscale = scal_info['Hscale']
+    HDelay = scal_info['HDelay']
+    HPos = scal_info['HPos']
 
     #Other info for the header
-    Vunits = infoSplit[8]
-    Hunits = infoSplit[4]
-    waveType = infoSplit[13]
-    pointsFormat = infoSplit[2]
-    ProbeA = int(float(oscilloscope.query("TRIGger:EXTernal:PRObe?").rstrip()))
+    VerticalScale = scal_info['VerticalScale']
+    Vunits = scal_info['Vunits']
+    Hunits = scal_info['Hunits']
+    waveType = scal_info['waveType']
+    pointsFormat = scal_info['pointsFormat']
     firmware = float(idn.split()[1].split("v")[1])
 
     headerInfo = {
@@ -157,11 +153,12 @@ def saveData(oscilloscope, name, number):
     }
     
 
-    #convert to [time [s], voltage [V]] using the scope settings
+    #convert to [time [s], voltage [V], ...] using the scope settings of every channel
     waveform_data = convertToWave(raw_waveform_data, headerInfo)
+    waveform_data = np.vstack([waveform_data[0]] + [convertToWave(raw, info)[1] for raw, info in records.values()])
 
-    #save just the raw reading
-    np.savetxt(csv_file_path_raw, raw_waveform_data, delimiter=",")
+    #save just the raw reading, one column per channel
+    np.savetxt(csv_file_path_raw, np.column_stack([raw for raw, info in records.values()]), delimiter=",")
 
     #and the fully converted waveform
     #header info
@@ -169,9 +166,10 @@ def saveData(oscilloscope, name, number):
 
     #the data
     with open(csv_file_path,'a') as f:
-        subheader = np.array([["",""], ["",""], ["",""], 
-                              ["Label",""],
-                              ["TIME",channel_id]])
+        blank = [""] * len(records)
+        subheader = np.array([[""] + blank, [""] + blank, [""] + blank,
+                              ["Label"] + blank,
+                              ["TIME"] + list(records)])
 
         np.savetxt(f,subheader, delimiter=",", fmt="%s")
         np.savetxt(f,waveform_data.T, delimiter=",")
@@ -181,15 +179,48 @@ def saveData(oscilloscope, name, number):
     return
 
 
+def saveRaw(records, name, number):
+    """
+    Appends one acquisition read from the scope to the run files {Filename}_{channel}.pmtraw (one per channel),
+    as raw 8-bit samples. Same inputs as saveData, so the pipeline can use either.
+
+    input:
+        records: dictionary of channel: (raw data, scaling details), the output from ScopeSession.collect_channels()
+        name: str of full path name of the run, without file type extension
+        number: int of the data set number, its position in the run files
+    output:
+        None
+    """
+    for channel, (raw_waveform_data, scal_info) in records.items():
+        raw_writers[channel].add(number, raw_waveform_data[np.newaxis, :], scal_info)
+
+    return
+
+
 ################ main ################
 
 # Create a VISA resource manager
-rm = visa.ResourceManager('@py')
+if use_simulator:
+    rm = SimulatedResourceManager()
+else:
+    rm = visa.ResourceManager('@py')
 data_number = 0
 
+if output_format == 'raw':
+    raw_writers = {channel: RawRunWriter(f'{folder}{Filename}_{channel}.pmtraw', {'PMT': PMTnumber, 'PMT voltage (V)': PMT_voltage,
+                                                                      'LED wavelength (nm)': LED_wavelength, 'LED ADC value': LED_ADC_value,
+                                                                      'channel': channel, 'date': d1})
+                   for channel in channel_ids}
+    #carry on numbering after what is already in the files
+    data_number = min(writer.num_committed for writer in raw_writers.values())
+    pipeline = AcquisitionPipeline(lambda item: saveRaw(*item), num_workers, max_queue)
+else:
+    pipeline = AcquisitionPipeline(lambda item: saveData(*item), num_workers, max_queue)
+metrics = None
+
 try:
     # Open a connection to the oscilloscope
-    scope = rm.open_resource(oscilloscope_address)
+    scope = ScopeSession(rm.open_resource(oscilloscope_address), channel_id, dateLength, wait_method=wait_method, roi=roi)
 
     # Query the instrument's identification
     idn = scope.query('*IDN?')
@@ -211,55 +242,50 @@ try:
     print("Trigger set to: ", scope.query("TRIGger:A:EDGE:SLOpe?").rstrip(), 
                     scope.query(f"TRIGger:A:LEVel:{channel_id}?").rstrip(), "V")
 
+    metrics = MetricsLog(scope, metrics_path(name), metrics_every)
+
     end_time = time() + (dataTakingTime)
     print(f"Taking data for {dataTakingTime} s ({dataTakingTime/60:.2} min)")
 
+    #the probe attenuation is a trigger setting, so it is read once here for the CSV header
+    ProbeA = int(float(scope.query("TRIGger:EXTernal:PRObe?").rstrip()))
+
     while time() < end_time:
         #start the acquiring mode
-        scope.write("ACQ:STATE RUN")
-        waiting = 1
-        looptime = time()
-        triggertime = time()
-        # print(end_time, triggertime)
-
-        # wait here until trigger received or time ends
-        while (waiting == 1):
-            #returns 1 if in acquiring mode, 0 if stopped
-            waiting = int(scope.query("ACQ:STATE?"))
-            # print("waiting...", waiting)
-
-            #capture the trigger time - this is not being used anywhere cause I don't
-            # really think we care about the exact timing right now, but could be added in
-            #later
-            if waiting == 0:
-                # Saved the data as CSV file if the acquisition has stopped
-                trigger = scope.query("TRIGGER:STATE?").rstrip()
-                print(f"acquisition stopped, {trigger}")
-                saveData(scope, name, data_number)
-                data_number += 1 #add one for the next data set
-                # triggertime = time()
-
-            looptime = time()
-            if looptime > end_time:
-                if scope.query("TRIGGER:STATE?").rstrip() == 'REA':
-                    print("No trigger event for finale capture")
-                break
-        
-            #print status of the trigger state, and the acquisition date
-            # print(scope.query("TRIGGER:STATE?").rstrip(), scope.query("ACQ:STATE?").rstrip())
-
-        #this seems to only work for very consistent waveforms, and I don't really know why
-        # Saved the data as CSV file if the trigger has been triggered        
-        # if scope.query("TRIGGER:STATE?").rstrip() == "TRIG":
-        #     print(f"{channel_id} triggered")
-        #     #call function that actually does the savings
-
-        #     saveData(scope, name2, data_number)
-        #     data_number += 1 #add one for the next data set
+        scope.arm()
+
+        # wait here until trigger received or time ends, without flooding the scope with ACQ:STATE? queries
+        if scope.wait_for_acquisition(timeout=max(end_time - time(), 0)):
+            # Saved the data as CSV file if the acquisition has stopped
+            trigger = scope.query("TRIGGER:STATE?").rstrip()
+            print(f"acquisition stopped, {trigger}")
+            records = scope.collect_channels(channel_ids)
+            pipeline.put((records, name, data_number))
+            data_number += 1 #add one for the next data set
+            metrics.update(queue_depth=pipeline.depth())
+        else:
+            if scope.query("TRIGGER:STATE?").rstrip() == 'REA':
+                print("No trigger event for finale capture")
+            break
+
+        #the TRIG file that used to be saved here from a second acquisition never lined up with the first one,
+        #add the trigger/LED monitor channel to channel_ids instead and it is read from the same acquisition
 
 finally:
+    #wait for the workers to save everything still in the queue
+    pipeline.close()
+    if output_format == 'raw':
+        for writer in raw_writers.values():
+            writer.close()
     print("Data taking complete.")
-    print(f"{data_number} data files saved: {name}_waveform_X.csv")
+    if output_format == 'raw':
+        print(f"{data_number} waveforms saved: {folder}{Filename}_CHX.pmtraw")
+    else:
+        print(f"{data_number} data files saved: {name}_waveform_X.csv")
+    scope.report()
+    pipeline.report()
+    if metrics is not None:
+        metrics.close()
     # Close the connection    
     scope.close()
     rm.close()
@@ -5,12 +5,22 @@ import time
 from datetime import date
 import os, sys
 
+from Scope_session import ScopeSession, convertFrames
+from Acquisition_pipeline import AcquisitionPipeline
+from Waveform_writer import ChunkedWaveformWriter, save_timestamps, truncate_timestamps
+from Raw_run_format import RawRunWriter
+from Scope_simulator import SimulatedResourceManager
+from Acquisition_telemetry import MetricsLog, metrics_path
+from Online_analysis import OnlineCharge, PrecisionStop, charges_path
+
 """"This is Meghan's code to take data from the oscilloscope and save it as a CSV file. 
 I added a small safety check (lines 191–200) to stop data taking if it takes too long,
 originally, the code could get stuck in an infinite loop.
 We later found and fixed the real issue, but I left the check in (currently commented) just in case it's useful in the future. 
 It's commented out now because for the SPE check we need 10e4 waveforms for a smooth histogram, which takes longer than the previous 100.
  Feel free to leave it commented or enable it as needed.
+ (It is now the t_max setting below, None to turn it off, and auto_stop can end the run as soon as the
+ SPE fit is precise enough.)
  """
 
 #BA0131
@@ -25,19 +35,83 @@ laser_status = 'ON' #set as ON or OFF depending on if this is a laser or backgro
 #this is the name of the file-
 Filename = f'SPEdataTest_{PMTnumber}-{PMT_voltage}V_L-{LED_wavelength}_LASER-{laser_status}'
 
-#how many samples (light flashes) you want to save
+#how many samples (light flashes) you want to save, at most (see auto_stop)
 num_waveforms = 10000
 
+#wall-clock budget of the run in s, None for no limit
+t_max = None
+
+#stop as soon as the charge histogram is good enough instead of always taking num_waveforms (turns on the online
+#analysis below): every stop_check_every waveforms the charges are refitted with the stop_model of SPE_likelihood
+#('spe', 'spe_background', 'poisson' or 'double_gaussian'), and the run stops once the gain and the width of the
+#single photoelectron peak have a relative uncertainty below stop_precision. num_waveforms and t_max are still
+#the budgets
+auto_stop = False
+stop_precision = 0.01
+stop_model = 'spe'
+min_waveforms = 1000
+stop_check_every = 500
+
+#how to take the data:
+#   'single': re-arm the scope and read back one waveform per LED flash
+#   'fastframe': the scope captures frames_per_batch flashes into its segmented (FastFrame) memory,
+#                and each batch is read back in a single transfer with per-frame trigger timestamps
+acquisition_mode = 'single'
+frames_per_batch = 1000 #limited by the scope memory, record length x frames_per_batch has to fit
+
+#the scope is read on the main thread, converting the waveforms is done by this many worker threads
+num_workers = 2
+max_queue = 1000 #how many raw waveforms/batches can wait to be converted before reading the scope pauses
+
+#waveforms are written to disk in parts of chunk_size waveforms as they come in, and put together into a
+#single {name}.csv at the end. If the run stops part-way, running again with resume = True continues after
+#the last complete part instead of starting over
+chunk_size = 1000
+resume = True
+
+#'csv' saves the waveforms in volts as {name}.csv, 'raw' saves the 8-bit samples from the scope as they came in
+#to {name}.pmtraw (about 20x smaller and much faster to read back, see Raw_run_format.py),
+#'charges' only saves the charge of every trigger to {name}_charges.csv (see online_analysis below)
+output_format = 'csv'
+
+#integrate every waveform over integration_window (t0, t1 in s, same window as SPE_fit.compute_area) while taking
+#data, save the charges to {name}_charges.csv and show their histogram live every live_plot_every s (0 for no plot).
+#Always on with output_format = 'charges'
+online_analysis = False
+integration_window = (0.38e-7, 2e-7)
+live_plot_every = 5
+
 ################### setup ########################
 
+#how the script waits for each FastFrame batch: 'opc' (*OPC?), 'srq' (service request events) or 'poll' (ACQ:STATE?),
+#and how long to wait for a trigger before giving up, in s. In 'single' mode the wait is chained with the readout
+#instead (ACQuire:STATE RUN;*WAI;:CURVe?, see Scope_session.acquire_raw)
+wait_method = 'opc'
+acquisition_timeout = 10
+
+#the rates, dead time and command latencies of the run are written to {name}_metrics.jsonl every this many s
+metrics_every = 5
+
 #oscilloscope address, make sure scope is connected to ethernet port
 oscilloscope_address = 'TCPIP::142.90.115.154::inst0::INSTR'
 
 #oscilloscope_address = 'TCPIP::142.90.100.19::inst0::INSTR'
 
+#set to True to take data from the simulated scope of Scope_simulator.py instead, e.g. to test without the scope
+use_simulator = False
+
 #channel to readout
 channel_id = 'CH1'
 
+#how many datapoints to collect in each waveform, limited by record length set on scope so check this
+dataLength = 1000
+
+#region-of-interest readout: only transfer the samples from the start of baseline_window to the end of
+#integration_window (in s) instead of the first dataLength samples, e.g. about 10x less data for 10k sample records.
+#The time of every sample is still exact, the offset of the first one is kept with the scaling information
+roi_readout = False
+baseline_window = (0.0, 0.38e-7)
+
 #file saving info, will save to a folder called SPE_PMT_data/{date}
 today = date.today()
 Date = today.strftime('%y-%m-%d')
@@ -53,118 +127,73 @@ name = f'{folder}{Filename}_{channel_id}'
 
 ################# functions to process & save data #####################
 
-def convertToWave(datac, scal_info):
-    """
-    Converts raw data that is output by query_binary_values to the corrected
-    time and voltage steps, and returns them as a 2D np.array. This requires the 
-    scaling information from the scope, read in through the dictionary scal_info.
-
-    input:
-        datac: 1D array that is the output from query_binary_values()
-        scal_info: dictionary with scope scaling details
-    output:
-        2D np.array of the converted data: [[time in s,] [voltages in V]]
-    """
-
-    x = []
-    y = []
-    for i in range(0,len(datac)):
-        x.append((i-(len(datac)*(scal_info['HPos']/100)))* scal_info['xincr'] + scal_info['HDelay'])
-        y.append(((datac[i]-scal_info['yoff']) * scal_info['ymult']) + scal_info['yzero'])
-        
-    return np.array([x,y])
-
-def collect_waveform(oscilloscope):
+def convert_and_store(item):
     '''
-    Collect and return a converted waveform from the scope using convertToWave
+    Pipeline handler, run on the worker threads: convert a raw waveform (or FastFrame batch) and
+    hand it to the writer at its position in the run
 
     input:
-        oscilloscope: object holding the connection to the oscilloscope to read from
-    output:
-        2D converted array of scope data
-    '''
-    
-    #configure and query waveform data
-    oscilloscope.write('DAT:ENC RPB')  #set data encoding to binary
-    oscilloscope.write('DAT:WID 1')    #set data width to 1 byte
-    oscilloscope.write('DAT:STAR 1')   #set start of data to first byte
-
-    dataLength = 1000 #this is how many datapoints you want to collect in each waveform, limited by record length set on scope so check this
-
-    oscilloscope.write(f'DAT:STOP {dataLength}') #set end of data to 10000th byte
-    oscilloscope.write(f"DATA:SOURCE {channel_id}") #change channel source being used
-
-    raw_waveform_data = oscilloscope.query_binary_values('CURV?', datatype='B', container=np.array)
-
-    #get data for converting the waveform
-    info = oscilloscope.query('WFMOutpre?') 
-    info = info.split(",")
-    infoSplit = info[-1].split(";")
-    xincr = float(infoSplit[5])
-
-    #Vertical scale multiplying factor
-    ymult = float(infoSplit[9])
-    #Vertical position of the source waveform in digitizing levels
-    yoff = float(infoSplit[10])
-    yzero = float(infoSplit[11])
-    Hscale = float(oscilloscope.query("HOR:SCA?"))
-    HDelay = float(oscilloscope.query("HORizontal:DELay:TIMe?"))
-    HPos = float(oscilloscope.query("HORIZONTAL:POSITION?"))
-
-    # get information needed for convertToWave function
-    scal_info = {     
-        'xincr': xincr,
-        'ymult': ymult, 
-        'yoff': yoff, 
-        'yzero': yzero,
-        'Hscale': Hscale, 
-        'HDelay': HDelay, 
-        'HPos': HPos
-    }
-
-    #convert to [time [s], voltage [V]] using the scope settings
-    waveform_data = convertToWave(raw_waveform_data, scal_info)
-
-    return waveform_data
-
-def save_all_waveforms(all_waveforms, name):
-    '''
-    Save all waveforms to a single CSV file - time in first column, each waveform in its own column
-
-    input:
-        all_waveforms: a list of all of the waveforms collected in a single run
-        name: str of full path name of file to save to, without file extension
+        item: tuple of (index of the first waveform, 2D array of raw frames one per row, scal_info dictionary)
     output:
         none
     '''
 
-    csv_file_path = f'{name}.csv'
+    first_id, frames, scal_info = item
 
-    time_axis = all_waveforms[0][0]  #define the timing as the first row of the first waveform
-    data = np.vstack([time_axis] + [wf[1] for wf in all_waveforms]) #put each waveform together sequentially
-    column_data = data.T  #change it into column format
-    headers = ['time (s)'] + [f'waveform_{i}' for i in range(len(all_waveforms))]   #define headers for each column
-    
-    df = pd.DataFrame(column_data, columns=headers) #make into dataframe
-    df.to_csv(csv_file_path, index=False)    #change to csv
-    print(f"Saved all waveforms to {csv_file_path}")
+    if online is not None:
+        online.add(first_id, frames, scal_info)
+    if output_format == 'charges':
+        return
 
-################# main ######################
+    #the raw format keeps the samples as they are, nothing to convert
+    if output_format == 'raw':
+        writer.add(first_id, frames, scal_info)
+        return
+
+    for i, waveform in enumerate(convertFrames(frames, scal_info)):
+        writer.add(first_id + i, waveform)
 
-rm = visa.ResourceManager('@py')
+################# main ######################
 
-all_waveforms = []       #list to hold the waveforms in as the thing runs
+if use_simulator:
+    rm = SimulatedResourceManager()
+else:
+    rm = visa.ResourceManager('@py')
+
+#integrates the waveforms as the thing runs
+online = None
+if online_analysis or auto_stop or output_format == 'charges':
+    online = OnlineCharge(*integration_window, charges_path(name), resume)
+
+#writes the waveforms to disk as the thing runs
+if output_format == 'charges':
+    writer = online #only the charges are saved, and a resumed run carries on after the last one
+elif output_format == 'raw':
+    metadata = {'PMT': PMTnumber, 'PMT voltage (V)': PMT_voltage, 'LED wavelength (nm)': LED_wavelength,
+                'laser': laser_status, 'channel': channel_id, 'date': Date}
+    writer = RawRunWriter(f'{name}.pmtraw', metadata, resume)
+else:
+    writer = ChunkedWaveformWriter(name, chunk_size, resume)
+if online is not None and writer is not online:
+    #the charges file is written before the data, after a crash it can have more waveforms than the data
+    online.truncate(writer.num_committed)
+#a resumed run takes the waveforms after the last committed one again, and saves their timestamps again
+truncate_timestamps(name, writer.num_committed)
+
+pipeline = AcquisitionPipeline(convert_and_store, num_workers, max_queue)
+metrics = None
 
 try:
     #open a connection to the oscilloscope
-    scope = rm.open_resource(oscilloscope_address)
+    roi = (min(baseline_window[0], integration_window[0]), max(baseline_window[1], integration_window[1])) if roi_readout else None
+    scope = ScopeSession(rm.open_resource(oscilloscope_address), channel_id, dataLength, wait_method=wait_method, roi=roi)
 
     #query the instrument's identification
     idn = scope.query('*IDN?')
     print(f"Instrument Identification: {idn}")
 
-    #put scope into continuous trigger
-    scope.write('ACQuire:STOPAfter RUNSTop')
+    #stop after every acquisition, so each waveform we read belongs to a new trigger
+    scope.write('ACQuire:STOPAfter SEQuence')
     
     scope.write('TRIGger:A:TYPe EDGE') #set to edge trigger
     scope.write('TRIGger:A:EDGE:SOUrce AUX')  #specifies that this is externally triggered (scope trigger port is AUX)
@@ -177,52 +206,97 @@ try:
 
     print('Trigger set to: ', scope.query('TRIGger:A:EDGE:SLOpe?').rstrip(), scope.query(f'TRIGger:A:LEVel:AUXin?').rstrip(), 'V')
 
-    waveform_id = 0 #initialize number of waveforms to be zero
+    waveform_id = writer.num_committed #zero, unless we are resuming a run that stopped part-way
+    if waveform_id > 0:
+        print(f'Resuming {name} at waveform {waveform_id}')
+
+    metrics = MetricsLog(scope, metrics_path(name), metrics_every)
 
     #start counting time 
 
     t_0= time.time()
+    last_plot = t_0
 
-    t_max=120
+    #the budgets are always checked, the fit only with auto_stop
+    stop = PrecisionStop(online if auto_stop else None, stop_precision, stop_model, min_waveforms, stop_check_every,
+                         max_waveforms=num_waveforms, max_time=t_max)
+    stop_reason = stop.check(waveform_id) #a resumed run may already be done
 
-    while waveform_id < num_waveforms:
+    if acquisition_mode == 'fastframe':
 
-        # if abs(time.time()-t_0)> t_max:
-        #     print("t_max exceeded (1)")
-        #     break
+        while stop_reason is None:
 
-        #start acquiring mode
-        scope.write('ACQuire:STATE RUN')
+            #the last batch only captures what is left
+            batch_size = min(frames_per_batch, num_waveforms - waveform_id)
 
-        # while True:
-        #    if abs(time.time()-t_0)> t_max:
-        #     print("t_max exceeded (2)")
-        #     break
-        #    waiting = int(scope.query('ACQ:STATE?').rstrip()) 
-        #    if waiting == 0:
-        #        break
-           
-        #    #this is just to not continually query, change this depending on how fast function generator is
-        #    time.sleep(0.0005) #script check oscilloscope for trigger every 0.5ms
+            frames, scal_info, timestamps = scope.collect_fastframe_raw(batch_size)
+            pipeline.put((waveform_id, frames, scal_info))
+            save_timestamps(timestamps, waveform_id, name)
 
-        trigger = scope.query('TRIGGER:STATE?').rstrip()
-        
-        if waveform_id % 1000 == 0: #check status every 1000 waveforms
-            print(f"[{waveform_id}] Triggered: {trigger}")
+            waveform_id += batch_size
+            print(f"Collected waveform {waveform_id}/{num_waveforms}, queue depth {pipeline.depth()}")
+            metrics.update(queue_depth=pipeline.depth())
+
+            if online is not None and live_plot_every and time.time() - last_plot > live_plot_every:
+                online.plot()
+                last_plot = time.time()
+
+            stop_reason = stop.check(waveform_id)
+
+    else:
+
+        while stop_reason is None:
+
+            #start acquiring mode, wait for the trigger (so we never read a stale waveform) and read it back,
+            #all in one round trip
+            raw_waveform_data, scal_info = scope.acquire_raw(timeout=acquisition_timeout)
+            if raw_waveform_data is None:
+                print(f"No trigger within {acquisition_timeout} s, stopping at waveform {waveform_id}")
+                break
+
+            if waveform_id % 1000 == 0: #check status every 1000 waveforms
+                trigger = scope.query('TRIGGER:STATE?').rstrip()
+                print(f"[{waveform_id}] Triggered: {trigger}")
+
+            pipeline.put((waveform_id, raw_waveform_data[np.newaxis, :], scal_info))
+
+            waveform_id += 1
+            metrics.update(queue_depth=pipeline.depth())
+
+            if online is not None and live_plot_every and time.time() - last_plot > live_plot_every:
+                online.plot()
+                last_plot = time.time()
 
-        waveform = collect_waveform(scope)
-        all_waveforms.append(waveform)
+            stop_reason = stop.check(waveform_id)
 
-        waveform_id += 1
+            if waveform_id % 1000 == 0:
+                print(f"Collected waveform {waveform_id}/{num_waveforms}, queue depth {pipeline.depth()}")
 
-        if waveform_id % 1000 == 0:
-            print(f"Collected waveform {waveform_id}/{num_waveforms}")
+    if stop_reason is not None:
+        print(f'Stopping: {stop_reason}')
 
-    save_all_waveforms(all_waveforms, name)
+    #wait for the workers to convert everything still in the queue, then put the parts together
+    pipeline.close()
+    writer.close()
+    if output_format == 'csv':
+        writer.merge()
 
 finally:
+    #drain whatever is still in flight, so a run that stopped part-way still leaves readable parts on disk
+    pipeline.close()
+    writer.close()
     print('Data taking complete')
-    print(f'{waveform_id} data files saved: {name}.csv')
+    if output_format == 'charges':
+        print(f'{waveform_id} charges saved: {charges_path(name)}')
+    else:
+        print(f'{waveform_id} data files saved: {name}.{"pmtraw" if output_format == "raw" else "csv"}')
+    if online is not None:
+        online.close()
+        print(f'{online.num_committed} charges integrated over {integration_window[0]}..{integration_window[1]} s')
+    scope.report()
+    pipeline.report()
+    if metrics is not None:
+        metrics.close()
     scope.close()
     rm.close()
 
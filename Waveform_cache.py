@@ -0,0 +1,308 @@
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+import hashlib
+import time
+import json
+import sys
+import os
+
+try:
+    import fcntl
+except ImportError:
+    #no fcntl on Windows, there the index is updated without a lock
+    fcntl = None
+
+
+"""
+This keeps the parsed waveform matrices of the TakingSPEData CSV files on disk, so the analysis scripts
+(Charge_Test.py, Linearity_Test.py, Scope_pulse_reconstruction.py, Peaks_plotter.py, SPE_fit.py and the notebook)
+only parse a CSV once: the first read stores it as a .npy file, every later read memory-maps the .npy instead.
+Waveform_io.load_waveforms() and Waveform_io.iter_waveform_blocks() go through it, nothing else has to change.
+
+An entry is found by the content hash of the CSV (blake2b of its bytes), so a copied or renamed file hits the
+same entry. Hashing means reading the file, so the hash of every path is remembered with the size and mtime it
+was computed for, and only recomputed when one of them changes (a rewritten or resumed run).
+
+The cache is in ~/.cache/pmt_waveforms (or the folder in the PMT_WAVEFORM_CACHE environment variable, 'off'
+turns it off), in float64 like a CSV parsed by pandas. Its total size is kept under max_bytes by evicting
+the least recently used entries. Several processes can share it (e.g. the workers of Grid_analysis.py), the
+index is only changed while holding a lock on it. From a terminal:
+
+    python Waveform_cache.py info                       #entries and size of the cache
+    python Waveform_cache.py invalidate FILE [FILE...]  #forget the entries of these CSV files
+    python Waveform_cache.py clear                      #empty the cache
+"""
+
+
+HASH_BLOCK = 16 * 2**20     #bytes read at a time when hashing a CSV
+DEFAULT_FOLDER = os.path.join(os.path.expanduser('~'), '.cache', 'pmt_waveforms')
+
+
+def file_hash(file):
+    '''
+    Content hash of a file, and its number of lines (read in the same pass)
+
+    output:
+        str of the hex digest
+        int of lines, the last one counts even without a newline at its end
+    '''
+    digest = hashlib.blake2b(digest_size=20)
+    lines = 0
+    last = b'\n'
+    with open(file, 'rb') as f:
+        while True:
+            data = f.read(HASH_BLOCK)
+            if not data:
+                break
+            digest.update(data)
+            lines += data.count(b'\n')
+            last = data[-1:]
+    if last != b'\n':
+        lines += 1
+    return digest.hexdigest(), lines
+
+
+def parse_csv(file, path, num_rows, chunk_rows=500):
+    '''
+    Parse a TakingSPEData CSV file into a .npy file, a few rows at a time so the file never has to fit in memory
+
+    input:
+        file: str of the path of the CSV file
+        path: str of the .npy file to write
+        num_rows: int of sample rows in the file (lines without the header)
+        chunk_rows: int of rows parsed at a time
+    '''
+    with open(file) as f:
+        num_columns = f.readline().count(',') + 1
+
+    data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=(num_rows, num_columns))
+    row = 0
+    for chunk in pd.read_csv(file, delimiter=',', chunksize=chunk_rows, dtype=np.float64, engine='c'):
+        if row + len(chunk) > num_rows:
+            raise ValueError(f'{file} has more than the {num_rows} rows counted in it')
+        data[row:row + len(chunk)] = chunk.to_numpy()
+        row += len(chunk)
+    data.flush()
+    del data
+
+    if row != num_rows:
+        #e.g. empty lines at the end of the file, that pandas skips. The rows read are copied to another file,
+        #path can't be overwritten while it is mapped
+        trimmed = f'{path}.trim'
+        try:
+            with open(trimmed, 'wb') as f:
+                np.save(f, np.load(path, mmap_mode='r')[:row])
+            os.replace(trimmed, path)
+        finally:
+            if os.path.exists(trimmed):
+                os.remove(trimmed)
+
+
+class WaveformCache:
+    '''
+    On-disk cache of parsed waveform CSV files
+
+    input:
+        folder: str of the folder of the cache
+        max_bytes: float of the largest total size of the cached matrices, least recently used ones are evicted
+    '''
+
+    def __init__(self, folder=DEFAULT_FOLDER, max_bytes=20e9):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(folder, 'index.json')
+        os.makedirs(folder, exist_ok=True)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_path):
+            return {'paths': {}, 'entries': {}}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except ValueError:
+            #a damaged index only costs a re-parse
+            return {'paths': {}, 'entries': {}}
+
+    def _write_index(self, index):
+        tmp = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path)  #the index is never half written
+
+    @contextmanager
+    def _locked(self):
+        '''
+        Hold the lock of the index, so the read-modify-write of one process does not undo another one
+        '''
+        with open(os.path.join(self.folder, 'index.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry_path(self, key):
+        return os.path.join(self.folder, f'{key}.npy')
+
+    def key(self, file):
+        '''
+        output:
+            str of the content hash of the file, only recomputed when its size or mtime changed
+            int of lines in the file, None if the hash was remembered
+        '''
+        path = os.path.abspath(file)
+        stat = os.stat(path)
+        known = self._read_index()['paths'].get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['hash'], None
+
+        return file_hash(path)
+
+    def load(self, file):
+        '''
+        Parsed contents of a CSV file, parsed (and stored) now if they are not in the cache
+
+        input:
+            file: str of the path of a TakingSPEData CSV file
+        output:
+            2D read-only memmap of [time in s, waveform_0 in V, waveform_1 in V, ...] columns,
+            every sample row of the file (the header is not included)
+        '''
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        key, lines = self.key(file)
+        path = self._entry_path(key)
+
+        #hashing and parsing are done outside of the lock, only the index changes are locked
+        if not os.path.exists(path):
+            if lines is None:
+                key, lines = file_hash(file)
+                path = self._entry_path(key)
+            tmp = f'{path}.{os.getpid()}.tmp.npy'
+            try:
+                parse_csv(file, tmp, lines - 1)
+                os.replace(tmp, path)
+            finally:
+                #only left when the parse failed
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+        with self._locked():
+            index = self._read_index()
+            index['paths'][file] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': key}
+            entry = index['entries'].setdefault(key, {'bytes': os.path.getsize(path), 'file': file})
+            entry['last_used'] = time.time()
+            self._evict(index, keep=key)
+            self._write_index(index)
+
+            return np.load(path, mmap_mode='r')
+
+    def lookup(self, file):
+        '''
+        Parsed contents of a CSV file if they are already in the cache, without hashing or parsing it
+
+        input:
+            file: str of the path of a TakingSPEData CSV file
+        output:
+            2D read-only memmap like load(), None if the file (at its current size and mtime) is not in the cache
+        '''
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        with self._locked():
+            index = self._read_index()
+            known = index['paths'].get(file)
+            if known is None or known['size'] != stat.st_size or known['mtime_ns'] != stat.st_mtime_ns:
+                return None
+            path = self._entry_path(known['hash'])
+            if known['hash'] not in index['entries'] or not os.path.exists(path):
+                return None
+
+            index['entries'][known['hash']]['last_used'] = time.time()
+            self._write_index(index)
+            return np.load(path, mmap_mode='r')
+
+    def _evict(self, index, keep=None):
+        '''
+        Remove the least recently used entries until the cache is under max_bytes
+        '''
+        entries = index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries.pop(key)['bytes']
+            if os.path.exists(self._entry_path(key)):
+                os.remove(self._entry_path(key))
+
+        hashes = set(entries)
+        index['paths'] = {path: known for path, known in index['paths'].items() if known['hash'] in hashes}
+
+    def invalidate(self, files=None):
+        '''
+        Forget cached files, they are parsed again the next time they are read
+
+        input:
+            files: list of str of the paths of CSV files, None to empty the whole cache
+        output:
+            int of entries removed
+        '''
+        with self._locked():
+            return self._invalidate(files)
+
+    def _invalidate(self, files):
+        index = self._read_index()
+        if files is None:
+            keys = set(index['entries'])
+        else:
+            paths = {os.path.abspath(file) for file in files}
+            keys = {known['hash'] for path, known in index['paths'].items() if path in paths}
+            keys |= {key for key, entry in index['entries'].items() if entry['file'] in paths}
+
+        for key in keys:
+            index['entries'].pop(key, None)
+            if os.path.exists(self._entry_path(key)):
+                os.remove(self._entry_path(key))
+        index['paths'] = {path: known for path, known in index['paths'].items() if known['hash'] not in keys}
+        self._write_index(index)
+
+        return len(keys)
+
+    def info(self):
+        '''
+        output:
+            dictionary with the number of entries and their total size in bytes
+        '''
+        entries = self._read_index()['entries']
+        return {'entries': len(entries), 'bytes': sum(entry['bytes'] for entry in entries.values()),
+                'max_bytes': self.max_bytes, 'folder': self.folder}
+
+
+def default_cache():
+    '''
+    output:
+        the WaveformCache the analysis scripts share, None if PMT_WAVEFORM_CACHE is 'off'
+    '''
+    folder = os.environ.get('PMT_WAVEFORM_CACHE', DEFAULT_FOLDER)
+    if folder.lower() == 'off':
+        return None
+    return WaveformCache(folder)
+
+
+if __name__ == '__main__':
+
+    cache = default_cache()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'info'
+    if cache is None:
+        print('The waveform cache is turned off (PMT_WAVEFORM_CACHE=off)')
+    elif command == 'invalidate':
+        print(f'{cache.invalidate(sys.argv[2:])} entries removed')
+    elif command == 'clear':
+        print(f'{cache.invalidate()} entries removed')
+    else:
+        info = cache.info()
+        print(f"{info['entries']} files, {info['bytes'] / 1e9:.2f} of {info['max_bytes'] / 1e9:.0f} GB in {info['folder']}")
@@ -0,0 +1,192 @@
+import numpy as np
+import pandas as pd
+
+from Raw_run_format import RawRun, EXTENSION
+from Waveform_cache import default_cache
+
+
+"""
+This is where the analysis scripts (SPE_fit.py, Charge_Test.py, Linearity_Test.py, Scope_pulse_reconstruction.py
+and Peaks_plotter.py) read their waveform files from, so they work the same on the TakingSPEData CSV files
+and on the compact .pmtraw files of Raw_run_format.py.
+
+load_waveforms() reads a whole file at once. A 1e4 waveform CSV has 10,001 columns, and parsing all of it
+with pandas takes most of the runtime of the analysis and several times the memory of the data, while the
+analysis only needs the samples up to the end of its t0..t1 window (the window plus the baseline before it).
+iter_waveform_blocks() only reads those rows, and gives the waveforms back in blocks of block_size columns,
+so the analysis functions can work through a file block by block with bounded memory:
+
+    for times, block in iter_waveform_blocks(file, t0, t1):
+        ...     #block has one waveform per column, its rows are the samples at times
+
+Both keep every sample row, of the CSV files and of the .pmtraw files alike, so a run gives the same matrix
+whatever format it was saved in (load_waveforms() used to read the CSV files with skiprows=1, which made the
+first sample row the header and lost it).
+
+Both read the CSV files through the on-disk cache of Waveform_cache.py, so every later pass (or script)
+memory-maps the parsed matrix instead of parsing the CSV again. load_waveforms() and a block read of the whole
+record (t1 None) parse all of the file into the cache the first time. A block read that stops at t1 only uses
+the cache if the file is already in it, otherwise it reads its rows from the CSV and leaves the cache alone,
+so the first pass over a large run does not parse the rows after t1 just to store them.
+use_cache=False always reads the CSV itself.
+"""
+
+
+def _cached(file, use_cache, parse=True):
+    '''
+    output:
+        2D memmap of the parsed CSV file from the cache (every sample row), None if not using the cache
+        (or if parse is False and the file is not in the cache yet)
+    '''
+    cache = default_cache() if use_cache else None
+    if cache is None:
+        return None
+    return cache.load(file) if parse else cache.lookup(file)
+
+
+def load_waveforms(file, dtype=np.float64, use_cache=True):
+    '''
+    Read a run of waveforms into a 2D array with the time in the first column and each waveform in its own column
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        dtype: float type of the returned array, np.float32 halves the memory of large runs
+        use_cache: if True CSV files are read through the parsed-data cache (see Waveform_cache.py)
+    output:
+        2D np.array of [time in s, waveform_0 in V, waveform_1 in V, ...] columns, one row per sample
+    '''
+
+    if str(file).endswith(EXTENSION):
+        return RawRun(file).to_columns(dtype)
+
+    data = _cached(file, use_cache)
+    if data is not None:
+        return np.array(data, dtype=dtype)
+
+    file_ = pd.read_csv(file, delimiter=',', header=0)
+    return np.asarray(file_, dtype=dtype)
+
+
+def read_times(file, t_max=None, chunk_rows=500):
+    '''
+    Read only the time column of a run
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t_max: float in s, the CSV is only read until the first sample after t_max (None for the whole record)
+        chunk_rows: int of CSV rows read at a time
+    output:
+        1D np.array of the sample times in s
+    '''
+
+    if str(file).endswith(EXTENSION):
+        return RawRun(file).times
+
+    #every row of a wide CSV is long, so stop reading as soon as the window is passed
+    chunks = []
+    for chunk in pd.read_csv(file, delimiter=',', usecols=[0], chunksize=chunk_rows):
+        chunks.append(chunk.to_numpy()[:, 0])
+        if t_max is not None and chunks[-1][-1] > t_max:
+            break
+    return np.concatenate(chunks)
+
+
+def _sample_rows(times, t0, t1, baseline):
+    '''
+    output:
+        slice of the sample rows needed for the t0..t1 window, from the first sample if baseline is True
+    '''
+    if t1 is None:
+        stop = len(times)
+    else:
+        stop = np.searchsorted(times, t1 + 1e-9, side='right')
+    if t0 is None or baseline:
+        start = 0
+    else:
+        start = np.searchsorted(times, t0 - 1e-9, side='left')
+    return slice(int(start), int(stop))
+
+
+def iter_waveform_blocks(file, t0=None, t1=None, baseline=True, block_size=1000, dtype=np.float64,
+                         max_waveforms=None, max_memory=512e6, use_cache=True):
+    '''
+    Read a run block by block, only the sample rows up to t1 (and from t0 if baseline is False)
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t0, t1: float of the start and end of the window in s, None for the start/end of the record
+        baseline: if True also read the samples before t0, for the baseline
+        block_size: int of waveforms per block
+        dtype: float type of the blocks
+        max_waveforms: int to only read the first max_waveforms waveforms
+        max_memory: float of bytes, a CSV whose rows fit in it is parsed in a single pass,
+                    otherwise every block is parsed separately (only its columns)
+        use_cache: if True CSV files are read through the parsed-data cache (see Waveform_cache.py), with t1 only
+                   if the file is already in it
+    yields:
+        times: 1D np.array of the sample times of the rows in s
+        block: 2D np.array of the voltages in V, one row per sample and one waveform per column
+    '''
+
+    #a read that stops at t1 does not parse the whole file into the cache
+    data = None if str(file).endswith(EXTENSION) else _cached(file, use_cache, parse=t1 is None)
+    if data is not None:
+        times = np.asarray(data[:, 0])
+        rows = _sample_rows(times, t0, t1, baseline)
+        num_waveforms = data.shape[1] - 1 if max_waveforms is None else min(data.shape[1] - 1, max_waveforms)
+        for start in range(0, num_waveforms, block_size):
+            stop = min(start + block_size, num_waveforms)
+            yield times[rows], np.asarray(data[rows, start + 1:stop + 1], dtype=dtype)
+        return
+
+    times = read_times(file, None if t1 is None else t1 + 1e-9)
+    rows = _sample_rows(times, t0, t1, baseline)
+    times = times[rows]
+
+    if str(file).endswith(EXTENSION):
+        run = RawRun(file)
+        num_waveforms = len(run) if max_waveforms is None else min(len(run), max_waveforms)
+        for start in range(0, num_waveforms, block_size):
+            stop = min(start + block_size, num_waveforms)
+            yield times, run.voltages(start, stop, dtype, rows).T
+        return
+
+    with open(file) as f:
+        num_waveforms = f.readline().count(',')
+    if max_waveforms is not None:
+        num_waveforms = min(num_waveforms, max_waveforms)
+
+    def read(columns):
+        #the C parser stops after nrows, and only converts the columns asked for
+        data = pd.read_csv(file, delimiter=',', usecols=columns, skiprows=range(1, rows.start + 1),
+                           nrows=rows.stop - rows.start, dtype=dtype, engine='c')
+        return data.to_numpy()
+
+    if len(times) * num_waveforms * np.dtype(dtype).itemsize <= max_memory:
+        data = read(range(1, num_waveforms + 1))
+        for start in range(0, num_waveforms, block_size):
+            yield times, data[:, start:start + block_size]
+    else:
+        for start in range(0, num_waveforms, block_size):
+            yield times, read(range(start + 1, min(start + block_size, num_waveforms) + 1))
+
+
+def average_waveform(file, t0=None, t1=None, dtype=np.float64, block_size=1000):
+    '''
+    Average pulse of all the waveforms of a run between t0 and t1, read block by block
+
+    input:
+        file: str of the path of a TakingSPEData CSV file or a .pmtraw file
+        t0, t1: float of the start and end of the window in s, None for the start/end of the record
+    output:
+        times: 1D np.array of the sample times in s
+        average: 1D np.array of the average voltage in V
+    '''
+
+    total = None
+    count = 0
+    for times, block in iter_waveform_blocks(file, t0, t1, baseline=False, block_size=block_size, dtype=dtype):
+        total = block.sum(axis=1) if total is None else total + block.sum(axis=1)
+        count += block.shape[1]
+
+    return times, total / count
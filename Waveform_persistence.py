@@ -0,0 +1,194 @@
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from Waveform_io import iter_waveform_blocks
+
+
+"""
+This draws all the waveforms of a run at once, like the persistence display of a scope: a 2D histogram of how
+many waveforms went through every (time, voltage) cell, with the average pulse and its +-1 sigma band on top.
+It shows the whole population of pulse shapes (pedestal, single and multiple photoelectrons, late pulses,
+ringing, ...) of 1e4+ waveforms in one picture, where Peaks_plotter.py only shows the average pulse and
+Scope_pulse_reconstruction.py one waveform per image.
+
+A PersistenceMap is filled block by block (every sample of a block is binned at once with np.bincount), so
+building it costs about one read of the run, and it can keep going over more blocks and files, or be merged
+with the map of another file or process. The voltage bins are fixed when the map is made: persistence_map()
+takes them from the first block (with a margin) unless voltage_range is given, and the samples falling
+outside of them are only counted (outside). The average and standard deviation are accumulated exactly, from
+every sample, not from the histogram.
+"""
+
+
+class PersistenceMap:
+    '''
+    Time x voltage occupancy of the waveforms of one or more runs, with their average and standard deviation
+
+    input:
+        times: 1D np.array of the sample times in s
+        voltage_range: tuple of the lowest and highest voltage of the histogram in V
+        num_voltage_bins: int of voltage bins
+    '''
+
+    def __init__(self, times, voltage_range, num_voltage_bins=256):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.voltage_edges = np.linspace(voltage_range[0], voltage_range[1], num_voltage_bins + 1)
+        self.counts = np.zeros((len(self.times), num_voltage_bins), dtype=np.int64)
+        self.outside = 0
+        self.num_waveforms = 0
+        self._mean = np.zeros(len(self.times))
+        self._m2 = np.zeros(len(self.times))   #sum of the squared deviations from the mean
+
+    def add(self, block):
+        '''
+        Add a block of waveforms
+
+        input:
+            block: 2D np.array of the voltages in V, one row per sample of times and one waveform per column
+        '''
+        block = np.asarray(block)
+        num_samples, num_waveforms = block.shape
+        if num_samples != len(self.times):
+            raise ValueError(f'{num_samples} samples per waveform, the map has {len(self.times)}')
+        if num_waveforms == 0:
+            return
+
+        num_bins = self.counts.shape[1]
+        low, high = self.voltage_edges[0], self.voltage_edges[-1]
+        position = (block - low) * (num_bins / (high - low))
+        inside = (position >= 0) & (position < num_bins)    #NaN is neither
+        cell = position[inside].astype(np.intp)
+        cell += np.broadcast_to(np.arange(num_samples)[:, None] * num_bins, block.shape)[inside]
+        self.counts += np.bincount(cell, minlength=self.counts.size).reshape(self.counts.shape)
+        self.outside += block.size - len(cell)
+
+        mean = block.mean(axis=1)
+        m2 = np.sum((block - mean[:, None])**2, axis=1)
+        self._combine(num_waveforms, mean, m2)
+
+    def _combine(self, num_waveforms, mean, m2):
+        '''
+        Combine the mean and m2 of more waveforms with the ones of the map (Chan et al. parallel variance)
+        '''
+        total = self.num_waveforms + num_waveforms
+        delta = mean - self._mean
+        self._mean = self._mean + delta * num_waveforms / total
+        self._m2 = self._m2 + m2 + delta**2 * self.num_waveforms * num_waveforms / total
+        self.num_waveforms = total
+
+    def merge(self, other):
+        '''
+        Add the waveforms of another map, with the same sample times and voltage bins (e.g. of another file)
+        '''
+        if len(other.times) != len(self.times) or not np.allclose(other.times, self.times, rtol=0, atol=1e-12):
+            raise ValueError('the maps do not have the same sample times')
+        if not np.array_equal(other.voltage_edges, self.voltage_edges):
+            raise ValueError('the maps do not have the same voltage bins')
+        if other.num_waveforms == 0:
+            return
+
+        self.counts += other.counts
+        self.outside += other.outside
+        self._combine(other.num_waveforms, other._mean, other._m2)
+
+    def average(self):
+        '''
+        output:
+            1D np.array of the average voltage in V at every sample time
+        '''
+        return self._mean.copy()
+
+    def std(self):
+        '''
+        output:
+            1D np.array of the standard deviation of the voltage in V at every sample time
+        '''
+        return np.sqrt(self._m2 / max(self.num_waveforms - 1, 1))
+
+
+def persistence_map(files, t0=None, t1=None, voltage_range=None, num_voltage_bins=256, subtract_baseline=True,
+                    block_size=1000, max_waveforms=None, persistence=None):
+    '''
+    Persistence map of all the waveforms of one or more runs, in a single pass over each file
+
+    input:
+        files: str of the path of a TakingSPEData CSV file or a .pmtraw file, or a list of them
+        t0, t1: float of the start and end of the window in s
+        voltage_range: tuple of the lowest and highest voltage in V, None to take it from the first block
+        num_voltage_bins: int of voltage bins
+        subtract_baseline: if True the mean of the samples before t0 is subtracted from every waveform
+        block_size: int of waveforms read at a time
+        max_waveforms: int to only use the first max_waveforms waveforms of every file
+        persistence: PersistenceMap to keep filling (e.g. of the files of the same PMT and HV), None for a new one
+    output:
+        PersistenceMap
+    '''
+    if isinstance(files, str):
+        files = [files]
+    if not files:
+        raise ValueError('no files')
+
+    for file in files:
+        blocks = iter_waveform_blocks(file, t0, t1, baseline=subtract_baseline, block_size=block_size,
+                                      max_waveforms=max_waveforms)
+        for times, block in blocks:
+            if subtract_baseline and t0 is not None:
+                window = times >= t0 - 1e-9
+                if not window.all():
+                    block = block[window] - block[~window].mean(axis=0)
+                times = times[window]
+
+            if persistence is None:
+                if voltage_range is None:
+                    low, high = np.nanmin(block), np.nanmax(block)
+                    margin = 0.25 * (high - low) if high > low else 1e-3
+                    voltage_range = (low - margin, high + margin)
+                persistence = PersistenceMap(times, voltage_range, num_voltage_bins)
+            elif len(times) != len(persistence.times) or not np.allclose(times, persistence.times, rtol=0, atol=1e-12):
+                raise ValueError(f'{file} does not have the same sample times as the previous files')
+
+            persistence.add(block)
+
+    if persistence is None:
+        raise ValueError(f"no waveforms in {', '.join(files)}")
+    if persistence.outside:
+        print(f'{persistence.outside} of {persistence.counts.sum() + persistence.outside} samples outside of '
+              f'{persistence.voltage_edges[0] * 1e3:.1f} to {persistence.voltage_edges[-1] * 1e3:.1f} mV')
+
+    return persistence
+
+
+def plot_persistence(persistence, title='', log=True, band=True):
+    '''
+    Plot a persistence map, with the average pulse and its +-1 sigma band
+
+    input:
+        persistence: PersistenceMap
+        title: str of the title of the plot
+        log: if True the colour scale is logarithmic, so single waveforms stay visible next to the pedestal
+        band: if True the average and +-1 sigma are drawn on top
+    '''
+    counts = np.ma.masked_equal(persistence.counts.T, 0)
+    norm = LogNorm(vmin=1, vmax=max(counts.max(), 1)) if log else None
+
+    #every sample is the middle of its time bin
+    times = persistence.times
+    middles = (times[1:] + times[:-1]) / 2
+    time_edges = np.concatenate([[2 * times[0] - middles[0]], middles, [2 * times[-1] - middles[-1]]])
+
+    plt.figure(figsize=(8, 6))
+    plt.pcolormesh(time_edges, persistence.voltage_edges, counts, cmap='viridis', norm=norm, rasterized=True)
+    plt.colorbar(label='Waveforms')
+
+    if band:
+        average, std = persistence.average(), persistence.std()
+        plt.plot(times, average, '-', color='red', label='Average')
+        plt.plot(times, average + std, '--', color='red', lw=0.8, label=r'Average $\pm 1\sigma$')
+        plt.plot(times, average - std, '--', color='red', lw=0.8)
+        plt.legend(loc='lower right')
+
+    plt.xlabel('Time (s)')
+    plt.ylabel('Voltage (V)')
+    plt.title(f'{title}\n{persistence.num_waveforms} waveforms'.strip())
+    plt.tight_layout()
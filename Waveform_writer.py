@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+import threading
+import glob
+import os
+
+
+"""
+This is a streaming writer for the SPE runs of TakingSPEData.py.
+
+Before, every waveform of a run was kept in a Python list and written to one big CSV file at the very end,
+so the memory grew with num_waveforms and a crash at waveform 9,999 lost everything.
+The writer keeps at most one chunk of waveforms in memory and writes every finished chunk to its own part file:
+
+    {name}_part0000.csv, {name}_part0001.csv, ...
+
+Every part has the same layout as the old single file (time in the first column, each waveform in its own
+column, named waveform_N with N the position in the whole run), so a part on its own is a valid, readable file.
+Parts are written to a temporary file first and then renamed, so a crash never leaves a half written part behind.
+
+When a run is restarted with the same name, the writer finds the parts that were already committed and the
+run can continue from the first waveform after them. merge() puts all the parts together into {name}.csv
+at the end of the run, line by line, so it doesn't need the whole run in memory either.
+"""
+
+
+class ChunkedWaveformWriter:
+    '''
+    Append waveforms to disk in chunks of chunk_size as they arrive
+
+    input:
+        name: str of full path name of the run, without file extension
+        chunk_size: int of waveforms per part file
+        resume: if True keep the full chunks already on disk and continue after them, if False start from scratch
+    '''
+
+    def __init__(self, name, chunk_size=1000, resume=True):
+        self.name = name
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+
+        parts = self.parts()
+        if not resume:
+            for part in parts:
+                os.remove(part)
+            parts = []
+
+        #only full chunks count as committed, a partial last chunk (written when a run stopped early) is taken again
+        self.num_chunks = 0
+        for part in parts:
+            if self._num_columns(part) - 1 != chunk_size:
+                os.remove(part)
+                break
+            self.num_chunks += 1
+        for part in self.parts()[self.num_chunks:]:
+            os.remove(part)
+
+        self.buffer = {}    #waveforms of the chunk being filled, keyed by their position in the run
+
+    @property
+    def num_committed(self):
+        '''
+        int of how many waveforms are safely on disk, a resumed run starts taking data from here
+        '''
+        return self.num_chunks * self.chunk_size
+
+    def parts(self):
+        '''
+        output:
+            sorted list of the part files of this run on disk
+        '''
+        return sorted(glob.glob(f'{glob.escape(self.name)}_part[0-9][0-9][0-9][0-9].csv'))
+
+    def _part_name(self, number):
+        return f'{self.name}_part{number:04d}.csv'
+
+    @staticmethod
+    def _num_columns(part):
+        with open(part) as f:
+            return len(f.readline().split(','))
+
+    def add(self, index, waveform):
+        '''
+        Add a waveform to the run. Waveforms can come in any order (e.g. from several pipeline workers),
+        a chunk is written as soon as all of its waveforms are there.
+
+        input:
+            index: int of the position of the waveform in the run
+            waveform: 2D array of [[time in s,] [voltages in V]]
+        '''
+        with self.lock:
+            self.buffer[index] = waveform
+
+            first = self.num_committed
+            if all(i in self.buffer for i in range(first, first + self.chunk_size)):
+                self._write_chunk([self.buffer.pop(i) for i in range(first, first + self.chunk_size)], first)
+                self.num_chunks += 1
+
+    def _write_chunk(self, waveforms, first):
+        '''
+        Write waveforms to the next part file, in the same layout as the single run file
+
+        input:
+            waveforms: list of 2D arrays of [[time in s,] [voltages in V]]
+            first: int of the position in the run of the first waveform
+        '''
+        part = self._part_name(self.num_chunks)
+
+        time_axis = waveforms[0][0]  #define the timing as the first row of the first waveform
+        data = np.vstack([time_axis] + [wf[1] for wf in waveforms]) #put each waveform together sequentially
+        headers = ['time (s)'] + [f'waveform_{first + i}' for i in range(len(waveforms))]
+
+        pd.DataFrame(data.T, columns=headers).to_csv(f'{part}.tmp', index=False)
+        os.replace(f'{part}.tmp', part)  #the part only shows up once it is complete
+
+    def close(self):
+        '''
+        Write the waveforms of the last, partially filled chunk so they end up on disk too
+
+        output:
+            int of how many waveforms are on disk in total
+        '''
+        with self.lock:
+            first = self.num_committed
+            waveforms = []
+            while first + len(waveforms) in self.buffer:
+                waveforms.append(self.buffer.pop(first + len(waveforms)))
+
+            if waveforms:
+                self._write_chunk(waveforms, first)
+
+            return first + len(waveforms)
+
+    def merge(self, keep_parts=False):
+        '''
+        Put all the part files together into a single {name}.csv with the time in the first column
+        and every waveform in its own column, like the original save_all_waveforms
+
+        input:
+            keep_parts: if False the part files are deleted once the merged file is written
+        output:
+            str of the path of the merged file
+        '''
+        csv_file_path = f'{self.name}.csv'
+        parts = self.parts()
+
+        files = [open(part) for part in parts]
+        try:
+            with open(f'{csv_file_path}.tmp', 'w') as out:
+                for lines in zip(*files):
+                    #only the first part keeps its time column
+                    row = [lines[0].rstrip('\n')] + [line.rstrip('\n').split(',', 1)[1] for line in lines[1:]]
+                    out.write(','.join(row) + '\n')
+        finally:
+            for f in files:
+                f.close()
+
+        os.replace(f'{csv_file_path}.tmp', csv_file_path)
+
+        if not keep_parts:
+            for part in parts:
+                os.remove(part)
+
+        print(f"Saved all waveforms to {csv_file_path}")
+
+        return csv_file_path
+
+
+def save_timestamps(timestamps, first_id, name):
+    '''
+    Append the trigger timestamps of a FastFrame batch to a CSV file - one row per waveform, with the first
+    waveform of the batch it was captured in and its trigger time relative to the first frame of that batch
+
+    input:
+        timestamps: 1D array of the trigger times of the batch
+        first_id: int of the position in the run of the first waveform of the batch
+        name: str of full path name of file to save to, without file extension
+    output:
+        none
+    '''
+
+    csv_file_path = f'{name}_timestamps.csv'
+
+    df = pd.DataFrame({
+        'waveform': first_id + np.arange(len(timestamps)),
+        'batch': first_id,
+        'trigger time (s)': timestamps,
+    })
+    df.to_csv(csv_file_path, index=False, mode='a', header=not os.path.exists(csv_file_path))
+
+
+def truncate_timestamps(name, num_waveforms):
+    '''
+    Drop the trigger timestamps of the waveforms from num_waveforms on, so a resumed run can append the ones of
+    the waveforms it takes again (with num_waveforms 0 the file is removed, for a new run)
+
+    input:
+        name: str of full path name of the run, without file extension
+        num_waveforms: int of waveforms committed to the data file, where the run starts
+    output:
+        none
+    '''
+
+    csv_file_path = f'{name}_timestamps.csv'
+    if not os.path.exists(csv_file_path):
+        return
+    if num_waveforms == 0:
+        os.remove(csv_file_path)
+        return
+
+    df = pd.read_csv(csv_file_path)
+    kept = df[df['waveform'] < num_waveforms]
+    if len(kept) < len(df):
+        kept.to_csv(f'{csv_file_path}.tmp', index=False)
+        os.replace(f'{csv_file_path}.tmp', csv_file_path)
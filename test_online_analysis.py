@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import Online_analysis
+from Online_analysis import OnlineCharge, PrecisionStop
+
+
+def last_fit(num_charges):
+    names = ['N', 'mu', 'Q0', 'sigma0', 'gain', 'sigma1']
+    values = [num_charges, 1.0, 5e-14, 1.5e-13, 1.6e-12, 5.6e-13]
+    return {'model': 'spe', 'names': names, 'params': dict(zip(names, values)),
+            'errors': {name: 0.01 * abs(value) for name, value in zip(names, values)},
+            'converged': True, 'at_bound': [], 'num_charges': num_charges}
+
+
+@pytest.mark.parametrize('error', [RuntimeError, ValueError, np.linalg.LinAlgError])
+def test_failed_refit(monkeypatch, error):
+    online = OnlineCharge(0, 1e-7)
+    online.charges = list(np.linspace(0, 5e-12, 2000))
+    stop = PrecisionStop(online, min_waveforms=1000)
+    stop.fit = last_fit(1000)
+
+    calls = []
+
+    def fit_spe(charges, model, bins, p0=None):
+        calls.append(p0)
+        if p0 is not None:
+            fit = last_fit(len(charges))
+            fit['converged'] = False
+            return fit
+        raise error('the fit from the charges failed')
+
+    monkeypatch.setattr(Online_analysis, 'fit_spe', fit_spe)
+
+    #the warm start did not converge and the fit from the charges raised: the run carries on
+    assert stop.refit() is None
+    assert stop.check(2000) is None
+    assert len(calls) == 4 and calls[1] is None
+    assert stop.fit['num_charges'] == 1000
+
+
+def test_resume_with_the_data_behind_the_charges(tmp_path):
+    path = str(tmp_path / 'run_charges.csv')
+    online = OnlineCharge(0, 1e-7, path)
+    online.charges = [1e-12 * i for i in range(5)]
+    with open(path, 'a') as f:
+        f.write(''.join(f'{i},{charge!r}\n' for i, charge in enumerate(online.charges)))
+    online.close()
+
+    #the data file only got 3 of the 5 waveforms before the crash
+    online = OnlineCharge(0, 1e-7, path, resume=True)
+    assert online.num_committed == 5
+    online.truncate(3)
+    assert online.num_committed == 3
+    with pytest.raises(ValueError):
+        online.truncate(4)
+
+    #the waveform taken again is committed right after the ones kept
+    scal_info = {'xincr': 1e-9, 'HPos': 0.0, 'HDelay': 0.0, 'ymult': 1e-3, 'yoff': 0.0, 'yzero': 0.0}
+    online.add(3, np.full((1, 200), 100, dtype=np.uint8), scal_info)
+    assert online.num_committed == 4 and not online.pending
+    online.close()
+    charges = np.loadtxt(path, delimiter=',', skiprows=1)
+    assert list(charges[:, 0]) == [0, 1, 2, 3]
+    assert list(charges[:3, 1]) == [0.0, 1e-12, 2e-12]
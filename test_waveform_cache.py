@@ -0,0 +1,41 @@
+import numpy as np
+import os
+
+from Waveform_cache import WaveformCache, file_hash
+
+
+def write_csv(path, num_rows, final_newline):
+    times = np.arange(num_rows) * 1e-9
+    lines = ['TIME,CH1_0,CH1_1'] + [f'{t:g},{i * 1e-3:g},{-i * 1e-3:g}' for i, t in enumerate(times)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + ('\n' if final_newline else ''))
+
+
+def test_file_without_final_newline(tmp_path):
+    for final_newline in (True, False):
+        file = tmp_path / f'run_{final_newline}.csv'
+        write_csv(file, 200, final_newline)
+        assert file_hash(file)[1] == 201
+
+        cache = WaveformCache(str(tmp_path / 'cache'))
+        data = cache.load(str(file))
+        assert data.shape == (200, 3)
+        assert data[-1, 1] == 199e-3
+
+    #no parse left anything behind
+    assert not [name for name in os.listdir(tmp_path / 'cache') if '.tmp' in name]
+
+
+def test_file_with_trailing_empty_lines(tmp_path):
+    file = tmp_path / 'run.csv'
+    write_csv(file, 200, True)
+    with open(file, 'a') as f:
+        f.write('\n\n\n')
+
+    cache = WaveformCache(str(tmp_path / 'cache'))
+    data = cache.load(str(file))
+    assert data.shape == (200, 3)
+    assert data[-1, 1] == 199e-3
+    #the trimmed matrix is the one kept, and read again from the cache
+    assert cache.load(str(file)).shape == (200, 3)
+    assert not [name for name in os.listdir(tmp_path / 'cache') if '.tmp' in name or '.trim' in name]